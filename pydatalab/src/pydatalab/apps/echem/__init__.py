@@ -1,3 +1,3 @@
-from .blocks import CycleBlock
+from .blocks import CapacityFadeBlock, CycleBlock
 
-__all__ = ("CycleBlock",)
+__all__ = ("CycleBlock", "CapacityFadeBlock")
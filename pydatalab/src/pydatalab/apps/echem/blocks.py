@@ -1,25 +1,44 @@
+import hashlib
+import json
+import multiprocessing
 import os
-import time
+import warnings
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import Union
+from typing import Any, Dict, List, Optional, Tuple
 
 import bokeh
 import pandas as pd
-from bson import ObjectId
-from navani import echem as ec
 
 from pydatalab import bokeh_plots
 from pydatalab.blocks.base import DataBlock
 from pydatalab.file_utils import get_file_info_by_id
 from pydatalab.logger import LOGGER
 from pydatalab.mongo import flask_mongo
+from pydatalab.permissions import get_default_permissions
 
 from .utils import (
+    cache_echem_file,
+    compute_capacity_retention,
     compute_gpcl_differential,
     filter_df_by_cycle_index,
+    load_cached_cycle_summary,
+    load_cached_cycle_summary_error,
+    load_echem_file,
     reduce_echem_cycle_sampling,
 )
 
+_CYCLE_SUMMARY_POOL: Optional[ProcessPoolExecutor] = None
+"""A lazily-created pool of worker processes used to populate missing echem parse caches."""
+
+_CYCLE_SUMMARY_JOBS: Dict[Tuple[str, int], Future] = {}
+"""The parse jobs submitted to the worker pool, keyed by file location and revision."""
+
+MAX_DIFFERENTIAL_CACHES: int = 8
+"""The maximum number of differential caches (i.e., sets of differential parameters)
+kept for each file; the least recently used caches are removed beyond this."""
+
 
 class CycleBlock(DataBlock):
     """A data block for processing electrochemical cycling data.
@@ -53,21 +72,20 @@ class CycleBlock(DataBlock):
     }
 
     def _get_characteristic_mass_g(self):
-        # return {"characteristic_mass": 1000}
-        doc = flask_mongo.db.items.find_one(
-            {"item_id": self.data["item_id"]}, {"characteristic_mass": 1}
-        )
+        doc = self.get_item_context()
+        if not doc:
+            return None
         characteristic_mass_mg = doc.get("characteristic_mass", None)
         if characteristic_mass_mg:
             return characteristic_mass_mg / 1000.0
         return None
 
-    def _load(self, file_id: Union[str, ObjectId], reload: bool = True):
-        """Loads the echem data using navani, summarises it, then caches the results
-        to disk with suffixed names.
+    def _load(self, file_info: Dict[str, Any], reload: bool = True):
+        """Loads the echem data using navani, summarises it and indexes the row ranges
+        of each cycle, then caches the results to disk with suffixed names.
 
         Parameters:
-            file_id: The ID of the file to load.
+            file_info: The file information for the file to load, as returned by `get_file_info_by_id`.
             reload: Whether to reload the data from the file, or use the cached version, if available.
 
         """
@@ -94,7 +112,6 @@ class CycleBlock(DataBlock):
             "dvdq": "dV/dQ (V/mA)",
         }
 
-        file_info = get_file_info_by_id(file_id, update_if_live=True)
         filename = file_info["name"]
 
         if file_info.get("is_live"):
@@ -107,38 +124,7 @@ class CycleBlock(DataBlock):
                 f"Unrecognized filetype {ext}, must be one of {self.accepted_file_extensions}"
             )
 
-        parsed_file_loc = Path(file_info["location"]).with_suffix(".RAW_PARSED.pkl")
-        cycle_summary_file_loc = Path(file_info["location"]).with_suffix(".SUMMARY.pkl")
-
-        raw_df = None
-        cycle_summary_df = None
-        if not reload:
-            if parsed_file_loc.exists():
-                raw_df = pd.read_pickle(parsed_file_loc)
-
-            if cycle_summary_file_loc.exists():
-                cycle_summary_df = pd.read_pickle(cycle_summary_file_loc)
-
-        if raw_df is None:
-            try:
-                LOGGER.debug("Loading file %s", file_info["location"])
-                start_time = time.time()
-                raw_df = ec.echem_file_loader(file_info["location"])
-                LOGGER.debug(
-                    "Loaded file %s in %s seconds",
-                    file_info["location"],
-                    time.time() - start_time,
-                )
-            except Exception as exc:
-                raise RuntimeError(f"Navani raised an error when parsing: {exc}") from exc
-            raw_df.to_pickle(parsed_file_loc)
-
-        try:
-            if cycle_summary_df is None:
-                cycle_summary_df = ec.cycle_summary(raw_df)
-                cycle_summary_df.to_pickle(cycle_summary_file_loc)
-        except Exception:
-            pass
+        raw_df, cycle_summary_df, cycle_index = load_echem_file(file_info["location"], reload)
 
         raw_df = raw_df.filter(required_keys)
         raw_df.rename(columns=keys_with_units, inplace=True)
@@ -149,7 +135,42 @@ class CycleBlock(DataBlock):
                 cycle_summary_df.index, downcast="integer"
             )
 
-        return raw_df, cycle_summary_df
+        return raw_df, cycle_summary_df, cycle_index
+
+    @staticmethod
+    def _get_differential_cache_location(
+        file_info: Dict[str, Any], differential_parameters: Dict[str, Any]
+    ) -> Path:
+        """Returns the location of the cache of per-half-cycle differentials for the given file
+        revision and set of differential parameters, stored alongside the parsed data cache.
+
+        Parameters:
+            file_info: The file information for the file, as returned by `get_file_info_by_id`.
+            differential_parameters: All the parameters that affect the computed differentials.
+
+        """
+        key = hashlib.sha1(
+            json.dumps(
+                {"revision": file_info.get("revision"), **differential_parameters}, sort_keys=True
+            ).encode("utf-8")
+        ).hexdigest()[:16]
+        return Path(file_info["location"]).with_suffix(f".DIFFERENTIAL-{key}.pkl")
+
+    @staticmethod
+    def _prune_differential_caches(file_info: Dict[str, Any]) -> None:
+        """Removes the least recently used differential caches of the file, beyond
+        `MAX_DIFFERENTIAL_CACHES`, including any left over from older revisions.
+
+        """
+        location = Path(file_info["location"])
+        caches = []
+        for cache in location.parent.glob(f"{location.stem}.DIFFERENTIAL-*.pkl"):
+            try:
+                caches.append((cache.stat().st_mtime, cache))
+            except FileNotFoundError:
+                continue
+        for _, cache in sorted(caches, reverse=True)[MAX_DIFFERENTIAL_CACHES:]:
+            cache.unlink(missing_ok=True)
 
     def plot_cycle(self):
         """Plots the electrochemical cycling data from the file ID provided in the request."""
@@ -178,7 +199,11 @@ class CycleBlock(DataBlock):
         if not isinstance(cycle_list, list):
             cycle_list = None
 
-        raw_df, cycle_summary_df = self._load(file_id)
+        file_info = get_file_info_by_id(file_id, update_if_live=True)
+        # Use the parse caches unless the file is live, i.e., may have changed remotely
+        raw_df, cycle_summary_df, cycle_index = self._load(
+            file_info, reload=bool(file_info.get("is_live"))
+        )
 
         characteristic_mass_g = self._get_characteristic_mass_g()
 
@@ -193,21 +218,50 @@ class CycleBlock(DataBlock):
                     cycle_summary_df["discharge capacity (mAh)"] / characteristic_mass_g
                 )
 
-        df = filter_df_by_cycle_index(raw_df, cycle_list)
+        df = filter_df_by_cycle_index(raw_df, cycle_list, cycle_index=cycle_index)
         if cycle_summary_df is not None:
             cycle_summary_df = filter_df_by_cycle_index(cycle_summary_df, cycle_list)
 
         if mode in ("dQ/dV", "dV/dQ"):
+            differential_parameters = {
+                "mode": mode,
+                "polynomial_spline": int(self.data["p_spline"]),
+                "s_spline": 10 ** (-float(self.data["s_spline"])),
+                "window_size_1": int(self.data["win_size_1"]),
+                "window_size_2": int(self.data["win_size_2"]),
+                "use_normalized_capacity": bool(characteristic_mass_g),
+            }
+
+            # Differentials are cached per half cycle for each file revision and parameter set,
+            # so that changing the cycle selection only requires computing any new half cycles
+            differential_cache_loc = self._get_differential_cache_location(
+                file_info,
+                {**differential_parameters, "characteristic_mass_g": characteristic_mass_g},
+            )
+            differential_cache: Dict[int, Optional[pd.DataFrame]] = {}
+            if differential_cache_loc.exists():
+                try:
+                    differential_cache = pd.read_pickle(differential_cache_loc)
+                    # mark the cache as recently used, so that it is pruned last
+                    os.utime(differential_cache_loc)
+                except Exception as exc:
+                    LOGGER.warning(
+                        "Unable to read differential cache %s: %s", differential_cache_loc, exc
+                    )
+            num_cached_half_cycles = len(differential_cache)
+
             df = compute_gpcl_differential(
                 df,
-                mode=mode,
-                polynomial_spline=int(self.data["p_spline"]),
-                s_spline=10 ** (-float(self.data["s_spline"])),
-                window_size_1=int(self.data["win_size_1"]),
-                window_size_2=int(self.data["win_size_2"]),
-                use_normalized_capacity=bool(characteristic_mass_g),
+                **differential_parameters,
+                # Only pay the cost of starting worker processes when there are many cycles to fit
+                parallel=df["half cycle"].nunique() > 50,
+                cache=differential_cache,
             )
 
+            if len(differential_cache) > num_cached_half_cycles:
+                pd.to_pickle(differential_cache, differential_cache_loc)
+                self._prune_differential_caches(file_info)
+
         # Reduce df size to 100 points per cycle by default if there are more than a 100k points
         if len(df) > 1e5:
             df = reduce_echem_cycle_sampling(df, num_samples=100)
@@ -227,3 +281,248 @@ class CycleBlock(DataBlock):
     @property
     def plot_functions(self):
         return (self.plot_cycle,)
+
+
+def _queue_echem_file_caching(location: str, revision: int) -> Future:
+    """Submit a job to parse the given raw cycler file and populate its caches on the
+    background worker pool, unless a job for the same file revision is still running.
+    Finished jobs are forgotten: their results are read from the parse caches, or from
+    the recorded error (see `load_cached_cycle_summary_error`).
+
+    Raises:
+        BrokenProcessPool: If the worker pool has failed, in which case a new pool
+            will be created for the next job.
+
+    Returns:
+        The future corresponding to the (new or existing) job.
+
+    """
+    global _CYCLE_SUMMARY_POOL
+
+    key = (location, revision)
+    job = _CYCLE_SUMMARY_JOBS.get(key)
+    if job is not None:
+        return job
+
+    if _CYCLE_SUMMARY_POOL is None:
+        _CYCLE_SUMMARY_POOL = ProcessPoolExecutor(
+            max_workers=max(min(os.cpu_count() or 1, 4), 1),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    LOGGER.debug("Queueing echem parse of %s (revision %s)", location, revision)
+    try:
+        job = _CYCLE_SUMMARY_POOL.submit(cache_echem_file, location)
+    except BrokenProcessPool:
+        _CYCLE_SUMMARY_POOL = None
+        raise
+    _CYCLE_SUMMARY_JOBS[key] = job
+    job.add_done_callback(lambda _: _CYCLE_SUMMARY_JOBS.pop(key, None))
+    return job
+
+
+def get_capacity_fade_data(
+    collection_id: Optional[str] = None, item_id: Optional[str] = None
+) -> Tuple[pd.DataFrame, List[str], List[str]] | None:
+    """Gather the capacity retention and coulombic efficiency of every cycling file
+    attached to the cells in the given collection (or to the given item).
+
+    Only the cached cycle summaries are read, so no raw file is parsed during the request;
+    any files without a (fresh) cache are instead queued for parsing on a background worker pool.
+
+    Parameters:
+        collection_id: The collection whose cells should be gathered, or
+        item_id: The single item to gather.
+
+    Returns:
+        A long-format dataframe (see `compute_capacity_retention`) with additional columns for the
+        `file_id`, `item_id` and `filename` of each series, a list of the file IDs that are still
+        being processed and a list of errors for files that could not be parsed, or `None` if the
+        collection or item could not be found.
+
+    """
+    if collection_id is not None:
+        collection = flask_mongo.db.collections.find_one(
+            {"collection_id": collection_id, **get_default_permissions(user_only=False)},
+            {"_id": 1},
+        )
+        if collection is None:
+            return None
+        item_match = {
+            "type": "cells",
+            "relationships.type": "collections",
+            "relationships.immutable_id": collection["_id"],
+        }
+    elif item_id is not None:
+        item_match = {"item_id": item_id}
+    else:
+        raise RuntimeError("Must provide one of `collection_id` or `item_id`.")
+
+    items = list(
+        flask_mongo.db.items.find(
+            {**item_match, **get_default_permissions(user_only=False)},
+            {"item_id": 1, "file_ObjectIds": 1, "characteristic_mass": 1},
+        )
+    )
+    if item_id is not None and not items:
+        return None
+
+    file_ids = [file_id for item in items for file_id in item.get("file_ObjectIds") or []]
+    files = flask_mongo.db.files.find(
+        {"_id": {"$in": file_ids}, **get_default_permissions(user_only=False)},
+        {"name": 1, "location": 1, "revision": 1, "item_ids": 1},
+    )
+
+    item_by_file_id = {
+        str(file_id): item for item in items for file_id in item.get("file_ObjectIds") or []
+    }
+
+    cycle_summaries: Dict[str, pd.DataFrame] = {}
+    filenames: Dict[str, str] = {}
+    pending: List[str] = []
+    errors: List[str] = []
+    for file in files:
+        file_id = str(file["_id"])
+        ext = os.path.splitext(file["name"])[-1].lower()
+        if ext not in CycleBlock.accepted_file_extensions or not file.get("location"):
+            continue
+
+        try:
+            cycle_summary, is_stale = load_cached_cycle_summary(file["location"])
+        except Exception as exc:
+            LOGGER.warning("Unable to read cached cycle summary for %s: %s", file["location"], exc)
+            cycle_summary, is_stale = None, True
+
+        if is_stale:
+            error = load_cached_cycle_summary_error(file["location"])
+            if error is None:
+                try:
+                    job = _queue_echem_file_caching(file["location"], file.get("revision", 1))
+                    if job.done() and job.exception() is not None:
+                        error = str(job.exception())
+                except BrokenProcessPool as exc:
+                    error = str(exc)
+            if error is not None:
+                errors.append(f"Unable to parse {file['name']!r}: {error}")
+            elif cycle_summary is None:
+                pending.append(file_id)
+
+        if cycle_summary is not None:
+            cycle_summaries[file_id] = cycle_summary
+            filenames[file_id] = file["name"]
+
+    df = compute_capacity_retention(cycle_summaries)
+
+    # Normalize capacities by the characteristic mass of each cell, where available
+    characteristic_masses_g = {
+        file_id: item["characteristic_mass"] / 1000.0
+        for file_id, item in item_by_file_id.items()
+        if item.get("characteristic_mass")
+    }
+    masses = df["series"].map(characteristic_masses_g)
+    df["charge capacity (mAh/g)"] = df["charge capacity (mAh)"] / masses
+    df["discharge capacity (mAh/g)"] = df["discharge capacity (mAh)"] / masses
+
+    df["file_id"] = df["series"]
+    df["item_id"] = df["series"].map(lambda file_id: item_by_file_id[file_id]["item_id"])
+    df["filename"] = df["series"].map(filenames)
+
+    return df, pending, errors
+
+
+def capacity_fade_payload(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Convert the long-format capacity fade dataframe into a compact JSON-serializable
+    list with one entry per series, with each column stored as a list of values.
+
+    """
+    value_columns = [
+        "cycle index",
+        "charge capacity (mAh)",
+        "discharge capacity (mAh)",
+        "charge capacity (mAh/g)",
+        "discharge capacity (mAh/g)",
+        "capacity retention (%)",
+        "coulombic efficiency (%)",
+    ]
+    payload = []
+    for (file_id, item_id, filename), series in df.groupby(
+        ["file_id", "item_id", "filename"], sort=False
+    ):
+        values = series[value_columns].astype(object)
+        values = values.where(values.notna(), None)
+        payload.append(
+            {
+                "file_id": file_id,
+                "item_id": item_id,
+                "filename": filename,
+                **{column: values[column].tolist() for column in value_columns},
+            }
+        )
+    return payload
+
+
+class CapacityFadeBlock(DataBlock):
+    """A data block for comparing capacity retention across many electrochemical cells.
+
+    This block reads the cached cycle summaries of all cycling files attached to the
+    cells in a collection (or to a single item) and plots their capacity retention and
+    coulombic efficiency per cycle. Raw files are never parsed while rendering the block;
+    any missing caches are populated in the background by a pool of worker processes.
+
+    """
+
+    blocktype = "capacity-fade"
+    name = "Capacity fade"
+    description = "This block compares capacity retention and coulombic efficiency across all cycled cells in a collection."
+    accepted_file_extensions = CycleBlock.accepted_file_extensions
+    _supports_collections = True
+
+    @property
+    def plot_functions(self):
+        return (self.plot_capacity_fade,)
+
+    def plot_capacity_fade(self):
+        """Plots the capacity retention of all cells attached to the block's collection or item."""
+        result = get_capacity_fade_data(
+            collection_id=self.data.get("collection_id"), item_id=self.data.get("item_id")
+        )
+        if result is None:
+            LOGGER.warning("No collection or item found for %s", self.block_id)
+            return
+
+        df, pending, errors = result
+        self.data["pending_file_ids"] = pending
+        if pending:
+            warnings.warn(
+                f"{len(pending)} file(s) are still being processed and will appear once parsed."
+            )
+        for error in errors:
+            warnings.warn(error)
+
+        if df.empty:
+            return
+
+        series = {
+            f"{item_id}: {filename}": series_df
+            for (item_id, filename), series_df in df.groupby(["item_id", "filename"], sort=False)
+        }
+        normalized = df["discharge capacity (mAh/g)"].notna().any()
+
+        layout = bokeh_plots.selectable_axes_plot(
+            series,
+            x_options=["cycle index"],
+            y_options=[
+                "capacity retention (%)",
+                "coulombic efficiency (%)",
+                "discharge capacity (mAh)",
+                "charge capacity (mAh)",
+                *(["discharge capacity (mAh/g)", "charge capacity (mAh/g)"] if normalized else []),
+            ],
+            plot_line=True,
+            plot_points=True,
+            point_size=3,
+        )
+
+        self.data["bokeh_plot_data"] = bokeh.embed.json_item(
+            layout, theme=bokeh_plots.DATALAB_BOKEH_THEME
+        )
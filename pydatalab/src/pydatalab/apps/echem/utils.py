@@ -1,4 +1,11 @@
-from typing import List, Optional
+import functools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import navani.echem as ec
 import numpy as np
@@ -7,6 +14,197 @@ import pandas as pd
 from pydatalab.logger import LOGGER
 from pydatalab.utils import reduce_df_size
 
+_DIFFERENTIAL_POOL: Optional[ProcessPoolExecutor] = None
+"""A lazily-created pool of worker processes used to compute differentials of half cycles."""
+
+
+def _get_echem_cache_location(location: Union[str, Path], cache_name: str) -> Path:
+    """Returns the location of the named parse cache for the given raw cycler file."""
+    return Path(location).with_suffix(f".{cache_name}.pkl")
+
+
+def _is_fresh(cache_location: Path, location: Union[str, Path]) -> bool:
+    return cache_location.exists() and cache_location.stat().st_mtime >= os.path.getmtime(location)
+
+
+def load_echem_file(
+    location: Union[str, Path], reload: bool = True
+) -> Tuple[pd.DataFrame, Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+    """Loads the echem data using navani, summarises it and indexes the row ranges
+    of each cycle, then caches the results to disk alongside the file with suffixed names.
+
+    Parameters:
+        location: The location of the raw cycler file to load.
+        reload: Whether to reload the data from the file, or use the cached version, if
+            available and no older than the file.
+
+    Returns:
+        The raw dataframe as returned by navani, the cycle summary dataframe and the
+        cycle index (or `None` where either of the latter could not be computed).
+
+    """
+    parsed_file_loc = _get_echem_cache_location(location, "RAW_PARSED")
+    cycle_summary_file_loc = _get_echem_cache_location(location, "SUMMARY")
+    cycle_index_file_loc = _get_echem_cache_location(location, "CYCLE_INDEX")
+
+    raw_df = None
+    cycle_summary_df = None
+    cycle_index = None
+    if not reload:
+        if _is_fresh(parsed_file_loc, location):
+            raw_df = pd.read_pickle(parsed_file_loc)
+
+        if _is_fresh(cycle_summary_file_loc, location):
+            cycle_summary_df = pd.read_pickle(cycle_summary_file_loc)
+
+        if raw_df is not None and _is_fresh(cycle_index_file_loc, location):
+            cycle_index = pd.read_pickle(cycle_index_file_loc)
+
+    if raw_df is None:
+        try:
+            LOGGER.debug("Loading file %s", location)
+            start_time = time.time()
+            raw_df = ec.echem_file_loader(location)
+            LOGGER.debug(
+                "Loaded file %s in %s seconds",
+                location,
+                time.time() - start_time,
+            )
+        except Exception as exc:
+            raise RuntimeError(f"Navani raised an error when parsing: {exc}") from exc
+        raw_df.to_pickle(parsed_file_loc)
+
+    try:
+        if cycle_summary_df is None:
+            cycle_summary_df = ec.cycle_summary(raw_df)
+            cycle_summary_df.to_pickle(cycle_summary_file_loc)
+    except Exception as exc:
+        LOGGER.debug("Unable to compute cycle summary for %s: %s", location, exc)
+        cycle_summary_df = None
+
+    try:
+        if cycle_index is None:
+            cycle_index = build_cycle_index(raw_df)
+            if cycle_index is not None:
+                cycle_index.to_pickle(cycle_index_file_loc)
+    except Exception as exc:
+        LOGGER.debug("Unable to build cycle index for %s: %s", location, exc)
+
+    return raw_df, cycle_summary_df, cycle_index
+
+
+def _get_cycle_summary_error_location(location: Union[str, Path]) -> Path:
+    return Path(location).with_suffix(".SUMMARY_ERROR.txt")
+
+
+def cache_echem_file(location: Union[str, Path]) -> None:
+    """Parses the given raw cycler file and writes all of its parse caches, without
+    returning the (potentially large) parsed data, e.g., for use in a background worker.
+
+    If the file cannot be parsed or summarised, the error is recorded alongside the file
+    (see `load_cached_cycle_summary_error`), so that it is not reparsed until it changes.
+
+    Raises:
+        RuntimeError: If the file could not be parsed, or its cycle summary computed.
+
+    """
+    error_file_loc = _get_cycle_summary_error_location(location)
+    try:
+        _, cycle_summary_df, _ = load_echem_file(location, reload=True)
+        if cycle_summary_df is None:
+            raise RuntimeError("Unable to compute the cycle summary")
+    except Exception as exc:
+        error_file_loc.write_text(str(exc))
+        raise
+    error_file_loc.unlink(missing_ok=True)
+
+
+def load_cached_cycle_summary_error(location: Union[str, Path]) -> Optional[str]:
+    """Returns the error recorded by `cache_echem_file` when the current version of the
+    given raw cycler file could not be summarised, if any.
+
+    """
+    error_file_loc = _get_cycle_summary_error_location(location)
+    try:
+        if error_file_loc.stat().st_mtime < Path(location).stat().st_mtime:
+            return None
+        return error_file_loc.read_text()
+    except FileNotFoundError:
+        return None
+
+
+def load_cached_cycle_summary(location: Union[str, Path]) -> Tuple[Optional[pd.DataFrame], bool]:
+    """Loads the cycle summary for the given raw cycler file from the parse cache only,
+    without ever parsing the raw file itself.
+
+    Parameters:
+        location: The location of the raw cycler file.
+
+    Returns:
+        The cached cycle summary as computed by navani (or `None` if it has not been cached),
+        and whether the cached summary is stale, i.e., older than the raw file.
+
+    """
+    cycle_summary_file_loc = _get_echem_cache_location(location, "SUMMARY")
+    try:
+        cache_mtime = cycle_summary_file_loc.stat().st_mtime
+    except FileNotFoundError:
+        return None, True
+
+    try:
+        is_stale = cache_mtime < Path(location).stat().st_mtime
+    except FileNotFoundError:
+        is_stale = False
+
+    return pd.read_pickle(cycle_summary_file_loc), is_stale
+
+
+def compute_capacity_retention(cycle_summaries: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """Compute the capacity retention and coulombic efficiency per cycle for many cells at once.
+
+    Parameters:
+        cycle_summaries: A mapping from a series label (e.g., a file ID) to the corresponding
+            cycle summary as computed by navani, with "Charge Capacity" and
+            "Discharge Capacity" columns indexed by full cycle.
+
+    Returns:
+        A single long-format dataframe with the columns "series", "cycle index",
+        "charge capacity (mAh)", "discharge capacity (mAh)", "capacity retention (%)"
+        and "coulombic efficiency (%)", sorted by series then cycle.
+
+    """
+    columns = ["charge capacity (mAh)", "discharge capacity (mAh)"]
+    frames = [
+        pd.DataFrame(
+            {
+                "series": label,
+                "cycle index": pd.to_numeric(summary.index, downcast="integer"),
+                "charge capacity (mAh)": summary["Charge Capacity"].to_numpy(dtype=float),
+                "discharge capacity (mAh)": summary["Discharge Capacity"].to_numpy(dtype=float),
+            }
+        )
+        for label, summary in cycle_summaries.items()
+        if {"Charge Capacity", "Discharge Capacity"}.issubset(summary.columns) and len(summary)
+    ]
+
+    if not frames:
+        return pd.DataFrame(
+            columns=["series", "cycle index", *columns]
+            + ["capacity retention (%)", "coulombic efficiency (%)"]
+        )
+
+    df = pd.concat(frames, ignore_index=True).sort_values(["series", "cycle index"])
+
+    # Retention is measured relative to the first cycle with a non-zero discharge capacity
+    discharge = df["discharge capacity (mAh)"]
+    initial_discharge = discharge.where(discharge > 0).groupby(df["series"]).transform("first")
+    df["capacity retention (%)"] = 100 * discharge / initial_discharge
+    df["coulombic efficiency (%)"] = (
+        100 * discharge / df["charge capacity (mAh)"].where(df["charge capacity (mAh)"] > 0)
+    )
+
+    return df.reset_index(drop=True)
+
 
 def reduce_echem_cycle_sampling(df: pd.DataFrame, num_samples: int = 100) -> pd.DataFrame:
     """Reduce number of cycles to at most `num_samples` points per half cycle. Will
@@ -30,6 +228,27 @@ def reduce_echem_cycle_sampling(df: pd.DataFrame, num_samples: int = 100) -> pd.
     return return_df
 
 
+def _compute_half_cycle_differential(
+    y: np.ndarray, x: np.ndarray, smoothing_parameters: Dict[str, Any]
+) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Compute the spline-smoothed derivative for a single half cycle with navani,
+    returning `None` if the derivative could not be computed (e.g., for rests or voltage holds).
+
+    This function is defined at the module level so that it can be pickled
+    and dispatched to a process pool.
+
+    """
+    try:
+        return ec.dqdv_single_cycle(y, x, **smoothing_parameters)
+    except TypeError as e:
+        LOGGER.debug(
+            f"""Calculating derivative failed with the following error (likely it is a rest or voltage hold):
+             {e}
+            Skipping derivative calculation for this half cycle."""
+        )
+        return None
+
+
 def compute_gpcl_differential(
     df: pd.DataFrame,
     mode: str = "dQ/dV",
@@ -41,6 +260,8 @@ def compute_gpcl_differential(
     polyorder_1: int = 5,
     polyorder_2: int = 5,
     use_normalized_capacity: bool = False,
+    parallel: bool = False,
+    cache: Optional[Dict[int, Optional[pd.DataFrame]]] = None,
 ) -> pd.DataFrame:
     """Compute differential dQ/dV or dV/dQ for the input dataframe.
 
@@ -54,12 +275,19 @@ def compute_gpcl_differential(
         window_size_2: The window size for the `savgol` filter when smoothing the final differential.
         polyorder_1: The polynomial order for the `savgol` filter when smoothing the capacity.
         polyorder_2: The polynomial order for the `savgol` filter when smoothing the final differential.
+        parallel: If true, compute the derivative of each half cycle in a shared pool of worker processes.
+        cache: An optional mapping from half cycle index to previously computed differential
+            data for the same input data and parameters. Any half cycles present in the cache
+            are reused rather than recomputed, and the cache is updated in place with any
+            newly computed half cycles (failed half cycles are stored as `None`).
 
     Returns:
         A data frame containing the voltages, capacities and requested differential
         on the reduced cycle list.
 
     """
+    global _DIFFERENTIAL_POOL
+
     if len(df) < 2:
         LOGGER.debug(
             f"compute_gpcl_differential called on dataframe with length {len(df)}, too small to calculate derivatives"
@@ -85,51 +313,109 @@ def compute_gpcl_differential(
         "final_smooth": smoothing,
     }
 
-    differential_df = pd.DataFrame()
+    # Split the frame into half cycles once, keeping the order in which they appear
+    half_cycle_indices = df.groupby("half cycle", sort=False).indices
+    y_values = df[y_label].to_numpy()
+    x_values = df[x_label].to_numpy()
+    full_cycle_values = df["full cycle"].to_numpy()
+
+    if cache is None:
+        cache = {}
+
+    half_cycles = list(half_cycle_indices)
+    missing_half_cycles = [cycle for cycle in half_cycles if int(cycle) not in cache]
+    segments = [
+        (y_values[half_cycle_indices[cycle]], x_values[half_cycle_indices[cycle]])
+        for cycle in missing_half_cycles
+    ]
+
+    compute = functools.partial(
+        _compute_half_cycle_differential, smoothing_parameters=smoothing_parameters
+    )
+    results = None
+    if parallel and len(segments) > 1:
+        if _DIFFERENTIAL_POOL is None:
+            _DIFFERENTIAL_POOL = ProcessPoolExecutor(
+                max_workers=max(min(os.cpu_count() or 1, 8), 1),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        try:
+            results = list(_DIFFERENTIAL_POOL.map(compute, *zip(*segments)))
+        except BrokenProcessPool as exc:
+            LOGGER.warning("Differential worker pool failed, computing serially: %s", exc)
+            _DIFFERENTIAL_POOL = None
 
-    # Loop over distinct half cycles
-    for cycle in df["half cycle"].unique():
-        # Extract all segments corresponding to this half cycle index
-        df_cycle = df[df["half cycle"] == cycle]
+    if results is None:
+        results = [compute(y, x) for y, x in segments]
 
-        # Compute the desired derivative
-        try:
-            x, yp, y = ec.dqdv_single_cycle(
-                df_cycle[y_label], df_cycle[x_label], **smoothing_parameters
-            )
-        except TypeError as e:
-            LOGGER.debug(
-                f"""Calculating derivative {mode} of half_cycle {cycle} failed with the following error (likely it is a rest or voltage hold):
-                 {e}
-                Skipping derivative calculation for this half cycle."""
-            )
+    for cycle, result in zip(missing_half_cycles, results):
+        if result is None:
+            cache[int(cycle)] = None
             continue
 
+        x, yp, y = result
+
         # Set up an array per cycle segment that stores the cycle and half-cycle index
-        cycle_index = df_cycle["full cycle"].max()
-        cycle_index_array = np.full(len(x), int(cycle_index), dtype=int)
-        half_cycle_index_array = np.full(len(x), int(cycle), dtype=int)
-
-        differential_df = pd.concat(
-            [
-                differential_df,
-                pd.DataFrame(
-                    {
-                        x_label: x,
-                        y_label: y,
-                        yp_label: yp,
-                        "full cycle": cycle_index_array,
-                        "half cycle": half_cycle_index_array,
-                    }
-                ),
-            ]
+        cycle_index = full_cycle_values[half_cycle_indices[cycle]].max()
+        cache[int(cycle)] = pd.DataFrame(
+            {
+                x_label: x,
+                y_label: y,
+                yp_label: yp,
+                "full cycle": np.full(len(x), int(cycle_index), dtype=int),
+                "half cycle": np.full(len(x), int(cycle), dtype=int),
+            }
         )
 
-    return differential_df
+    differential_dfs = [cache[int(cycle)] for cycle in half_cycles if cache[int(cycle)] is not None]
+    if not differential_dfs:
+        return pd.DataFrame()
+
+    return pd.concat(differential_dfs)
+
+
+def build_cycle_index(df: pd.DataFrame) -> Optional[pd.DataFrame]:
+    """Build an index of the row ranges occupied by each half cycle in the input dataframe,
+    so that cycles can later be selected by slicing rather than by filtering the whole frame.
+
+    Args:
+        df: The input dataframe, which must have the columns "half cycle" and "full cycle".
+
+    Returns:
+        A dataframe indexed by half cycle, with the columns "full cycle", "start" and "stop"
+        containing the corresponding full cycle and the (positional) row range of each half cycle,
+        or `None` if the half cycles do not occupy contiguous row ranges.
+
+    """
+    half_cycles = df["half cycle"].to_numpy()
+    if len(half_cycles) == 0 or pd.isna(half_cycles).any():
+        return None
+
+    # Find the rows at which the half cycle index changes
+    boundaries = np.flatnonzero(half_cycles[1:] != half_cycles[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    stops = np.concatenate((boundaries, [len(half_cycles)]))
+
+    cycle_index = pd.DataFrame(
+        {
+            "half cycle": half_cycles[starts].astype(int),
+            "full cycle": df["full cycle"].to_numpy()[stops - 1].astype(int),
+            "start": starts,
+            "stop": stops,
+        }
+    )
+
+    # If any half cycle appears in more than one run of rows, slicing is not possible
+    if cycle_index["half cycle"].duplicated().any():
+        return None
+
+    return cycle_index.set_index("half cycle").sort_index()
 
 
 def filter_df_by_cycle_index(
-    df: pd.DataFrame, cycle_list: Optional[List[int]] = None
+    df: pd.DataFrame,
+    cycle_list: Optional[List[int]] = None,
+    cycle_index: Optional[pd.DataFrame] = None,
 ) -> pd.DataFrame:
     """Filters the input dataframe by the chosen rows in the `cycle_list`.
     If `half_cycle` is a column in the df, it will be used for filtering,
@@ -138,6 +424,9 @@ def filter_df_by_cycle_index(
     Args:
         df: The input dataframe to filter. Must have the column "half cycle".
         cycle_list: The provided list of cycle indices to keep.
+        cycle_index: An optional precomputed index of half cycle row ranges for `df`,
+            as returned by `build_cycle_index`. If provided, the selected half cycles
+            will be sliced directly from `df`, rather than filtering every row.
 
     Returns:
         A dataframe with all the data for the selected cycles.
@@ -158,16 +447,39 @@ def filter_df_by_cycle_index(
             cycle_list[0] = df["cycle index"].max()
         return df[df["cycle index"].isin(i for i in cycle_list)]
 
+    if cycle_index is not None:
+        min_half_cycle, max_half_cycle = cycle_index.index.min(), cycle_index.index.max()
+    else:
+        min_half_cycle, max_half_cycle = df["half cycle"].min(), df["half cycle"].max()
+
     try:
-        if len(cycle_list) == 1 and 2 * max(cycle_list) > df["half cycle"].max():
-            cycle_list[0] = df["half cycle"].max() // 2
+        if len(cycle_list) == 1 and 2 * max(cycle_list) > max_half_cycle:
+            cycle_list[0] = max_half_cycle // 2
         half_cycles = [
             i
             for item in cycle_list
-            for i in [max((2 * int(item)) - 1, df["half cycle"].min()), 2 * int(item)]
+            for i in [max((2 * int(item)) - 1, min_half_cycle), 2 * int(item)]
         ]
     except ValueError as exc:
         raise ValueError(
             f"Unable to parse `cycle_list` as integers: {cycle_list}. Error: {exc}"
         ) from exc
-    return df[df["half cycle"].isin(half_cycles)]
+
+    if cycle_index is None:
+        return df[df["half cycle"].isin(half_cycles)]
+
+    ranges = cycle_index.loc[cycle_index.index.intersection(half_cycles), ["start", "stop"]]
+
+    # Merge adjacent row ranges so that contiguous selections are returned as a single slice
+    slices: List[List[int]] = []
+    for start, stop in ranges.sort_values("start").itertuples(index=False):
+        if slices and slices[-1][1] == start:
+            slices[-1][1] = stop
+        else:
+            slices.append([start, stop])
+
+    if not slices:
+        return df.iloc[0:0]
+    if len(slices) == 1:
+        return df.iloc[slices[0][0] : slices[0][1]]
+    return pd.concat(df.iloc[start:stop] for start, stop in slices)
@@ -0,0 +1,295 @@
+import multiprocessing
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+
+import bokeh.embed
+import numpy as np
+import pandas as pd
+from bokeh.layouts import column, gridplot
+from bokeh.models import ColumnDataSource, HoverTool
+from bokeh.palettes import viridis
+from bokeh.plotting import figure
+
+from pydatalab.blocks.base import DataBlock
+from pydatalab.bokeh_plots import COLORS, DATALAB_BOKEH_GRID_THEME, TOOLS
+from pydatalab.file_utils import get_file_info_by_id, get_file_info_by_ids
+from pydatalab.logger import LOGGER
+from pydatalab.mongo import flask_mongo
+from pydatalab.permissions import get_default_permissions
+
+from .utils import EIS_CIRCUITS, downsample_spectrum, evaluate_fit, fit_eis_file, load_eis_file
+
+_EIS_POOL: Optional[ProcessPoolExecutor] = None
+"""A lazily-created pool of worker processes used to load and fit spectra in parallel."""
+
+
+def _fit_eis_file_or_error(
+    args: Tuple[str, Optional[str]],
+) -> Tuple[Optional[pd.DataFrame], Optional[Dict[str, Any]], Optional[str]]:
+    """Worker function for loading and fitting spectra in parallel, which returns any
+    error message rather than raising, so that it can be attributed to the correct file.
+    A spectrum that can be parsed but not fitted is still returned.
+
+    """
+    location, circuit = args
+    try:
+        eis = load_eis_file(location, reload=False)
+    except Exception as exc:
+        return None, None, f"could not be parsed: {exc}"
+
+    try:
+        return fit_eis_file(location, circuit, reload=False) + (None,)
+    except Exception as exc:
+        return eis, None, f"could not be fitted with {circuit}: {exc}"
+
+
+class EISBlock(DataBlock):
+    """A data block for plotting and fitting electrochemical impedance spectra.
+
+    The block plots the selected file, or otherwise every EIS file attached to its item
+    (or to the items in its collection), as Nyquist and Bode plots. Each spectrum can be
+    fitted with an equivalent circuit from `EIS_CIRCUITS`, with the fitted parameters
+    returned as a table. Parsed spectra and fits are cached alongside each file, and
+    many files are loaded and fitted in a pool of worker processes.
+
+    """
+
+    accepted_file_extensions = (".txt",)
+    blocktype = "eis"
+    name = "EIS"
+    description = "This block can plot and fit electrochemical impedance spectroscopy (EIS) data from Ivium .txt files"
+
+    defaults = {"circuit": "R-RQ"}
+    _supports_collections = True
+
+    max_points_per_spectrum: int = 200
+    """The maximum number of measured points to plot per spectrum."""
+
+    fit_curve_points: int = 100
+    """The number of points at which to plot each fitted circuit."""
+
+    @property
+    def plot_functions(self):
+        return (self.generate_eis_plot,)
+
+    def _get_file_infos(self) -> List[Dict[str, Any]]:
+        """Returns the file selected in the block, or otherwise all EIS files attached to the
+        block's item, or to the items in the block's collection.
+
+        """
+        if self.data.get("file_id"):
+            file_infos = [get_file_info_by_id(self.data["file_id"], update_if_live=True)]
+        else:
+            if self.data.get("collection_id") is not None:
+                collection = flask_mongo.db.collections.find_one(
+                    {
+                        "collection_id": self.data["collection_id"],
+                        **get_default_permissions(user_only=False),
+                    },
+                    {"_id": 1},
+                )
+                items = []
+                if collection is not None:
+                    items = flask_mongo.db.items.find(
+                        {
+                            "relationships.type": "collections",
+                            "relationships.immutable_id": collection["_id"],
+                            **get_default_permissions(user_only=False),
+                        },
+                        {"file_ObjectIds": 1},
+                    )
+            else:
+                item = self.get_item_context()
+                items = [item] if item else []
+
+            file_ids = [file_id for item in items for file_id in item.get("file_ObjectIds") or []]
+            file_infos = get_file_info_by_ids(file_ids, update_if_live=False)
+
+        accepted = []
+        for file_info in file_infos:
+            ext = os.path.splitext(file_info["location"].split("/")[-1])[-1].lower()
+            if ext in self.accepted_file_extensions:
+                accepted.append(file_info)
+            elif self.data.get("file_id"):
+                LOGGER.warning(
+                    "Unsupported file extension (must be one of %s, not %s)",
+                    self.accepted_file_extensions,
+                    ext,
+                )
+        return accepted
+
+    @classmethod
+    def load_spectra(
+        cls, file_infos: List[Dict[str, Any]], circuit: Optional[str] = None, parallel: bool = False
+    ) -> List[Tuple[Optional[pd.DataFrame], Optional[Dict[str, Any]], Optional[str]]]:
+        """Load (and optionally fit) several spectra at once, reusing any cached parses and
+        fits of each file, and optionally processing the remaining files in a shared pool
+        of worker processes.
+
+        Parameters:
+            file_infos: The file documents to load.
+            circuit: The name of the circuit in `EIS_CIRCUITS` to fit, if any.
+            parallel: Whether to process the files in parallel.
+
+        Returns:
+            A list of (spectrum, fit, error) tuples, in the same order as `file_infos`.
+
+        """
+        global _EIS_POOL
+
+        jobs = [(str(f["location"]), circuit) for f in file_infos]
+        if parallel and len(jobs) > 1:
+            if _EIS_POOL is None:
+                _EIS_POOL = ProcessPoolExecutor(
+                    max_workers=max(min(os.cpu_count() or 1, 8), 1),
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            try:
+                return list(_EIS_POOL.map(_fit_eis_file_or_error, jobs))
+            except BrokenProcessPool as exc:
+                LOGGER.warning("EIS worker pool failed, processing serially: %s", exc)
+                _EIS_POOL = None
+        return [_fit_eis_file_or_error(job) for job in jobs]
+
+    def generate_eis_plot(self):
+        self.data["available_circuits"] = {
+            name: circuit.description for name, circuit in EIS_CIRCUITS.items()
+        }
+        self.data["fit_results"] = None
+
+        circuit = self.data.get("circuit") or None
+        if circuit is not None and circuit not in EIS_CIRCUITS:
+            warnings.warn(f"Unknown circuit {circuit!r}, must be one of {list(EIS_CIRCUITS)}")
+            circuit = None
+
+        file_infos = self._get_file_infos()
+        if not file_infos:
+            LOGGER.warning("No EIS files found for block %s", self.block_id)
+            return
+
+        in_collection = self.data.get("collection_id") is not None
+        spectra: Dict[str, pd.DataFrame] = {}
+        fits: Dict[str, Dict[str, Any]] = {}
+        rows = []
+        for file_info, (eis, fit, error) in zip(
+            file_infos, self.load_spectra(file_infos, circuit, parallel=len(file_infos) > 4)
+        ):
+            if eis is None and not self.data.get("file_id"):
+                # other .txt files may be attached, so only report those selected explicitly
+                LOGGER.debug("Skipping %s, which %s", file_info["name"], error)
+                continue
+            if error is not None:
+                warnings.warn(f"{file_info['name']!r} {error}")
+            if eis is None:
+                continue
+
+            label = file_info["name"]
+            if in_collection and file_info.get("item_ids"):
+                label = f"{file_info['item_ids'][0]}: {label}"
+            spectra[label] = eis
+            if fit is not None:
+                fits[label] = fit
+                rows.append(
+                    {
+                        "file_id": str(file_info["immutable_id"]),
+                        "label": label,
+                        "values": list(fit["parameters"].values()),
+                        "chi_squared": fit["chi_squared"],
+                        "success": fit["success"],
+                    }
+                )
+
+        if circuit is not None:
+            self.data["fit_results"] = {
+                "circuit": circuit,
+                "parameters": list(EIS_CIRCUITS[circuit].parameters),
+                "rows": rows,
+            }
+
+        if spectra:
+            self.data["bokeh_plot_data"] = self._plot_spectra(spectra, fits)
+
+    @classmethod
+    def _plot_spectra(
+        cls, spectra: Dict[str, pd.DataFrame], fits: Dict[str, Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """Plots the downsampled spectra (and any fits) as a Nyquist plot above
+        Bode plots of the modulus and phase of the impedance.
+
+        """
+        nyquist = figure(
+            x_axis_label="Re(Z) [Ω]",
+            y_axis_label="-Im(Z) [Ω]",
+            match_aspect=True,
+            aspect_ratio=1.5,
+            tools=TOOLS,
+        )
+        modulus = figure(
+            x_axis_label="Frequency [Hz]",
+            y_axis_label="|Z| [Ω]",
+            x_axis_type="log",
+            y_axis_type="log",
+            tools=TOOLS,
+        )
+        phase = figure(
+            x_axis_label="Frequency [Hz]",
+            y_axis_label="-Phase [°]",
+            x_axis_type="log",
+            x_range=modulus.x_range,
+            tools=TOOLS,
+        )
+
+        colors = COLORS if len(spectra) <= len(COLORS) else viridis(len(spectra))
+        show_legend = len(spectra) <= 10
+        renderers = []
+        for ind, (label, eis) in enumerate(spectra.items()):
+            color = colors[ind % len(colors)]
+            eis = downsample_spectrum(eis, cls.max_points_per_spectrum)
+            source = ColumnDataSource(
+                {
+                    **{
+                        column: eis[column].to_numpy()
+                        for column in (
+                            "Frequency [Hz]",
+                            "Re(Z) [Ω]",
+                            "-Im(Z) [Ω]",
+                            "|Z| [Ω]",
+                            "-Phase [°]",
+                        )
+                    },
+                    "label": [label] * len(eis),
+                }
+            )
+            legend = {"legend_label": label} if show_legend else {}
+            renderers.append(
+                nyquist.scatter("Re(Z) [Ω]", "-Im(Z) [Ω]", source=source, color=color, **legend)
+            )
+            modulus.scatter("Frequency [Hz]", "|Z| [Ω]", source=source, color=color)
+            phase.scatter("Frequency [Hz]", "-Phase [°]", source=source, color=color)
+
+            if label in fits:
+                frequency, z = evaluate_fit(
+                    fits[label], eis["Frequency [Hz]"].to_numpy(), cls.fit_curve_points
+                )
+                nyquist.line(z.real, -z.imag, color=color, **legend)
+                modulus.line(frequency, np.abs(z), color=color)
+                phase.line(frequency, -np.degrees(np.angle(z)), color=color)
+
+        nyquist.add_tools(
+            HoverTool(
+                renderers=renderers,
+                tooltips=[("", "@label"), ("Frequency [Hz]", "@{Frequency [Hz]}")],
+            )
+        )
+        if show_legend:
+            nyquist.legend.click_policy = "hide"
+
+        layout = column(
+            nyquist,
+            gridplot([[modulus, phase]], sizing_mode="scale_width", toolbar_location="below"),
+            sizing_mode="scale_width",
+        )
+        return bokeh.embed.json_item(layout, theme=DATALAB_BOKEH_GRID_THEME)
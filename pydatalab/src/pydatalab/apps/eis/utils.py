@@ -0,0 +1,268 @@
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+
+__all__ = (
+    "EquivalentCircuit",
+    "EIS_CIRCUITS",
+    "parse_ivium_eis_txt",
+    "load_eis_file",
+    "fit_circuit",
+    "fit_eis_file",
+    "evaluate_fit",
+    "downsample_spectrum",
+)
+
+
+def parse_ivium_eis_txt(filename: Path) -> pd.DataFrame:
+    """Parses an Ivium EIS text export, adding the modulus and phase of the impedance."""
+    eis = pd.read_csv(filename, sep="\t")
+    eis["Z2 /ohm"] *= -1
+    eis.rename(
+        {"Z1 /ohm": "Re(Z) [Ω]", "Z2 /ohm": "-Im(Z) [Ω]", "freq. /Hz": "Frequency [Hz]"},
+        inplace=True,
+        axis="columns",
+    )
+    eis["|Z| [Ω]"] = np.hypot(eis["Re(Z) [Ω]"], eis["-Im(Z) [Ω]"])
+    eis["-Phase [°]"] = np.degrees(np.arctan2(eis["-Im(Z) [Ω]"], eis["Re(Z) [Ω]"]))
+    return eis
+
+
+def _get_eis_cache_location(location: Union[str, Path], cache_name: str) -> Path:
+    """Returns the location of the named cache for the given EIS file."""
+    return Path(location).with_suffix(f".{cache_name}.pkl")
+
+
+def _is_fresh(cache_location: Path, location: Union[str, Path]) -> bool:
+    return cache_location.exists() and cache_location.stat().st_mtime >= os.path.getmtime(location)
+
+
+def load_eis_file(location: Union[str, Path], reload: bool = True) -> pd.DataFrame:
+    """Parses an EIS file, caching the parsed dataframe alongside the file.
+
+    Parameters:
+        location: The location of the file to parse.
+        reload: Whether to reparse the file, or use the cached version, if it is
+            newer than the file itself.
+
+    Returns:
+        The parsed spectrum, as returned by `parse_ivium_eis_txt`.
+
+    """
+    cache_location = _get_eis_cache_location(location, "EIS_PARSED")
+    if not reload and _is_fresh(cache_location, location):
+        return pd.read_pickle(cache_location)
+
+    eis = parse_ivium_eis_txt(Path(location))
+    if not reload:
+        eis.to_pickle(cache_location)
+    return eis
+
+
+class EquivalentCircuit:
+    """An equivalent circuit model whose impedance can be fitted to a spectrum.
+
+    All parameters are positive and are fitted on a logarithmic scale; any
+    `exponents` (e.g., of constant phase elements) are additionally bounded above by 1.
+
+    Parameters:
+        name: A short name for the circuit in series/parallel notation (e.g., "R-RC").
+        description: A human-readable description of the circuit.
+        parameters: The names (with units) of the circuit parameters.
+        impedance: A callable that takes an array of parameter values and an array of
+            angular frequencies, and returns the complex impedance at each frequency.
+        initial_guess: A callable that takes the angular frequencies and measured complex
+            impedance, and returns an initial array of parameter values.
+        exponents: The names of any parameters that are exponents in [0, 1].
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        parameters: Sequence[str],
+        impedance: Callable[[np.ndarray, np.ndarray], np.ndarray],
+        initial_guess: Callable[[np.ndarray, np.ndarray], np.ndarray],
+        exponents: Sequence[str] = (),
+    ):
+        self.name = name
+        self.description = description
+        self.parameters = tuple(parameters)
+        self.impedance = impedance
+        self.initial_guess = initial_guess
+        self.exponents = tuple(exponents)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(name={self.name!r}, parameters={self.parameters!r})"
+
+
+def _guess_rc(omega: np.ndarray, z: np.ndarray) -> Tuple[float, float, float]:
+    """Estimates the series resistance, and the resistance and capacitance of the
+    first semicircle, from the high-frequency intercept and the peak of -Im(Z).
+
+    """
+    span = max(np.ptp(z.real), 1e-12)
+    r0 = max(z.real[np.argmax(omega)], 1e-3 * span)
+    r1 = max(z.real.max() - r0, 1e-3 * span)
+    omega_peak = omega[np.argmax(-z.imag)]
+    return r0, r1, 1 / (omega_peak * r1)
+
+
+def _randles_guess(omega: np.ndarray, z: np.ndarray) -> np.ndarray:
+    r0, r1, c1 = _guess_rc(omega, z)
+    low = np.argmin(omega)
+    sigma = max(-z.imag[low], 1e-3 * r1) * np.sqrt(omega[low])
+    return np.array([r0, r1, c1, 0.9, sigma])
+
+
+EIS_CIRCUITS: Dict[str, EquivalentCircuit] = {
+    circuit.name: circuit
+    for circuit in (
+        EquivalentCircuit(
+            "R-RC",
+            "Series resistance and a parallel RC element",
+            ["R0 [Ω]", "R1 [Ω]", "C1 [F]"],
+            lambda p, w: p[0] + p[1] / (1 + 1j * w * p[1] * p[2]),
+            lambda w, z: np.array(_guess_rc(w, z)),
+        ),
+        EquivalentCircuit(
+            "R-RQ",
+            "Series resistance and a parallel resistance and constant phase element",
+            ["R0 [Ω]", "R1 [Ω]", "Q1 [F s^(n-1)]", "n1"],
+            lambda p, w: p[0] + p[1] / (1 + p[1] * p[2] * (1j * w) ** p[3]),
+            lambda w, z: np.array([*_guess_rc(w, z), 0.9]),
+            exponents=["n1"],
+        ),
+        EquivalentCircuit(
+            "R-RQ-W",
+            "Randles circuit with a constant phase element and semi-infinite Warburg diffusion",
+            ["R0 [Ω]", "R1 [Ω]", "Q1 [F s^(n-1)]", "n1", "σ [Ω s^-1/2]"],
+            lambda p, w: p[0]
+            + 1 / (1 / (p[1] + p[4] * (1 - 1j) / np.sqrt(w)) + p[2] * (1j * w) ** p[3]),
+            _randles_guess,
+            exponents=["n1"],
+        ),
+    )
+}
+"""The library of equivalent circuits that can be fitted to EIS spectra."""
+
+
+def fit_circuit(
+    frequency: np.ndarray, z: np.ndarray, circuit: Union[str, EquivalentCircuit]
+) -> Dict[str, Any]:
+    """Fits an equivalent circuit to an impedance spectrum by least squares, with the
+    residuals weighted by the modulus of the measured impedance.
+
+    Parameters:
+        frequency: The measured frequencies in Hz.
+        z: The complex measured impedance, with the usual sign convention (i.e., Im(Z) < 0
+            for capacitive behaviour).
+        circuit: The circuit (or name of a circuit in `EIS_CIRCUITS`) to fit.
+
+    Returns:
+        A dictionary of the `circuit` name, the fitted `parameters`, the reduced
+        `chi_squared` of the fit and whether the optimizer reported `success`.
+
+    """
+    if isinstance(circuit, str):
+        circuit = EIS_CIRCUITS[circuit]
+
+    frequency = np.asarray(frequency, dtype=np.float64)
+    z = np.asarray(z, dtype=np.complex128)
+    mask = np.isfinite(frequency) & np.isfinite(z) & (frequency > 0)
+    omega, z = 2 * np.pi * frequency[mask], z[mask]
+    if len(omega) <= len(circuit.parameters) // 2:
+        raise RuntimeError(f"Too few points ({len(omega)}) to fit {circuit.name}")
+
+    weights = 1 / np.maximum(np.abs(z), np.finfo(np.float64).tiny)
+
+    def residuals(log_params: np.ndarray) -> np.ndarray:
+        diff = (circuit.impedance(np.exp(log_params), omega) - z) * weights
+        return np.concatenate([diff.real, diff.imag])
+
+    upper = np.array([0.0 if name in circuit.exponents else np.inf for name in circuit.parameters])
+    initial = np.minimum(np.log(circuit.initial_guess(omega, z)), upper - 1e-6)
+    result = least_squares(residuals, initial, bounds=(-np.inf, upper), method="trf")
+
+    degrees_of_freedom = max(2 * len(omega) - len(initial), 1)
+    return {
+        "circuit": circuit.name,
+        "parameters": dict(zip(circuit.parameters, np.exp(result.x).tolist())),
+        "chi_squared": float(2 * result.cost / degrees_of_freedom),
+        "success": bool(result.success),
+    }
+
+
+def fit_eis_file(
+    location: Union[str, Path], circuit: Optional[str], reload: bool = True
+) -> Tuple[pd.DataFrame, Optional[Dict[str, Any]]]:
+    """Loads an EIS file and fits the given circuit to it, caching the fit results
+    for each circuit alongside the file.
+
+    Parameters:
+        location: The location of the file.
+        circuit: The name of the circuit in `EIS_CIRCUITS` to fit, or `None` to skip fitting.
+        reload: Whether to reparse and refit the file, or use the cached results, if they
+            are newer than the file itself.
+
+    Returns:
+        The parsed spectrum and the fit results (see `fit_circuit`), if requested.
+
+    """
+    eis = load_eis_file(location, reload=reload)
+    if circuit is None:
+        return eis, None
+
+    cache_location = _get_eis_cache_location(location, "EIS_FIT")
+    fits: Dict[str, Dict[str, Any]] = {}
+    if not reload and _is_fresh(cache_location, location):
+        fits = pd.read_pickle(cache_location)
+
+    if circuit not in fits:
+        fits[circuit] = fit_circuit(
+            eis["Frequency [Hz]"].to_numpy(),
+            eis["Re(Z) [Ω]"].to_numpy() - 1j * eis["-Im(Z) [Ω]"].to_numpy(),
+            circuit,
+        )
+        if not reload:
+            pd.to_pickle(fits, cache_location)
+
+    return eis, fits[circuit]
+
+
+def evaluate_fit(
+    fit: Dict[str, Any], frequency: np.ndarray, num_points: int = 100
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Evaluates a fitted circuit on a log-spaced grid spanning the measured frequencies.
+
+    Parameters:
+        fit: The fit results, as returned by `fit_circuit`.
+        frequency: The measured frequencies in Hz.
+        num_points: The number of points in the grid.
+
+    Returns:
+        The grid of frequencies in Hz and the complex impedance of the circuit.
+
+    """
+    frequency = np.asarray(frequency, dtype=np.float64)
+    frequency = frequency[np.isfinite(frequency) & (frequency > 0)]
+    grid = np.logspace(np.log10(frequency.min()), np.log10(frequency.max()), num_points)
+    circuit = EIS_CIRCUITS[fit["circuit"]]
+    params = np.array([fit["parameters"][name] for name in circuit.parameters])
+    return grid, circuit.impedance(params, 2 * np.pi * grid)
+
+
+def downsample_spectrum(eis: pd.DataFrame, max_points: int) -> pd.DataFrame:
+    """Reduces a spectrum to at most `max_points` points by keeping evenly spaced points
+    of the frequency sweep, which are evenly spaced in log-frequency for the usual sweeps.
+
+    """
+    if len(eis) <= max_points:
+        return eis
+    indices = np.unique(np.linspace(0, len(eis) - 1, max_points).round().astype(int))
+    return eis.iloc[indices].reset_index(drop=True)
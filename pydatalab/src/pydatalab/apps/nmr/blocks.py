@@ -1,15 +1,16 @@
 import os
-import zipfile
 
 import bokeh.embed
+import numpy as np
 import pandas as pd
 
 from pydatalab.blocks.base import DataBlock
-from pydatalab.bokeh_plots import DATALAB_BOKEH_THEME, selectable_axes_plot
+from pydatalab.bokeh_plots import DATALAB_BOKEH_THEME, selectable_axes_plot, stacked_image_plot
 from pydatalab.file_utils import get_file_info_by_id
 from pydatalab.logger import LOGGER
+from pydatalab.utils import decode_array, encode_array, minmax_downsample_indices
 
-from .utils import read_bruker_1d
+from .utils import list_bruker_processes, read_bruker_zip, read_bruker_zip_2d
 
 
 class NMRBlock(DataBlock):
@@ -21,14 +22,24 @@ class NMRBlock(DataBlock):
     defaults = {"process number": 1}
     _supports_collections = False
 
+    max_preview_points: int = 8192
+    """The maximum number of points of the spectrum to store in the block and plot."""
+
+    max_image_shape: tuple[int, int] = (512, 1024)
+    """The maximum (F1, F2) shape of the image used to plot 2D spectra."""
+
     @property
     def plot_functions(self):
         return (self.generate_nmr_plot,)
 
-    def read_bruker_nmr_data(self):
+    def read_bruker_nmr_data(self) -> str | None:
+        """Read the selected process of the attached Bruker project into the block data,
+        returning the location of the zip file if successful.
+
+        """
         if "file_id" not in self.data:
             LOGGER.warning("NMRPlot.read_bruker_nmr_data(): No file set in the DataBlock")
-            return
+            return None
 
         zip_file_info = get_file_info_by_id(self.data["file_id"], update_if_live=True)
         filename = zip_file_info["name"]
@@ -38,34 +49,24 @@ class NMRBlock(DataBlock):
             LOGGER.warning(
                 "NMRBlock.read_bruker_nmr_data(): Unsupported file extension (must be .zip)"
             )
-            return
-
-        # unzip:
-        directory_location = zip_file_info["location"] + ".extracted"
-        LOGGER.debug(f"Directory location is: {directory_location}")
-        with zipfile.ZipFile(zip_file_info["location"], "r") as zip_ref:
-            zip_ref.extractall(directory_location)
+            return None
 
-        extracted_directory_name = os.path.join(directory_location, name)
-        available_processes = os.listdir(os.path.join(extracted_directory_name, "pdata"))
+        available_processes = list_bruker_processes(zip_file_info["location"])
 
         if self.data.get("selected_process") not in available_processes:
             self.data["selected_process"] = available_processes[0]
 
         try:
-            df, a_dic, topspin_title, processed_data_shape = read_bruker_1d(
-                os.path.join(directory_location, name),
-                process_number=self.data["selected_process"],
-                verbose=False,
+            df, a_dic, topspin_title, processed_data_shape = read_bruker_zip(
+                zip_file_info["location"], process_number=self.data["selected_process"]
             )
         except Exception as error:
             LOGGER.critical(f"Unable to parse {name} as Bruker project. {error}")
-            return
-
-        serialized_df = df.to_dict() if (df is not None) else None
+            return None
 
-        # all data sorted in a fairly raw way
-        self.data["processed_data"] = serialized_df
+        # all data sorted in a fairly raw way; the full-resolution spectrum remains
+        # in the parse cache, and only a compact, downsampled preview is stored here
+        self.data["processed_data"] = self._encode_spectrum(df) if df is not None else None
         self.data["acquisition_parameters"] = a_dic["acqus"]
         self.data["processing_parameters"] = a_dic["procs"]
         self.data["pulse_program"] = a_dic["pprog"]
@@ -84,14 +85,54 @@ class NMRBlock(DataBlock):
         self.data["pulse_program_name"] = a_dic["acqus"]["PULPROG"]
         self.data["topspin_title"] = topspin_title
 
+        return zip_file_info["location"]
+
+    @classmethod
+    def _encode_spectrum(self, df: pd.DataFrame) -> dict:
+        """Encode the spectrum as float32 base64 arrays, downsampled to at most
+        `max_preview_points` points by keeping the extrema of the intensity.
+
+        """
+        indices = minmax_downsample_indices(
+            df["intensity"].to_numpy(), self.max_preview_points // 2
+        )
+        return {
+            "num_points": len(df),
+            "columns": {
+                column: encode_array(df[column].to_numpy()[indices], "float32")
+                for column in ("ppm", "hz", "intensity")
+            },
+        }
+
+    @staticmethod
+    def _decode_spectrum(processed_data: dict, nscans: int | None = None) -> pd.DataFrame:
+        """Reconstruct the spectrum dataframe from the stored processed data."""
+        if "columns" not in processed_data:
+            # blocks saved before the spectrum was stored in binary form
+            return pd.DataFrame(processed_data)
+
+        df = pd.DataFrame(
+            {
+                column: decode_array(encoded).astype(np.float64)
+                for column, encoded in processed_data["columns"].items()
+            }
+        )
+        df["intensity_per_scan"] = df["intensity"] / (nscans or 1)
+        return df
+
     def generate_nmr_plot(self):
-        # currently calls every time plotting happens, but it should only happen if the file was updated
-        self.read_bruker_nmr_data()
+        # extraction and parsing are cached against the contents of the zip file,
+        # so this is cheap unless the file was updated
+        location = self.read_bruker_nmr_data()
+        if location is not None and len(self.data.get("processed_data_shape") or ()) == 2:
+            self.data["bokeh_plot_data"] = self._plot_2d_spectrum(location)
+            return
+
         if "processed_data" not in self.data or not self.data["processed_data"]:
             self.data["bokeh_plot_data"] = None
             return
 
-        df = pd.DataFrame(self.data["processed_data"])
+        df = self._decode_spectrum(self.data["processed_data"], self.data.get("nscans"))
         df["normalized intensity"] = df.intensity / df.intensity.max()
 
         bokeh_layout = selectable_axes_plot(
@@ -112,3 +153,55 @@ class NMRBlock(DataBlock):
         self.data["bokeh_plot_data"] = bokeh.embed.json_item(
             bokeh_layout, theme=DATALAB_BOKEH_THEME
         )
+
+    def _plot_2d_spectrum(self, location: str) -> dict | None:
+        """Plot a 2D spectrum as a downsampled image overlaid with contours.
+        Only the plot is stored in the block; the image itself stays in the parse cache.
+
+        """
+        try:
+            spectrum = read_bruker_zip_2d(
+                location,
+                process_number=self.data["selected_process"],
+                max_shape=self.max_image_shape,
+            )
+        except Exception as error:
+            LOGGER.critical(f"Unable to read 2D data from {location}. {error}")
+            return None
+
+        # the image glyph requires ascending axes, which are then flipped per NMR convention
+        image = spectrum["image"]
+        f1_ppm, f2_ppm = spectrum["f1_ppm"], spectrum["f2_ppm"]
+        if len(f1_ppm) > 1 and f1_ppm[0] > f1_ppm[-1]:
+            f1_ppm, image = f1_ppm[::-1], image[::-1]
+        if len(f2_ppm) > 1 and f2_ppm[0] > f2_ppm[-1]:
+            f2_ppm, image = f2_ppm[::-1], image[:, ::-1]
+
+        f1_label, f2_label = spectrum["labels"]
+        p = stacked_image_plot(
+            f2_ppm,
+            np.ascontiguousarray(image),
+            x_label=f"{f2_label} δ (ppm)",
+            y_label=f"{f1_label} δ (ppm)",
+            y=f1_ppm,
+            palette="Greys256",
+        )
+        for axis_range in (p.x_range, p.y_range):
+            axis_range.start, axis_range.end = axis_range.end, axis_range.start
+
+        # each level is drawn as a single NaN-separated float32 line, which bokeh
+        # serializes as a binary array rather than nested lists
+        separator = np.full((1, 2), np.nan)
+        for level, lines in zip(spectrum["levels"], spectrum["contours"]):
+            if lines:
+                points = np.concatenate(
+                    [part for line in lines for part in (line, separator)][:-1]
+                ).astype(np.float32)
+                p.line(
+                    x=points[:, 0],
+                    y=points[:, 1],
+                    line_color="#1f77b4" if level > 0 else "#d62728",
+                    line_width=1,
+                )
+
+        return bokeh.embed.json_item(p, theme=DATALAB_BOKEH_THEME)
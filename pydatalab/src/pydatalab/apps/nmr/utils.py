@@ -1,12 +1,16 @@
+import hashlib
 import itertools
+import json
 import os
 import re
+import zipfile
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 import nmrglue as ng
 import numpy as np
 import pandas as pd
+from contourpy import contour_generator
 from scipy import integrate
 
 ######################################################################################
@@ -14,6 +18,167 @@ from scipy import integrate
 ######################################################################################
 
 
+def _is_bruker_2d(processed_data_dir: Path) -> bool:
+    return (processed_data_dir / "2rr").exists()
+
+
+def _read_bruker_2d_parameters(
+    data_dir: Path, processed_data_dir: Path
+) -> tuple[dict, tuple[int, int]]:
+    """Reads the acquisition, processing and pulse program parameters of a 2D
+    experiment, without reading any binary data.
+
+    Returns:
+        The parameter dictionary (in the same layout as `nmrglue.bruker.read`)
+        and the shape of the processed data.
+
+    """
+    a_dic = ng.bruker.read_acqus_file(str(data_dir))
+    a_dic.update(ng.bruker.read_procs_file(str(processed_data_dir)))
+    pprog = data_dir / "pulseprogram"
+    if pprog.exists():
+        a_dic["pprog"] = ng.bruker.read_pprog(str(pprog))
+    shape, _ = ng.bruker.guess_shape_and_submatrix_shape(a_dic)
+    return a_dic, (int(shape[0]), int(shape[1]))
+
+
+def _memmap_bruker_2d(
+    filename: str | Path,
+    shape: tuple[int, int],
+    submatrix_shape: tuple[int, int],
+    big: bool = False,
+    isfloat: bool = False,
+) -> np.ndarray:
+    """Memory-maps a Bruker 2D processed data file (e.g., `2rr`) as an array of submatrices
+    with shape (submatrix rows, submatrix columns, *submatrix_shape)`, without reading it.
+
+    """
+    dtype = np.dtype(("f8" if isfloat else "i4")).newbyteorder(">" if big else "<")
+    tiles_per_dim = tuple(int(i // j) for i, j in zip(shape, submatrix_shape))
+    return np.memmap(filename, dtype=dtype, mode="r", shape=tiles_per_dim + tuple(submatrix_shape))
+
+
+def _iter_bruker_2d_rows(tiles: np.ndarray):
+    """Yields the rows of a tiled 2D array, one row of submatrices at a time."""
+    num_tile_cols, tile_rows, tile_cols = tiles.shape[1:]
+    for tile_row in tiles:
+        yield np.asarray(tile_row).transpose(1, 0, 2).reshape(tile_rows, num_tile_cols * tile_cols)
+
+
+def _block_extreme(block: np.ndarray, col_factor: int) -> np.ndarray:
+    """Reduces all rows of `block` to a single row, and each `col_factor` columns to one,
+    keeping the value with the largest magnitude (so that both positive and negative
+    peaks survive).
+
+    """
+    pad = (-block.shape[1]) % col_factor
+    if pad:
+        block = np.pad(block, ((0, 0), (0, pad)))
+    rows, cols = block.shape
+    block = block.reshape(rows, cols // col_factor, col_factor).transpose(1, 0, 2)
+    block = block.reshape(cols // col_factor, rows * col_factor)
+    return np.take_along_axis(block, np.abs(block).argmax(axis=1)[:, None], axis=1)[:, 0]
+
+
+def _downsample_axis(values: np.ndarray, factor: int) -> np.ndarray:
+    starts = np.arange(0, len(values), factor)
+    return np.add.reduceat(values, starts) / np.diff(np.append(starts, len(values)))
+
+
+def _contour_levels(image: np.ndarray, num_levels: int = 12, factor: float = 1.4) -> np.ndarray:
+    """Chooses geometric contour levels (TopSpin-style) starting a few noise
+    standard deviations above zero, with mirrored negative levels if needed.
+
+    """
+    finite = image[np.isfinite(image)]
+    if not finite.size:
+        return np.array([])
+    noise = float(1.4826 * np.median(np.abs(finite - np.median(finite))))
+    maximum = float(np.max(np.abs(finite)))
+    base = max(5 * noise, 0.02 * maximum)
+    if base <= 0:
+        return np.array([])
+    positive: np.ndarray = base * factor ** np.arange(num_levels)
+    positive = positive[positive <= maximum]
+    negative: np.ndarray = -positive[positive <= -float(np.min(finite))]
+    return np.concatenate((negative[::-1], positive))
+
+
+def read_bruker_2d(
+    data: Path,
+    process_number: int | str = 1,
+    max_shape: tuple[int, int] = (512, 1024),
+    num_levels: int = 12,
+) -> dict:
+    """Read a 2D Bruker processed spectrum (`2rr`) via a memory map, and reduce it
+    to a downsampled image and a set of contour lines suitable for plotting.
+
+    The data is streamed one row of submatrices at a time, so the full matrix is
+    never loaded into memory. Each pixel of the image keeps the value with the largest
+    magnitude in its block, so peaks are not lost by downsampling.
+
+    Parameters:
+        data: The directory of the full bruker data file.
+        process_number: The process number of the processed data to read.
+        max_shape: The maximum (F1, F2) shape of the downsampled image.
+        num_levels: The maximum number of positive contour levels.
+
+    Returns:
+        A dictionary with the ppm scales (`f1_ppm`, `f2_ppm`) and `labels` of each
+        dimension, the downsampled `image`, the contour `levels`, the contour lines at
+        each level (`contours`, as lists of (N, 2) arrays of (F2, F1) ppm), the
+        full `shape` and the parameter dictionary `dic`.
+
+    """
+    data_dir = Path(data)
+    processed_data_dir = data_dir / "pdata" / str(process_number)
+    dic, shape = _read_bruker_2d_parameters(data_dir, processed_data_dir)
+    _, submatrix_shape = ng.bruker.guess_shape_and_submatrix_shape(dic)
+
+    tiles = _memmap_bruker_2d(
+        processed_data_dir / "2rr",
+        shape,
+        submatrix_shape,
+        big=dic["procs"].get("BYTORDP") == 1,
+        isfloat=dic["procs"].get("DTYPP") == 2,
+    )
+
+    row_factor = max(-(-shape[0] // max_shape[0]), 1)
+    col_factor = max(-(-shape[1] // max_shape[1]), 1)
+
+    image_rows = []
+    pending = np.empty((0, shape[1]))
+    for rows in _iter_bruker_2d_rows(tiles):
+        pending = np.concatenate((pending, ng.bruker.scale_pdata(dic, rows)))
+        while len(pending) >= row_factor:
+            image_rows.append(_block_extreme(pending[:row_factor], col_factor))
+            pending = pending[row_factor:]
+    if len(pending):
+        image_rows.append(_block_extreme(pending, col_factor))
+    image = np.vstack(image_rows).astype(np.float32)
+
+    udic = ng.bruker.guess_udic(dic, np.broadcast_to(np.float32(0), shape))
+    f1_ppm = _downsample_axis(ng.fileiobase.uc_from_udic(udic, 0).ppm_scale(), row_factor)
+    f2_ppm = _downsample_axis(ng.fileiobase.uc_from_udic(udic, 1).ppm_scale(), col_factor)
+
+    levels = _contour_levels(image, num_levels=num_levels)
+    contours = []
+    if len(f1_ppm) > 1 and len(f2_ppm) > 1:
+        generator = contour_generator(x=f2_ppm, y=f1_ppm, z=image)
+        contours = [generator.lines(level) for level in levels]
+
+    return {
+        "f1_ppm": f1_ppm,
+        "f2_ppm": f2_ppm,
+        "labels": (udic[0]["label"], udic[1]["label"]),
+        "image": image,
+        "levels": levels,
+        "contours": contours,
+        "shape": tuple(shape),
+        "dic": dic,
+    }
+
+
 def read_bruker_1d(
     data: Path | pd.DataFrame,
     process_number: int = 1,
@@ -49,15 +214,21 @@ def read_bruker_1d(
 
     processed_data_dir = data_dir / "pdata" / str(process_number)
 
-    a_dic, a_data = ng.fileio.bruker.read(str(data_dir))  # aquisition_data
-    p_dic, p_data = ng.fileio.bruker.read_pdata(str(processed_data_dir))  # processing data
-
     try:
         with open(os.path.join(processed_data_dir, "title")) as f:
             topspin_title = f.read()
     except FileNotFoundError:
         topspin_title = None
 
+    if _is_bruker_2d(processed_data_dir):
+        # avoid loading the (potentially large) raw and processed data;
+        # see `read_bruker_2d` for reading these files
+        a_dic, p_shape = _read_bruker_2d_parameters(data_dir, processed_data_dir)
+        return None, a_dic, topspin_title, p_shape
+
+    a_dic, a_data = ng.fileio.bruker.read(str(data_dir))  # aquisition_data
+    p_dic, p_data = ng.fileio.bruker.read_pdata(str(processed_data_dir))  # processing data
+
     if len(p_data.shape) > 1:
         return None, a_dic, topspin_title, p_data.shape
 
@@ -96,6 +267,156 @@ def read_bruker_1d(
     return df, a_dic, topspin_title, a_data.shape
 
 
+BRUKER_ACQUISITION_FILES = re.compile(r"^(acqus|acqu\d+s|acqu|acqu\d+|pulseprogram|fid|ser)$")
+"""The top-level files of a Bruker experiment directory that are read by `nmrglue`."""
+
+
+def _find_bruker_root(names: list[str]) -> str:
+    """Returns the path prefix (with trailing slash, or empty) of the experiment
+    directory within a zip archive, i.e., the directory containing `acqus`.
+
+    """
+    candidates = [
+        name[: -len("acqus")]
+        for name in names
+        if (name == "acqus" or name.endswith("/acqus")) and not name.startswith("__MACOSX")
+    ]
+    if not candidates:
+        raise RuntimeError("No Bruker experiment (acqus file) found in zip archive")
+    return min(candidates, key=len)
+
+
+def list_bruker_processes(zip_location: str | Path) -> list[str]:
+    """Lists the processing numbers (i.e., the subdirectories of `pdata`) available in
+    a zipped Bruker experiment, without extracting it.
+
+    """
+    with zipfile.ZipFile(zip_location, "r") as zip_ref:
+        names = zip_ref.namelist()
+    root = _find_bruker_root(names)
+    processes = {
+        name[len(root) :].split("/")[1]
+        for name in names
+        if name.startswith(f"{root}pdata/") and len(name[len(root) :].split("/")) > 2
+    }
+    return sorted(
+        (p for p in processes if p), key=lambda p: (not p.isdigit(), int(p) if p.isdigit() else p)
+    )
+
+
+def extract_bruker_zip(
+    zip_location: str | Path, process_number: int | str, directory: str | Path
+) -> tuple[Path, str]:
+    """Extracts only the members of a zipped Bruker experiment that are required to read
+    the given processing number (the acquisition parameters, pulse program and raw data,
+    plus the `pdata/<process_number>` directory), skipping any that were already extracted
+    with the same CRC.
+
+    Parameters:
+        zip_location: The zip archive to extract.
+        process_number: The processing number to extract.
+        directory: The directory to extract into.
+
+    Returns:
+        The path to the extracted experiment directory and a key derived from
+        the CRCs of the required members.
+
+    """
+    directory = Path(directory)
+    manifest_location = directory / ".extraction_manifest.json"
+    manifest: dict[str, int] = {}
+    if manifest_location.exists():
+        try:
+            manifest = json.loads(manifest_location.read_text())
+        except json.JSONDecodeError:
+            manifest = {}
+
+    with zipfile.ZipFile(zip_location, "r") as zip_ref:
+        infos = zip_ref.infolist()
+        root = _find_bruker_root([info.filename for info in infos])
+        required_prefixes = (f"{root}pdata/{process_number}/", f"{root}pdata/1/procs")
+        # 2D processed data is read without the raw data, which can be very large
+        skipped = (
+            {"fid", "ser"}
+            if any(info.filename == f"{root}pdata/{process_number}/2rr" for info in infos)
+            else set()
+        )
+        required = [
+            info
+            for info in infos
+            if not info.is_dir()
+            and (
+                info.filename.startswith(required_prefixes)
+                or (
+                    "/" not in info.filename[len(root) :]
+                    and BRUKER_ACQUISITION_FILES.match(info.filename[len(root) :])
+                    and info.filename[len(root) :] not in skipped
+                )
+            )
+        ]
+        for info in required:
+            if manifest.get(info.filename) != info.CRC or not (directory / info.filename).exists():
+                zip_ref.extract(info, directory)
+                manifest[info.filename] = info.CRC
+
+    manifest_location.write_text(json.dumps(manifest))
+
+    crc_key = hashlib.sha1(
+        json.dumps(sorted((info.filename, info.CRC) for info in required)).encode()
+    ).hexdigest()
+    return directory / root, crc_key
+
+
+def _read_bruker_zip_cached(
+    zip_location: str | Path, process_number: int | str, reader, cache_name: str, **kwargs
+):
+    directory = Path(f"{zip_location}.extracted")
+    data_dir, crc_key = extract_bruker_zip(zip_location, process_number, directory)
+    key = (crc_key, sorted(kwargs.items()))
+
+    parsed_location = directory / f".{cache_name}-{process_number}.pkl"
+    if parsed_location.exists():
+        cached = pd.read_pickle(parsed_location)
+        if cached.get("key") == key:
+            return cached["result"]
+
+    result = reader(data_dir, process_number=process_number, **kwargs)
+    pd.to_pickle({"key": key, "result": result}, parsed_location)
+    return result
+
+
+def read_bruker_zip(
+    zip_location: str | Path, process_number: int | str = 1
+) -> tuple[pd.DataFrame | None, dict, str | None, tuple[int, ...]]:
+    """Reads a zipped Bruker experiment with `read_bruker_1d`, extracting only the
+    required members into `<zip_location>.extracted` and caching the parsed result
+    against the CRCs of those members.
+
+    Parameters:
+        zip_location: The zip archive to read.
+        process_number: The processing number to read.
+
+    Returns:
+        The outputs of `read_bruker_1d`.
+
+    """
+    return _read_bruker_zip_cached(zip_location, process_number, read_bruker_1d, "parsed")
+
+
+def read_bruker_zip_2d(
+    zip_location: str | Path,
+    process_number: int | str = 1,
+    max_shape: tuple[int, int] = (512, 1024),
+) -> dict:
+    """Reads a zipped 2D Bruker experiment with `read_bruker_2d`, with the same
+    selective extraction and caching as `read_bruker_zip`.
+
+    """
+    return _read_bruker_zip_cached(
+        zip_location, process_number, read_bruker_2d, "parsed-2d", max_shape=tuple(max_shape)
+    )
+
+
 def read_topspin_txt(filename, sample_mass_mg=None, nscans=None):
     MAX_HEADER_LINES = 10
     LEFTRIGHT_REGEX = r"# LEFT = (-?\d+\.\d+) ppm. RIGHT = (-?\d+\.\d+) ppm\."
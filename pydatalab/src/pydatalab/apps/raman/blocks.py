@@ -1,22 +1,115 @@
 import os
 from pathlib import Path
+from typing import Dict, Hashable, Iterable
 
 import bokeh
 import numpy as np
 import pandas as pd
+from bokeh.layouts import column
 from pybaselines import Baseline
-from rsciio.renishaw import file_reader
 from scipy.signal import medfilt
 
 from pydatalab.blocks.base import DataBlock
-from pydatalab.bokeh_plots import DATALAB_BOKEH_THEME, selectable_axes_plot
+from pydatalab.bokeh_plots import DATALAB_BOKEH_THEME, selectable_axes_plot, stacked_image_plot
+from pydatalab.derived_columns import (
+    DerivedColumnRegistry,
+    DerivedColumns,
+    get_file_revision_key,
+)
 from pydatalab.file_utils import get_file_info_by_id
 
+from .utils import get_map_spectrum, integrate_map_band, load_wdf, read_raman_txt, read_wdf
+
+POLYFIT_DEG = 15
+MEDFILT_KERNEL_SIZE = 101
+
+
+def _subtract_baseline(
+    df: pd.DataFrame, baseline: np.ndarray, name: str, baseline_label: str
+) -> Dict[str, np.ndarray]:
+    subtracted = df["normalized intensity"] - baseline
+    return {
+        f"intensity - {name}": subtracted / np.max(subtracted),
+        baseline_label: baseline / np.max(subtracted),
+    }
+
+
+def _polyfit_baseline(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    polyfit_deg = POLYFIT_DEG
+    baseline = np.poly1d(np.polyfit(df["wavenumber"], df["normalized intensity"], deg=polyfit_deg))(
+        df["wavenumber"]
+    )
+    return _subtract_baseline(
+        df, baseline, "polyfit baseline", f"baseline (`numpy.polyfit`, {polyfit_deg=})"
+    )
+
+
+def _median_baseline(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    kernel_size = MEDFILT_KERNEL_SIZE
+    baseline = medfilt(df["normalized intensity"], kernel_size=kernel_size)
+    return _subtract_baseline(
+        df, baseline, "median baseline", f"baseline (`scipy.signal.medfilt`, {kernel_size=})"
+    )
+
+
+def _morphological_baseline(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    # a value which worked for my data, not sure how universally good it will be
+    half_window = round(0.03 * df.shape[0])
+    baseline_fitter = Baseline(x_data=df["wavenumber"])
+    baseline = baseline_fitter.mor(df["normalized intensity"], half_window=half_window)[0]
+    return _subtract_baseline(
+        df,
+        baseline,
+        "morphological baseline",
+        f"baseline (`pybaselines.Baseline.mor`, {half_window=})",
+    )
+
+
+RAMAN_DERIVED_COLUMNS = DerivedColumnRegistry(
+    DerivedColumns(
+        "normalized intensity",
+        ["normalized intensity"],
+        lambda df: {"normalized intensity": df["intensity"] / np.max(df["intensity"])},
+    ),
+    DerivedColumns(
+        "sqrt(intensity)",
+        ["sqrt(intensity)"],
+        lambda df: {"sqrt(intensity)": np.sqrt(df["intensity"])},
+    ),
+    DerivedColumns(
+        "log(intensity)",
+        ["log(intensity)"],
+        lambda df: {"log(intensity)": np.log10(df["intensity"])},
+    ),
+    DerivedColumns(
+        "median baseline",
+        [
+            "intensity - median baseline",
+            f"baseline (`scipy.signal.medfilt`, kernel_size={MEDFILT_KERNEL_SIZE})",
+        ],
+        _median_baseline,
+        expensive=True,
+    ),
+    DerivedColumns(
+        "polyfit baseline",
+        ["intensity - polyfit baseline", f"baseline (`numpy.polyfit`, polyfit_deg={POLYFIT_DEG})"],
+        _polyfit_baseline,
+        expensive=True,
+    ),
+    DerivedColumns(
+        "morphological baseline",
+        ["intensity - morphological baseline"],
+        _morphological_baseline,
+        expensive=True,
+    ),
+)
+"""The derived columns available for Raman spectra; baselines are only computed on request."""
+
 
 class RamanBlock(DataBlock):
     blocktype = "raman"
     name = "Raman spectroscopy"
-    description = "Visualize 1D Raman spectroscopy data."
+    description = "Visualize 1D Raman spectroscopy data and 2D Raman maps."
     accepted_file_extensions = (".txt", ".wdf")
 
     @property
@@ -24,7 +117,31 @@ class RamanBlock(DataBlock):
         return (self.generate_raman_plot,)
 
     @classmethod
-    def load(self, location: str | Path) -> tuple[pd.DataFrame, dict, list[str]]:
+    def load(
+        self,
+        location: str | Path,
+        derived_columns: Iterable[str] | None = None,
+        cache_key: Hashable | None = None,
+        pixel: tuple[int, int] | None = None,
+        reload: bool = True,
+    ) -> tuple[pd.DataFrame, dict, list[str]]:
+        """Load a Raman spectrum from file, with any requested derived columns.
+
+        Parameters:
+            location: The location of the file to read.
+            derived_columns: Names of any expensive transforms (e.g., baselines) in
+                `RAMAN_DERIVED_COLUMNS` to compute in addition to the cheap defaults.
+            cache_key: A key identifying the file revision, under which derived columns
+                will be memoized (defaults to the location and modification time of the file).
+            pixel: For Raman maps, the (x, y) indices of the spectrum to load,
+                otherwise the mean spectrum of the map is loaded.
+            reload: Whether to reparse .wdf files, or use the cached version,
+                if it is newer than the file itself.
+
+        Returns:
+            The dataframe, any metadata and the list of columns that can be plotted on the y-axis.
+
+        """
         if not isinstance(location, str):
             location = str(location)
         ext = os.path.splitext(location)[-1].lower()
@@ -32,130 +149,88 @@ class RamanBlock(DataBlock):
         vendor = None
         metadata: dict = {}
         if ext == ".txt":
-            try:
-                header = []
-                with open(location, encoding="cp1252") as f:
-                    for line in f:
-                        if line.startswith("#"):
-                            header.append(line)
-                    if "#Wave" in header[0] and "#Intensity" in header[0]:
-                        vendor = "renishaw"
-                    else:
-                        metadata = {
-                            key: value for key, value in [line.split("=") for line in header]
-                        }
-                        if (
-                            metadata.get("#AxisType[0]") == "Intens\n"
-                            and metadata.get("#AxisType[1]") == "Spectr\n"
-                        ):
-                            vendor = "labspec"
-                if vendor == "renishaw":
-                    df = pd.DataFrame(np.loadtxt(location), columns=["wavenumber", "intensity"])
-                elif vendor == "labspec":
-                    df = pd.DataFrame(
-                        np.loadtxt(location, encoding="cp1252"), columns=["wavenumber", "intensity"]
-                    )
-                    metadata = {}
-            except IndexError:
-                pass
+            df, _, vendor = read_raman_txt(location)
         elif ext == ".wdf":
             vendor = "renishaw"
-            df, metadata = self.make_wdf_df(location)
-        if not vendor:
+            df, metadata = self.make_wdf_df(location, pixel=pixel, reload=reload)
+        if not vendor or df is None:
             raise Exception(
                 "Could not detect Raman data vendor -- this file type is not supported by this block."
             )
 
-        df["sqrt(intensity)"] = np.sqrt(df["intensity"])
-        df["log(intensity)"] = np.log10(df["intensity"])
-        df["normalized intensity"] = df["intensity"] / np.max(df["intensity"])
-        polyfit_deg = 15
-        polyfit_baseline = np.poly1d(
-            np.polyfit(df["wavenumber"], df["normalized intensity"], deg=polyfit_deg)
-        )(df["wavenumber"])
-        df["intensity - polyfit baseline"] = df["normalized intensity"] - polyfit_baseline
-        df[f"baseline (`numpy.polyfit`, {polyfit_deg=})"] = polyfit_baseline / np.max(
-            df["intensity - polyfit baseline"]
-        )
-        df["intensity - polyfit baseline"] /= np.max(df["intensity - polyfit baseline"])
-
-        kernel_size = 101
-        median_baseline = medfilt(df["normalized intensity"], kernel_size=kernel_size)
-        df["intensity - median baseline"] = df["normalized intensity"] - median_baseline
-        df[f"baseline (`scipy.signal.medfilt`, {kernel_size=})"] = median_baseline / np.max(
-            df["intensity - median baseline"]
-        )
-        df["intensity - median baseline"] /= np.max(df["intensity - median baseline"])
-
-        # baseline calculation I used in my data
-        half_window = round(
-            0.03 * df.shape[0]
-        )  # a value which worked for my data, not sure how universally good it will be
-        baseline_fitter = Baseline(x_data=df["wavenumber"])
-        morphological_baseline = baseline_fitter.mor(
-            df["normalized intensity"], half_window=half_window
-        )[0]
-        df["intensity - morphological baseline"] = (
-            df["normalized intensity"] - morphological_baseline
+        if cache_key is None:
+            cache_key = (location, os.path.getmtime(location))
+        if pixel is not None:
+            cache_key = (cache_key, tuple(pixel))
+        derived_columns = RAMAN_DERIVED_COLUMNS.add_columns(
+            df, requested=derived_columns, cache_key=cache_key
         )
-        df[f"baseline (`pybaselines.Baseline.mor`, {half_window=})"] = (
-            morphological_baseline / np.max(df["intensity - morphological baseline"])
-        )
-        df["intensity - morphological baseline"] /= np.max(df["intensity - morphological baseline"])
         df.index.name = location.split("/")[-1]
 
-        y_options = [
-            "normalized intensity",
-            "intensity",
-            "sqrt(intensity)",
-            "log(intensity)",
-            "intensity - median baseline",
-            f"baseline (`scipy.signal.medfilt`, {kernel_size=})",
-            "intensity - polyfit baseline",
-            f"baseline (`numpy.polyfit`, {polyfit_deg=})",
-            "intensity - morphological baseline",
-            f"baseline (`pybaselines.Baseline.mor`, {half_window=})",
+        y_options = ["normalized intensity", "intensity"] + [
+            c for c in derived_columns if c != "normalized intensity"
         ]
         return df, metadata, y_options
 
     @classmethod
-    def make_wdf_df(self, location: Path | str) -> pd.DataFrame:
-        """Read the .wdf file with RosettaSciIO and try to extract
-        1D Raman spectra.
+    def make_wdf_df(
+        self, location: Path | str, pixel: tuple[int, int] | None = None, reload: bool = True
+    ) -> tuple[pd.DataFrame, dict]:
+        """Read the .wdf file with RosettaSciIO and extract a 1D Raman spectrum.
 
         Parameters:
             location: The location of the file to read.
+            pixel: For Raman maps, the (x, y) indices of the spectrum to extract,
+                otherwise the mean spectrum of the map is returned.
+            reload: Whether to reparse the file, or use the cache from `load_wdf`.
 
         Returns:
-            A dataframe with the appropriate columns.
+            A dataframe with the appropriate columns, and the file metadata.
 
         """
+        wdf = read_wdf(location) if reload else load_wdf(location)
+        intensity = wdf["intensity"]
+        if pixel is not None and wdf["cube"] is not None:
+            intensity = get_map_spectrum(wdf, *pixel)
+        df = pd.DataFrame({"wavenumber": wdf["wavenumber"], "intensity": intensity})
+        return df, wdf["metadata"]
 
-        try:
-            raman_data = file_reader(location)
-        except Exception as e:
-            raise RuntimeError(f"Could not read file with RosettaSciIO. Error: {e}")
+    def _generate_map_image(self, location: str):
+        """Plot the band-integrated intensity of each pixel of a Raman map, and record
+        the map dimensions for the UI.
 
-        if len(raman_data[0]["axes"]) == 1:
-            pass
-        elif len(raman_data[0]["axes"]) == 3:
-            raise RuntimeError("This block does not support 2D Raman yet.")
-        else:
-            raise RuntimeError("Data is not compatible 1D or 2D Raman data.")
-
-        intensity = raman_data[0]["data"]
-        wavenumber_size = raman_data[0]["axes"][0]["size"]
-        wavenumber_offset = raman_data[0]["axes"][0]["offset"]
-        wavenumber_scale = raman_data[0]["axes"][0]["scale"]
-        wavenumbers = np.array(
-            [wavenumber_offset + i * wavenumber_scale for i in range(wavenumber_size)]
+        """
+        wdf = load_wdf(location)
+        if wdf["cube"] is None:
+            return None
+
+        self.data["map_shape"] = list(wdf["cube"].shape[:2])
+        self.data["wavenumber_limits"] = [
+            float(np.min(wdf["wavenumber"])),
+            float(np.max(wdf["wavenumber"])),
+        ]
+        band = self.data.get("map_band")
+        image = integrate_map_band(wdf, band=band)
+
+        pixel = self.data.get("map_pixel")
+        if pixel is not None:
+            pixel = [int(np.clip(p, 0, n - 1)) for p, n in zip(pixel, image.shape)]
+            self.data["map_pixel"] = pixel
+
+        return stacked_image_plot(
+            wdf["x"],
+            image.T,
+            x_label="x",
+            y_label="y",
+            z_label="band intensity" if band else "intensity",
+            y=wdf["y"],
         )
-        df = pd.DataFrame({"wavenumber": wavenumbers, "intensity": intensity})
-        return df, raman_data[0]["metadata"]
 
     def generate_raman_plot(self):
         file_info = None
         pattern_dfs = None
+        derived_columns = self.data.get("derived_columns") or []
+        self.data["available_derived_columns"] = RAMAN_DERIVED_COLUMNS.optional_names
 
         if "file_id" not in self.data:
             return None
@@ -169,7 +244,16 @@ class RamanBlock(DataBlock):
                     self.accepted_file_extensions,
                     ext,
                 )
-            pattern_dfs, _, y_options = self.load(file_info["location"])
+            map_image = None
+            if ext == ".wdf":
+                map_image = self._generate_map_image(file_info["location"])
+            pattern_dfs, _, y_options = self.load(
+                file_info["location"],
+                derived_columns=derived_columns,
+                cache_key=get_file_revision_key(file_info),
+                pixel=self.data.get("map_pixel") if map_image is not None else None,
+                reload=False,
+            )
             pattern_dfs = [pattern_dfs]
 
         if pattern_dfs:
@@ -181,5 +265,7 @@ class RamanBlock(DataBlock):
                 plot_points=True,
                 point_size=3,
             )
+            if map_image is not None:
+                p = column(map_image, p, sizing_mode="scale_width")
 
             self.data["bokeh_plot_data"] = bokeh.embed.json_item(p, theme=DATALAB_BOKEH_THEME)
@@ -0,0 +1,244 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from rsciio.renishaw import file_reader
+from scipy.integrate import trapezoid
+
+
+def read_raman_txt(location: str | Path) -> tuple[pd.DataFrame | None, dict, str | None]:
+    """Reads a Renishaw or LabSpec text export in a single pass: the leading `#` header
+    lines are read for vendor detection, then the numeric data is parsed from the same
+    file handle with the pandas C engine.
+
+    Parameters:
+        location: The location of the file to read.
+
+    Returns:
+        The dataframe of wavenumber and intensity, the header metadata and the
+        detected vendor, or `None, {}, None` if the vendor could not be detected.
+
+    """
+    with open(location, "rb") as f:
+        header = []
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line.startswith(b"#"):
+                break
+            header.append(line.decode("cp1252").rstrip("\r\n"))
+
+        vendor = None
+        metadata: dict = {}
+        if header and "#Wave" in header[0] and "#Intensity" in header[0]:
+            vendor = "renishaw"
+        elif header:
+            metadata = {
+                key: value.strip()
+                for key, value in (line.split("=", 1) for line in header if "=" in line)
+            }
+            if (
+                metadata.get("#AxisType[0]") == "Intens"
+                and metadata.get("#AxisType[1]") == "Spectr"
+            ):
+                vendor = "labspec"
+
+        if vendor is None:
+            return None, {}, None
+
+        f.seek(position)
+        df = pd.read_csv(
+            f,
+            sep=r"\s+",
+            comment="#",
+            header=None,
+            names=["wavenumber", "intensity"],
+            dtype=np.float64,
+            encoding="cp1252",
+            engine="c",
+        )
+
+    return df, metadata, vendor
+
+
+def _axis_values(axis: dict) -> np.ndarray:
+    """Returns the values of a RosettaSciIO axis, which is either given
+    explicitly or as a uniform offset and scale.
+
+    """
+    if "axis" in axis:
+        return np.asarray(axis["axis"], dtype=np.float64)
+    return axis.get("offset", 0.0) + np.arange(axis["size"]) * axis.get("scale", 1.0)
+
+
+def _get_wdf_cache_location(location: str | Path, suffix: str) -> Path:
+    return Path(location).with_suffix(f".RAMAN_WDF.{suffix}")
+
+
+def _split_wdf_axes(axes: list[dict]) -> tuple[dict, list[dict | None]]:
+    """Splits RosettaSciIO axes into the spectral axis and the (x, y) navigation axes,
+    where missing navigation axes are `None`.
+
+    """
+    signal_axes = [axis for axis in axes if not axis.get("navigate", False)]
+    if len(signal_axes) != 1 or len(axes) > 3:
+        raise RuntimeError("Data is not compatible 1D or 2D Raman data.")
+
+    navigation_axes = [axis for axis in axes if axis.get("navigate", False)]
+    by_name = {str(axis.get("name", "")).lower(): axis for axis in navigation_axes}
+    if set(by_name) == {"x", "y"}:
+        navigation_axes = [by_name["x"], by_name["y"]]
+    else:
+        # hyperspy-style axes are in array order, i.e., (y, x)
+        navigation_axes = navigation_axes[::-1]
+    return signal_axes[0], [*navigation_axes, *[None] * (2 - len(navigation_axes))]
+
+
+def read_wdf(location: str | Path) -> dict:
+    """Reads a Renishaw .wdf file with RosettaSciIO, without caching.
+
+    Parameters:
+        location: The location of the .wdf file.
+
+    Raises:
+        RuntimeError: if the file cannot be read or does not contain 1D or 2D Raman data.
+
+    Returns:
+        A dictionary as returned by `load_wdf`, but with any map `cube` held in memory.
+
+    """
+    try:
+        raman_data = file_reader(str(location))
+    except Exception as e:
+        raise RuntimeError(f"Could not read file with RosettaSciIO. Error: {e}")
+
+    signal_axis, (x_axis, y_axis) = _split_wdf_axes(raman_data[0]["axes"])
+    data = np.asarray(raman_data[0]["data"])
+    wdf = {
+        "wavenumber": _axis_values(signal_axis),
+        "metadata": raman_data[0]["metadata"],
+        "x": None,
+        "y": None,
+        "cube": None,
+        "intensity": data,
+    }
+
+    if x_axis is not None:
+        order = [
+            axis["index_in_array"] for axis in (x_axis, y_axis, signal_axis) if axis is not None
+        ]
+        cube = data.transpose(order)
+        if y_axis is None:
+            cube = cube[:, np.newaxis, :]
+        wdf["x"] = _axis_values(x_axis)
+        wdf["y"] = _axis_values(y_axis) if y_axis is not None else np.zeros(1)
+        wdf["cube"] = cube
+        wdf["intensity"] = cube.mean(axis=(0, 1), dtype=np.float64)
+
+    return wdf
+
+
+def build_wdf_cache(location: str | Path, chunk_rows: int = 64) -> dict:
+    """Reads a Renishaw .wdf file and caches it alongside the file.
+
+    Single spectra are cached as columns in a pickled index. Maps are written to a
+    memory-mapped float32 `.npy` cube of shape (x, y, wavenumber), with their axes and
+    mean spectrum stored in the index.
+
+    Parameters:
+        location: The location of the .wdf file.
+        chunk_rows: The number of x-rows of a map to write at a time.
+
+    Returns:
+        The cache index, as returned by `load_wdf`.
+
+    """
+    wdf = read_wdf(location)
+    cube = wdf.pop("cube")
+    if cube is not None:
+        cached = np.lib.format.open_memmap(
+            _get_wdf_cache_location(location, "npy"), mode="w+", dtype=np.float32, shape=cube.shape
+        )
+        for start in range(0, cube.shape[0], chunk_rows):
+            cached[start : start + chunk_rows] = cube[start : start + chunk_rows]
+        cached.flush()
+
+    pd.to_pickle(wdf, _get_wdf_cache_location(location, "pkl"))
+    return wdf
+
+
+def load_wdf(location: str | Path, reload: bool = False) -> dict:
+    """Loads a Renishaw .wdf file from its cache, (re)building the cache if it does not
+    exist or is older than the file.
+
+    Parameters:
+        location: The location of the .wdf file.
+        reload: Whether to rebuild the cache even if a fresh one exists.
+
+    Returns:
+        A dictionary with the `wavenumber` axis, the `intensity` of the spectrum (or the
+        mean spectrum for maps) and the RosettaSciIO `metadata`. For maps, the `x` and `y`
+        axes are also given, and the read-only memory-mapped (x, y, wavenumber) `cube`;
+        these are `None` for single spectra.
+
+    """
+    index_location = _get_wdf_cache_location(location, "pkl")
+    if (
+        not reload
+        and index_location.exists()
+        and index_location.stat().st_mtime >= os.path.getmtime(location)
+    ):
+        index = pd.read_pickle(index_location)
+    else:
+        index = build_wdf_cache(location)
+
+    index["cube"] = None
+    if index["x"] is not None:
+        index["cube"] = np.load(_get_wdf_cache_location(location, "npy"), mmap_mode="r")
+    return index
+
+
+def get_map_spectrum(wdf: dict, x_index: int, y_index: int) -> np.ndarray:
+    """Returns the spectrum at a single pixel of a Raman map loaded with `load_wdf`."""
+    return np.asarray(wdf["cube"][x_index, y_index], dtype=np.float64)
+
+
+def integrate_map_band(
+    wdf: dict, band: tuple[float, float] | None = None, chunk_rows: int = 64
+) -> np.ndarray:
+    """Integrates the intensity of each pixel of a Raman map over a wavenumber band,
+    reading a bounded number of rows of the memory-mapped cube at a time.
+
+    Parameters:
+        wdf: The map, as loaded with `load_wdf`.
+        band: The (lower, upper) wavenumbers to integrate between, defaulting to the full range.
+        chunk_rows: The number of x-rows to process at a time.
+
+    Raises:
+        RuntimeError: if the band does not overlap with the spectral range.
+
+    Returns:
+        An (x, y) image of the integrated intensities.
+
+    """
+    wavenumber = wdf["wavenumber"]
+    mask = np.ones(len(wavenumber), dtype=bool)
+    if band is not None:
+        lower, upper = sorted(band)
+        mask = (wavenumber >= lower) & (wavenumber <= upper)
+    selected = np.flatnonzero(mask)
+    if not len(selected):
+        raise RuntimeError(f"No data in the wavenumber band {band}")
+
+    # the selected points are contiguous, so can be sliced without copying the cube
+    window = slice(selected[0], selected[-1] + 1)
+    cube = wdf["cube"]
+    image = np.empty(cube.shape[:2])
+    for start in range(0, cube.shape[0], chunk_rows):
+        rows = np.asarray(cube[start : start + chunk_rows, :, window], dtype=np.float64)
+        if len(selected) > 1:
+            image[start : start + chunk_rows] = np.abs(trapezoid(rows, wavenumber[window], axis=-1))
+        else:
+            image[start : start + chunk_rows] = rows[..., 0]
+    return image
@@ -1,12 +1,19 @@
 import os
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 import bokeh
+import numpy as np
+import pandas as pd
 from bokeh.layouts import gridplot
 from scipy.signal import savgol_filter
 
-from pydatalab.apps.tga.parsers import parse_mt_mass_spec_ascii
+from pydatalab.apps.tga.parsers import (
+    parse_mt_mass_spec_ascii,
+    read_mt_mass_spec_window,
+    species_dataframes,
+    stream_mt_mass_spec_ascii,
+)
 from pydatalab.blocks.base import DataBlock
 from pydatalab.bokeh_plots import DATALAB_BOKEH_GRID_THEME, selectable_axes_plot
 from pydatalab.file_utils import get_file_info_by_id
@@ -19,6 +26,13 @@ class MassSpecBlock(DataBlock):
     description = "Read and visualize mass spectrometry data as a grid plot per channel"
     accepted_file_extensions = (".asc", ".txt")
 
+    streaming_threshold_bytes: int = 50 * 1024 * 1024
+    """Files larger than this are parsed in chunks into a downsampled preview
+    and a full-resolution cache, rather than loaded into memory."""
+
+    max_plot_points: int = 4096
+    """The approximate maximum number of points to plot per species for streamed files."""
+
     @property
     def plot_functions(self):
         return (self.generate_ms_plot,)
@@ -42,40 +56,147 @@ class MassSpecBlock(DataBlock):
                 )
                 return
 
-            ms_data = parse_mt_mass_spec_ascii(Path(file_info["location"]))
+            location = file_info["location"]
+            if os.path.getsize(location) > self.streaming_threshold_bytes:
+                ms_data = self.load_streamed(location, max_points=self.max_plot_points)
+            else:
+                ms_data = self.load(location, reload=False)
+
+            if ms_data and self.data.get("time_range"):
+                ms_data = self._select_time_range(ms_data, self.data["time_range"])
+
             if ms_data:
                 self.data["bokeh_plot_data"] = self._plot_ms_data(ms_data)
 
+    @classmethod
+    def load_streamed(cls, location: str | Path, max_points: int = 4096) -> dict:
+        """Parse a large mass spec file in chunks, or reuse its cache if it is newer than
+        the file, returning a downsampled preview of each species.
+
+        The full-resolution data is kept in a columnar cache in `<location>.MS_CACHE`,
+        which can be queried with `read_mt_mass_spec_window`.
+
+        """
+        cache_dir = Path(location).with_suffix(".MS_CACHE")
+        index_location = cache_dir / "index.pkl"
+        if index_location.exists() and index_location.stat().st_mtime >= os.path.getmtime(location):
+            return {**pd.read_pickle(index_location), "cache_dir": cache_dir}
+        return stream_mt_mass_spec_ascii(Path(location), cache_dir, max_points=max_points)
+
+    def _select_time_range(
+        self, ms_data: dict, time_range: tuple[float | None, float | None]
+    ) -> dict:
+        """Restrict the data of each species to the given (start, end) relative times,
+        where either may be `None` to leave that side open, reading full-resolution data
+        from the cache for streamed files.
+
+        """
+        start, end = time_range
+        start = -np.inf if start is None else float(start)
+        end = np.inf if end is None else float(end)
+        start, end = sorted((start, end))
+        if "cache_dir" in ms_data:
+            data = {
+                species: read_mt_mass_spec_window(
+                    ms_data["cache_dir"],
+                    species,
+                    time_range=(start, end),
+                    max_points=self.max_plot_points,
+                )
+                for species in ms_data["data"]
+            }
+            return {**ms_data, "data": data, "data_keys": ms_data["file_data_keys"]}
+
+        data = {}
+        for species, df in ms_data["data"].items():
+            time = df["Time Relative [s]"]
+            data[species] = df[(time >= start) & (time <= end)]
+        return {**ms_data, "data": data}
+
+    @classmethod
+    def load(cls, location: str | Path, reload: bool = True) -> dict:
+        """Parse a mass spec file, caching the parsed arrays alongside the file.
+
+        Parameters:
+            location: The location of the file to parse.
+            reload: Whether to reparse the file, or use the cached version, if it is
+                newer than the file itself.
+
+        Returns:
+            The parsed results, as returned by `parse_mt_mass_spec_ascii`.
+
+        """
+        cache_location = Path(location).with_suffix(".MS_PARSED.pkl")
+        if (
+            not reload
+            and cache_location.exists()
+            and cache_location.stat().st_mtime >= os.path.getmtime(location)
+        ):
+            ms_data = pd.read_pickle(cache_location)
+            ms_data["data"] = species_dataframes(ms_data)
+            return ms_data
+
+        ms_data = parse_mt_mass_spec_ascii(Path(location))
+        if not reload:
+            # the per-species dataframes are views, so only the wide array is cached
+            pd.to_pickle({k: v for k, v in ms_data.items() if k != "data"}, cache_location)
+        return ms_data
+
+    @staticmethod
+    def _smooth_channels(ms_data: dict, data_key: str) -> Dict[str, np.ndarray]:
+        """Apply a Savitzky-Golay filter to the `data_key` channel of every species,
+        filtering all channels with the same number of points in one call.
+
+        """
+        lengths: Dict[int, List[str]] = {}
+        for species, df in ms_data["data"].items():
+            lengths.setdefault(len(df), []).append(species)
+
+        smoothed = {}
+        for length, group in lengths.items():
+            if length == 0:
+                continue
+            channels = np.column_stack([ms_data["data"][species][data_key] for species in group])
+            # too few points to smooth with a cubic, e.g., for a narrow time range
+            if length // 10 <= 3:
+                filtered = channels
+            else:
+                filtered = savgol_filter(channels, length // 10, 3, axis=0)
+            smoothed.update({species: filtered[:, i] for i, species in enumerate(group)})
+        return smoothed
+
     @classmethod
     def _plot_ms_data(cls, ms_data):
         x_options = ["Time Relative [s]"]
 
-        # collect the maximum value of the data key for each species for plot ordering
-        max_vals: List[Tuple[str, float]] = []
-
         data_key: str = (
             "Partial pressure [mbar] or Ion Current [A]"  # default value for data key if missing
         )
+        for key in ("Partial Pressure [mbar]", "Ion Current [A]"):
+            if key in ms_data["data_keys"]:
+                data_key = key
+                break
 
-        for species in ms_data["data"]:
-            data_key = (
-                "Partial Pressure [mbar]"
-                if "Partial Pressure [mbar]" in ms_data["data"][species]
-                else "Ion Current [A]"
-            )
-            data = ms_data["data"][species][data_key].to_numpy()
-
-            ms_data["data"][species][f"{data_key} (Savitzky-Golay)"] = savgol_filter(
-                data, len(data) // 10, 3
-            )
+        smoothed = cls._smooth_channels(ms_data, data_key)
 
-            max_vals.append((species, ms_data["data"][species][data_key].max()))
+        # order the species by the maximum value of the data key
+        max_vals: List[Tuple[str, float]] = [
+            (species, ms_data["data"][species][data_key].max()) for species in smoothed
+        ]
 
         plots = []
         for ind, (species, _) in enumerate(sorted(max_vals, key=lambda x: x[1], reverse=True)):
+            df = ms_data["data"][species]
+            plot_df = pd.DataFrame(
+                {
+                    x_options[0]: df[x_options[0]],
+                    data_key: df[data_key],
+                    f"{data_key} (Savitzky-Golay)": smoothed[species],
+                }
+            )
             plots.append(
                 selectable_axes_plot(
-                    {species: ms_data["data"][species]},
+                    {species: plot_df},
                     x_options=x_options,
                     y_options=[data_key],
                     y_default=[
@@ -94,11 +215,14 @@ class MassSpecBlock(DataBlock):
 
             plots[-1].children[0].xaxis[0].ticker.desired_num_ticks = 2
 
-            # construct MxN grid of all species
-            M = 3
-            grid = []
-            for i in range(0, len(plots), M):
-                grid.append(plots[i : i + M])
-            p = gridplot(grid, sizing_mode="scale_width", toolbar_location="below")
+        if not plots:
+            return None
+
+        # construct MxN grid of all species
+        M = 3
+        grid = []
+        for i in range(0, len(plots), M):
+            grid.append(plots[i : i + M])
+        p = gridplot(grid, sizing_mode="scale_width", toolbar_location="below")
 
-            return bokeh.embed.json_item(p, theme=DATALAB_BOKEH_GRID_THEME)
+        return bokeh.embed.json_item(p, theme=DATALAB_BOKEH_GRID_THEME)
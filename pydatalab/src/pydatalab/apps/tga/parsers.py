@@ -1,92 +1,374 @@
 from pathlib import Path
-from typing import Dict, Union
+from typing import Any, Dict, List, Optional, Sequence, TextIO, Tuple, Union
 
 import dateutil
+import numpy as np
 import pandas as pd
 
-__all__ = ("parse_mt_mass_spec_ascii",)
+from pydatalab.utils import minmax_downsample_indices
 
+__all__ = (
+    "parse_mt_mass_spec_ascii",
+    "read_mt_mass_spec_window",
+    "species_dataframes",
+    "stream_mt_mass_spec_ascii",
+)
 
-def parse_mt_mass_spec_ascii(path: Path) -> Dict[str, Union[pd.DataFrame, Dict]]:
+
+_MT_HEADER_KEYS = ("Sourcefile", "Exporttime", "Start Time", "End Time")
+_MT_DATA_KEYS = ("Time Relative [s]", "Partial Pressure [mbar]", "Ion Current [A]")
+
+
+def _read_mt_mass_spec_header(f: TextIO) -> Tuple[Dict[str, Any], List[str]]:
+    """Reads the metadata header and species list from the start of a Mettler-Toledo
+    .asc file, leaving the file positioned at the column header row of the data.
+
+    """
+    header: Dict[str, Any] = {}
+
+    # Read start of file until all header keys have been found
+    max_header_lines = 8
+    reads = 0
+    header_end = None
+    while reads < max_header_lines:
+        line = f.readline().strip()
+        reads += 1
+        if line:
+            for key in _MT_HEADER_KEYS:
+                if key in line:
+                    header[key] = line.split(key)[-1].strip()
+        if all(k in header for k in _MT_HEADER_KEYS):
+            header_end = f.tell()
+            break
+    else:
+        raise ValueError(
+            f"Could not find all header keys in first {max_header_lines} lines of file."
+        )
+
+    for key in _MT_HEADER_KEYS[1:]:
+        if "time" in key.lower():
+            header[key] = dateutil.parser.parse(header[key])  # type: ignore
+
+    reads = 0
+    max_species_lines = 10
+    while reads < max_species_lines:
+        line = f.readline().strip()
+        reads += 1
+        if not line:
+            continue
+        return header, line.split()
+
+    raise ValueError(
+        f"Could not find species list in lines {header_end}:{header_end + max_species_lines} lines of file."
+    )
+
+
+def _read_mt_mass_spec_data(f: TextIO, chunksize: Optional[int] = None):
+    """Reads the numeric data of a Mettler-Toledo .asc file, optionally in chunks.
+
+    Duplicated keys will have (column number % number of data keys) appended to them.
+    MT software also writes "---" if the value is missing, so these are parsed as NaNs
+    to remove later. The time axis is not read, as its format cannot be easily inferred
+    and the data is essentially duplicated: "Start Time" in header provides the
+    timestamp of the first row.
+
+    """
+    return pd.read_csv(
+        f,
+        sep="\t",
+        header=0,
+        parse_dates=False,
+        na_values=["---"],
+        usecols=lambda column: column.rsplit(".", 1)[0] in _MT_DATA_KEYS,
+        dtype=np.float64,
+        engine="c",
+        chunksize=chunksize,
+    )
+
+
+def _species_column_layout(
+    columns: Sequence[str], species: Sequence[str]
+) -> Tuple[List[str], List[str], Dict[str, slice]]:
+    """Returns the data keys present in the file, the file columns in species-major
+    order and the slice of those columns belonging to each species.
+
+    """
+    # Some files have Ion Current [A] or Partial Pressure [mbar] -- only use those that are present
+    present_keys = [k for k in _MT_DATA_KEYS if k in columns]
+    ordered = [
+        key + (f".{ind}" if ind != 0 else "") for ind in range(len(species)) for key in present_keys
+    ]
+    species_columns = {
+        specie: slice(ind * len(present_keys), (ind + 1) * len(present_keys))
+        for ind, specie in enumerate(species)
+    }
+    return present_keys, ordered, species_columns
+
+
+def parse_mt_mass_spec_ascii(path: Path) -> Dict[str, Any]:
     """Parses an .asc file containing MS results from a Mettler-Toledo
     spectrometer and returns a dictionary with keys `data` and `meta`,
     which themselves contain a dictionary of dataframes for each species
     with the species names/masses as keys, and a dictionary of
     metadata fields respectively.
 
+    The underlying data is stored once, as a wide array under the key `array`,
+    with the slice of columns for each species given by `species_columns` and
+    the names of those columns by `data_keys`; the dataframes are views onto it.
+
     Parameters:
         path: The path of the file to parse.
 
     """
-
-    header_keys = ("Sourcefile", "Exporttime", "Start Time", "End Time")
-    data_keys = ("Time Relative [s]", "Partial Pressure [mbar]", "Ion Current [A]")
-    header = {}
-    species = []
-
     if not path.exists():
         raise RuntimeError(f"Provided path does not exist: {path!r}")
 
     with open(path) as f:
-        # Read start of file until all header keys have been found
-        max_header_lines = 8
-        reads = 0
-        header_end = None
-        while reads < max_header_lines:
-            line = f.readline().strip()
-            reads += 1
-            if line:
-                for key in header_keys:
-                    if key in line:
-                        header[key] = line.split(key)[-1].strip()
-            if all(k in header for k in header_keys):
-                header_end = f.tell()
-                break
-        else:
-            raise ValueError(
-                f"Could not find all header keys in first {max_header_lines} lines of file."
-            )
+        header, species = _read_mt_mass_spec_header(f)
+        df = _read_mt_mass_spec_data(f)
 
-        for key in header_keys[1:]:
-            if "time" in key.lower():
-                header[key] = dateutil.parser.parse(header[key])  # type: ignore
-
-        reads = 0
-        max_species_lines = 10
-        while reads < max_species_lines:
-            line = f.readline().strip()
-            reads += 1
-            if not line:
-                continue
-            species = line.split()
-            break
-        else:
-            raise ValueError(
-                f"Could not find species list in lines {header_end}:{header_end + max_species_lines} lines of file."
-            )
+    present_keys, columns, species_columns = _species_column_layout(df.columns, species)
+
+    # All channels are stored in a single wide array, with a contiguous slice of columns per species
+    ms_results: Dict[str, Any] = {
+        "meta": header,
+        "array": df[columns].to_numpy(dtype=np.float64),
+        "species_columns": species_columns,
+        "data_keys": present_keys,
+    }
+    ms_results["data"] = species_dataframes(ms_results)
+    return ms_results
+
+
+def _valid_rows(values: np.ndarray) -> Union[slice, np.ndarray]:
+    """Returns the rows of a 2D array without NaNs, as a slice if they
+    are contiguous from the start (e.g., when only the final rows are incomplete).
+
+    """
+    valid = ~np.isnan(values).any(axis=1)
+    num_valid = int(valid.sum())
+    if valid[:num_valid].all():
+        return slice(0, num_valid)
+    return valid
+
+
+def species_dataframes(ms_results: Dict[str, Any]) -> Dict[str, pd.DataFrame]:
+    """Builds a dataframe for each species from the wide array of parsed mass spec
+    results, without copying the underlying data unless some species have missing
+    values before their final row.
+
+    Parameters:
+        ms_results: The parsed results from `parse_mt_mass_spec_ascii`.
+
+    Returns:
+        A dictionary of dataframes for each species, with NaN rows removed.
 
-        # Read data with duplicated keys: will have (column number % number of data keys) appended to them
-        # MT software also writes "---" if the value is missing, so parse these as NaNs to remove later
-        df = pd.read_csv(f, sep="\t", header=0, parse_dates=False, na_values=["---"])
-        ms_results: Dict[str, Union[pd.DataFrame, Dict]] = {}
-        ms_results["meta"] = header
-        ms_results["data"] = {}
-
-        # Some files have Ion Current [A] or Partial Pressure [mbar] -- only rename those that are present
-        present_keys = set(df.columns.values) & set(data_keys)
-        for ind, specie in enumerate(species):
-            # Loop over all species and rename the columns to remove the species name and disaggregate as a dict
-            species_data_keys = [k + f"{'.' + str(ind) if ind != 0 else ''}" for k in present_keys]
-            ms_results["data"][specie] = df[species_data_keys].rename(
-                {mangled: original for mangled, original in zip(species_data_keys, present_keys)},
-                axis="columns",
+    """
+    data = {}
+    for specie, columns in ms_results["species_columns"].items():
+        values = ms_results["array"][:, columns]
+        data[specie] = pd.DataFrame(
+            values[_valid_rows(values)], columns=ms_results["data_keys"], copy=False
+        )
+    return data
+
+
+class _MinMaxEnvelope:
+    """Accumulates a bounded-size min/max envelope of many (x, y) channels from
+    a stream of row chunks.
+
+    Rows are reduced in buckets of `bucket_size` to the points with the minimum and
+    maximum `y` of each channel (in their original order). Whenever more than
+    `4 * max_buckets` points have accumulated, pairs of buckets are merged and the
+    bucket size doubles, so memory use is independent of the length of the stream.
+
+    """
+
+    def __init__(self, num_channels: int, max_buckets: int):
+        self.max_buckets = max_buckets
+        self.bucket_size = 1
+        self.points = (np.empty((0, num_channels)), np.empty((0, num_channels)))
+        self.pending = (np.empty((0, num_channels)), np.empty((0, num_channels)))
+
+    @staticmethod
+    def _reduce(x: np.ndarray, y: np.ndarray, size: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Reduces each group of `size` rows to its min and max points per channel."""
+        num_groups = len(y) // size
+        x = x[: num_groups * size].reshape(num_groups, size, -1)
+        y = y[: num_groups * size].reshape(num_groups, size, -1)
+        i_min = np.where(np.isnan(y), np.inf, y).argmin(axis=1)[:, np.newaxis]
+        i_max = np.where(np.isnan(y), -np.inf, y).argmax(axis=1)[:, np.newaxis]
+        first, second = np.minimum(i_min, i_max), np.maximum(i_min, i_max)
+        indices = np.concatenate((first, second), axis=1)
+        return (
+            np.take_along_axis(x, indices, axis=1).reshape(2 * num_groups, -1),
+            np.take_along_axis(y, indices, axis=1).reshape(2 * num_groups, -1),
+        )
+
+    def _extend(self, x: np.ndarray, y: np.ndarray) -> None:
+        self.points = (np.concatenate((self.points[0], x)), np.concatenate((self.points[1], y)))
+        while len(self.points[0]) > 4 * self.max_buckets:
+            # merge pairs of buckets (4 points), keeping any remainder as-is
+            num_merged = len(self.points[0]) - len(self.points[0]) % 4
+            merged = self._reduce(self.points[0][:num_merged], self.points[1][:num_merged], 4)
+            self.points = (
+                np.concatenate((merged[0], self.points[0][num_merged:])),
+                np.concatenate((merged[1], self.points[1][num_merged:])),
             )
+            self.bucket_size *= 2
+
+    def add(self, x: np.ndarray, y: np.ndarray) -> None:
+        """Adds a chunk of rows of shape (rows, channels) to the envelope."""
+        x = np.concatenate((self.pending[0], x))
+        y = np.concatenate((self.pending[1], y))
+        num_full = len(y) - len(y) % self.bucket_size
+        if num_full:
+            self._extend(*self._reduce(x[:num_full], y[:num_full], self.bucket_size))
+        self.pending = (x[num_full:], y[num_full:])
 
-            # Drop time axis as format cannot be easily inferred and data is essentially duplicated: "Start Time" in header
-            # provides the timestamp of the first row
-            ms_results["data"][specie].drop("Time", axis="columns", inplace=True, errors="ignore")
+    def finalize(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the (x, y) envelope points of shape (points, channels), including
+        any partially filled final bucket.
+
+        """
+        if len(self.pending[0]):
+            self._extend(*self._reduce(*self.pending, len(self.pending[0])))
+            self.pending = (self.pending[0][:0], self.pending[1][:0])
+        return self.points
+
+
+def _select_data_key(data_keys: Sequence[str]) -> str:
+    for key in ("Partial Pressure [mbar]", "Ion Current [A]"):
+        if key in data_keys:
+            return key
+    raise ValueError(f"No mass spec data found in columns {data_keys}")
+
+
+def stream_mt_mass_spec_ascii(
+    path: Path,
+    cache_dir: Path,
+    max_points: int = 4096,
+    chunksize: int = 10_000,
+) -> Dict[str, Any]:
+    """Parses a (potentially very large) Mettler-Toledo .asc file in chunks with
+    bounded memory use.
+
+    Each column is appended to its own full-resolution float64 file in `cache_dir`,
+    for later queries with `read_mt_mass_spec_window`, and each channel is reduced
+    on the fly to a min/max envelope of at most ~`max_points` points.
+
+    Parameters:
+        path: The path of the file to parse.
+        cache_dir: The directory in which to write the columnar cache.
+        max_points: The approximate maximum number of points to keep per species.
+        chunksize: The number of rows to read at a time.
+
+    Returns:
+        A dictionary in the format of `parse_mt_mass_spec_ascii`, without the wide
+        array, where `data` contains the downsampled time and value of each species.
+        The cache is also described by `num_rows`, `species_columns` and `cache_dir`.
+
+    """
+    if not path.exists():
+        raise RuntimeError(f"Provided path does not exist: {path!r}")
+
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    column_files: List = []
+    num_rows = 0
+    try:
+        with open(path) as f:
+            header, species = _read_mt_mass_spec_header(f)
+            envelope = None
+            for chunk in _read_mt_mass_spec_data(f, chunksize=chunksize):
+                if envelope is None:
+                    present_keys, columns, species_columns = _species_column_layout(
+                        chunk.columns, species
+                    )
+                    data_key = _select_data_key(present_keys)
+                    x_columns = [
+                        s.start + present_keys.index("Time Relative [s]")
+                        for s in species_columns.values()
+                    ]
+                    y_columns = [
+                        s.start + present_keys.index(data_key) for s in species_columns.values()
+                    ]
+                    column_files = [open(cache_dir / f"{i}.f8", "wb") for i in range(len(columns))]
+                    envelope = _MinMaxEnvelope(len(species), max(max_points // 4, 1))
+
+                array = chunk[columns].to_numpy(dtype=np.float64)
+                for i, column_file in enumerate(column_files):
+                    np.ascontiguousarray(array[:, i]).tofile(column_file)
+                envelope.add(array[:, x_columns], array[:, y_columns])
+                num_rows += len(array)
+    finally:
+        for column_file in column_files:
+            column_file.close()
+
+    if envelope is None:
+        raise ValueError(f"No mass spec data found in {path}")
+
+    x, y = envelope.finalize()
+    data = {}
+    for ind, specie in enumerate(species):
+        valid = ~(np.isnan(x[:, ind]) | np.isnan(y[:, ind]))
+        data[specie] = pd.DataFrame({"Time Relative [s]": x[valid, ind], data_key: y[valid, ind]})
+
+    index = {
+        "meta": header,
+        "data": data,
+        "data_keys": ["Time Relative [s]", data_key],
+        "file_data_keys": present_keys,
+        "species_columns": species_columns,
+        "num_rows": num_rows,
+    }
+    pd.to_pickle(index, cache_dir / "index.pkl")
+    return {**index, "cache_dir": cache_dir}
+
+
+def read_mt_mass_spec_window(
+    cache_dir: Path,
+    species: str,
+    time_range: Optional[Tuple[float, float]] = None,
+    max_points: Optional[int] = None,
+) -> pd.DataFrame:
+    """Reads the full-resolution data of one species within a time window from the
+    columnar cache written by `stream_mt_mass_spec_ascii`, via memory maps.
+
+    Parameters:
+        cache_dir: The cache directory.
+        species: The species to read.
+        time_range: The (start, end) of the window in seconds, defaulting to all data.
+        max_points: If provided, the window is reduced to a min/max envelope of
+            approximately this many points.
+
+    Returns:
+        A dataframe of the data keys of the species within the window, without NaNs.
+
+    """
+    cache_dir = Path(cache_dir)
+    index = pd.read_pickle(cache_dir / "index.pkl")
+    columns = index["species_columns"][species]
+    keys = index["file_data_keys"]
+    arrays: Dict[str, np.ndarray] = {
+        key: np.memmap(
+            cache_dir / f"{i}.f8", dtype=np.float64, mode="r", shape=(index["num_rows"],)
+        )
+        for key, i in zip(keys, range(columns.start, columns.stop))
+    }
 
-            # If the file was provided in an incomplete form, the final rows will be NaN, so drop them
-            ms_results["data"][specie].dropna(inplace=True)
+    window = slice(0, index["num_rows"])
+    if time_range is not None:
+        # relative times are monotonic, so the window can be found without reading all the data
+        time = arrays["Time Relative [s]"]
+        window = slice(
+            int(np.searchsorted(time, min(time_range), side="left")),
+            int(np.searchsorted(time, max(time_range), side="right")),
+        )
 
-        return ms_results
+    df = pd.DataFrame({key: np.array(array[window]) for key, array in arrays.items()}).dropna()
+    if max_points is not None and len(df) > max_points:
+        indices = minmax_downsample_indices(df[_select_data_key(keys)].to_numpy(), max_points // 2)
+        df = df.iloc[indices].reset_index(drop=True)
+    return df
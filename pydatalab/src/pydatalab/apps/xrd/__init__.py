@@ -1,3 +1,3 @@
-from .blocks import XRDBlock
+from .blocks import XRDBlock, XRDHeatmapBlock
 
-__all__ = ("XRDBlock",)
+__all__ = ("XRDBlock", "XRDHeatmapBlock")
@@ -1,5 +1,8 @@
+import multiprocessing
 import os
-from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
 
 import bokeh
 import numpy as np
@@ -7,12 +10,107 @@ import pandas as pd
 from scipy.signal import medfilt
 
 from pydatalab.blocks.base import DataBlock
-from pydatalab.bokeh_plots import DATALAB_BOKEH_THEME, selectable_axes_plot
-from pydatalab.file_utils import get_file_info_by_id
+from pydatalab.bokeh_plots import (
+    DATALAB_BOKEH_THEME,
+    selectable_axes_plot,
+    stacked_image_plot,
+)
+from pydatalab.derived_columns import (
+    DerivedColumnRegistry,
+    DerivedColumns,
+    get_file_revision_key,
+)
+from pydatalab.file_utils import get_file_info_by_id, get_file_info_by_ids
 from pydatalab.logger import LOGGER
-from pydatalab.mongo import flask_mongo
 
-from .utils import parse_xrdml
+from .utils import (
+    get_pattern_stack_window,
+    load_pattern_file,
+    load_pattern_stack,
+    stack_patterns,
+)
+
+POLYFIT_DEG = 15
+MEDFILT_KERNEL_SIZE = 101
+
+_PATTERN_POOL: Optional[ProcessPoolExecutor] = None
+"""A lazily-created pool of worker processes used to parse patterns in parallel."""
+
+
+def _subtract_baseline(
+    df: pd.DataFrame, baseline: np.ndarray, name: str, baseline_label: str
+) -> Dict[str, np.ndarray]:
+    subtracted = df["normalized intensity"] - baseline
+    subtracted /= np.max(subtracted)
+    return {
+        f"intensity - {name}": subtracted,
+        baseline_label: baseline / np.max(subtracted),
+    }
+
+
+def _polyfit_baseline(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    baseline = np.poly1d(np.polyfit(df["2θ (°)"], df["normalized intensity"], deg=POLYFIT_DEG))(
+        df["2θ (°)"]
+    )
+    return _subtract_baseline(
+        df, baseline, "polyfit baseline", f"baseline (`numpy.polyfit`, deg={POLYFIT_DEG})"
+    )
+
+
+def _median_baseline(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    baseline = medfilt(df["normalized intensity"], kernel_size=MEDFILT_KERNEL_SIZE)
+    return _subtract_baseline(
+        df,
+        baseline,
+        "median baseline",
+        f"baseline (`scipy.signal.medfilt`, kernel_size={MEDFILT_KERNEL_SIZE})",
+    )
+
+
+XRD_DERIVED_COLUMNS = DerivedColumnRegistry(
+    DerivedColumns(
+        "normalized intensity",
+        ["normalized intensity"],
+        lambda df: {"normalized intensity": df["intensity"] / np.max(df["intensity"])},
+    ),
+    DerivedColumns(
+        "sqrt(intensity)",
+        ["sqrt(intensity)"],
+        lambda df: {"sqrt(intensity)": np.sqrt(df["intensity"])},
+    ),
+    DerivedColumns(
+        "log(intensity)",
+        ["log(intensity)"],
+        lambda df: {"log(intensity)": np.log10(df["intensity"])},
+    ),
+    DerivedColumns(
+        "median baseline",
+        [
+            "intensity - median baseline",
+            f"baseline (`scipy.signal.medfilt`, kernel_size={MEDFILT_KERNEL_SIZE})",
+        ],
+        _median_baseline,
+        expensive=True,
+    ),
+    DerivedColumns(
+        "polyfit baseline",
+        ["intensity - polyfit baseline", f"baseline (`numpy.polyfit`, deg={POLYFIT_DEG})"],
+        _polyfit_baseline,
+        expensive=True,
+    ),
+)
+"""The derived columns available for XRD patterns; baselines are only computed on request."""
+
+
+def _load_pattern_file_or_error(location: str) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    """Worker function for parsing patterns in parallel, which returns any error
+    message rather than raising, so that it can be attributed to the correct file.
+
+    """
+    try:
+        return load_pattern_file(location, reload=False), None
+    except Exception as exc:
+        return None, str(exc)
 
 
 class XRDBlock(DataBlock):
@@ -29,39 +127,99 @@ class XRDBlock(DataBlock):
 
     @classmethod
     def load_pattern(
-        self, location: str, wavelength: float | None = None
+        self,
+        location: str,
+        wavelength: float | None = None,
+        derived_columns: Iterable[str] | None = None,
+        cache_key: Hashable | None = None,
+        reload: bool = True,
     ) -> Tuple[pd.DataFrame, List[str]]:
+        """Load an XRD pattern from file, with any requested derived columns.
+
+        Parameters:
+            location: The location of the file to read.
+            wavelength: The wavelength used to convert 2θ into Q and d, if provided.
+            derived_columns: Names of any expensive transforms (e.g., baselines) in
+                `XRD_DERIVED_COLUMNS` to compute in addition to the cheap defaults.
+            cache_key: A key identifying the file revision, under which derived columns
+                will be memoized (defaults to the location and modification time of the file).
+            reload: Whether to reparse the file, or use the cached parse, if available.
+
+        Returns:
+            The dataframe and the list of columns that can be plotted on the y-axis.
+
+        """
         if not isinstance(location, str):
             location = str(location)
 
-        ext = os.path.splitext(location.split("/")[-1])[-1].lower()
+        df = load_pattern_file(location, reload=reload)
+        return self._process_pattern(df, location, wavelength, derived_columns, cache_key)
 
-        if ext == ".xrdml":
-            df = parse_xrdml(location)
+    @classmethod
+    def load_patterns(
+        self,
+        file_infos: List[Dict],
+        wavelength: float | None = None,
+        derived_columns: Iterable[str] | None = None,
+        parallel: bool = False,
+    ) -> List[Tuple[pd.DataFrame, List[str]]]:
+        """Load several XRD patterns at once, reusing any cached parses of each file
+        and optionally parsing the remaining files in a shared pool of worker processes.
 
-        else:
-            columns = ["twotheta", "intensity", "error"]
-            # Try to parse the file by incrementing skiprows until all lines can be cast to np.float64
-            skiprows: int = 0
-            # Set arbitrary limit to avoid infinite loop; a header of 10,000 lines is unlikely to be useful
-            while skiprows < 10_000:
-                try:
-                    df = pd.read_csv(
-                        location, sep=r"\s+", names=columns, dtype=np.float64, skiprows=skiprows
-                    )
-                    break
-                except ValueError:
-                    skiprows += 1
-            else:
-                raise RuntimeError(
-                    f"Unable to extract XRD data from file {location}; check file header for irregularities"
+        Parameters:
+            file_infos: The file documents (as returned by `get_file_info_by_ids`) to load.
+            wavelength: The wavelength used to convert 2θ into Q and d, if provided.
+            derived_columns: Names of any expensive transforms to compute for each pattern.
+            parallel: Whether to parse the files in parallel.
+
+        Returns:
+            A list of (dataframe, y_options) tuples, in the same order as `file_infos`.
+
+        """
+        global _PATTERN_POOL
+
+        locations = [str(f["location"]) for f in file_infos]
+        results = None
+        if parallel and len(locations) > 1:
+            if _PATTERN_POOL is None:
+                _PATTERN_POOL = ProcessPoolExecutor(
+                    max_workers=max(min(os.cpu_count() or 1, 8), 1),
+                    mp_context=multiprocessing.get_context("spawn"),
                 )
+            try:
+                results = list(_PATTERN_POOL.map(_load_pattern_file_or_error, locations))
+            except BrokenProcessPool as exc:
+                LOGGER.warning("Pattern worker pool failed, parsing serially: %s", exc)
+                _PATTERN_POOL = None
+
+        if results is None:
+            results = [_load_pattern_file_or_error(location) for location in locations]
 
-            if skiprows > 0:
-                with open(location) as f:
-                    header = "".join([next(f) for _ in range(skiprows)])
-                    df.attrs["header"] = header
+        patterns = []
+        for file_info, location, (df, error) in zip(file_infos, locations, results):
+            if error is not None:
+                raise RuntimeError(f"Could not parse file {location}. Error: {error}")
+            patterns.append(
+                self._process_pattern(
+                    df,
+                    location,
+                    wavelength,
+                    derived_columns,
+                    get_file_revision_key(file_info),
+                )
+            )
 
+        return patterns
+
+    @classmethod
+    def _process_pattern(
+        self,
+        df: pd.DataFrame,
+        location: str,
+        wavelength: float | None = None,
+        derived_columns: Iterable[str] | None = None,
+        cache_key: Hashable | None = None,
+    ) -> Tuple[pd.DataFrame, List[str]]:
         if len(df) == 0:
             raise RuntimeError(f"No compatible data found in {location}")
 
@@ -75,38 +233,16 @@ class XRDBlock(DataBlock):
             except (ValueError, ZeroDivisionError):
                 pass
 
-        df["sqrt(intensity)"] = np.sqrt(df["intensity"])
-        df["log(intensity)"] = np.log10(df["intensity"])
-        df["normalized intensity"] = df["intensity"] / np.max(df["intensity"])
-        polyfit_deg = 15
-        polyfit_baseline = np.poly1d(
-            np.polyfit(df["2θ (°)"], df["normalized intensity"], deg=polyfit_deg)
-        )(df["2θ (°)"])
-        df["intensity - polyfit baseline"] = df["normalized intensity"] - polyfit_baseline
-        df["intensity - polyfit baseline"] /= np.max(df["intensity - polyfit baseline"])
-        df[f"baseline (`numpy.polyfit`, deg={polyfit_deg})"] = polyfit_baseline / np.max(
-            df["intensity - polyfit baseline"]
-        )
-
-        kernel_size = 101
-        median_baseline = medfilt(df["normalized intensity"], kernel_size=kernel_size)
-        df["intensity - median baseline"] = df["normalized intensity"] - median_baseline
-        df["intensity - median baseline"] /= np.max(df["intensity - median baseline"])
-        df[f"baseline (`scipy.signal.medfilt`, kernel_size={kernel_size})"] = (
-            median_baseline / np.max(df["intensity - median baseline"])
+        if cache_key is None:
+            cache_key = (location, os.path.getmtime(location))
+        derived_columns = XRD_DERIVED_COLUMNS.add_columns(
+            df, requested=derived_columns, cache_key=cache_key
         )
 
         df.index.name = location.split("/")[-1]
 
-        y_options = [
-            "normalized intensity",
-            "intensity",
-            "sqrt(intensity)",
-            "log(intensity)",
-            "intensity - median baseline",
-            f"baseline (`scipy.signal.medfilt`, kernel_size={kernel_size})",
-            "intensity - polyfit baseline",
-            f"baseline (`numpy.polyfit`, deg={polyfit_deg})",
+        y_options = ["normalized intensity", "intensity"] + [
+            c for c in derived_columns if c != "normalized intensity"
         ]
 
         return df, y_options
@@ -115,19 +251,16 @@ class XRDBlock(DataBlock):
         file_info = None
         all_files = None
         pattern_dfs = None
+        derived_columns = self.data.get("derived_columns") or []
+        self.data["available_derived_columns"] = XRD_DERIVED_COLUMNS.optional_names
 
         if "file_id" not in self.data:
             # If no file set, try to plot them all
-            item_info = flask_mongo.db.items.find_one(
-                {"item_id": self.data["item_id"]},
-            )
+            item_info = self.get_item_context()
 
             all_files = [
                 d
-                for d in [
-                    get_file_info_by_id(f, update_if_live=False)
-                    for f in item_info["file_ObjectIds"]
-                ]
+                for d in get_file_info_by_ids(item_info["file_ObjectIds"], update_if_live=False)
                 if any(d["name"].lower().endswith(ext) for ext in self.accepted_file_extensions)
             ]
 
@@ -135,18 +268,26 @@ class XRDBlock(DataBlock):
                 LOGGER.warning("XRDBlock.generate_xrd_plot(): No files found on sample")
                 return
 
-            pattern_dfs = []
-            for f in all_files:
-                try:
-                    pattern_df, y_options = self.load_pattern(
-                        f["location"],
-                        wavelength=float(self.data.get("wavelength", self.defaults["wavelength"])),
-                    )
-                except Exception as exc:
-                    raise RuntimeError(
-                        f"Could not parse file {file_info['location']}. Error: {exc}"
-                    )
-                pattern_dfs.append(pattern_df)
+            patterns = self.load_patterns(
+                all_files,
+                wavelength=float(self.data.get("wavelength", self.defaults["wavelength"])),
+                derived_columns=derived_columns,
+                parallel=len(all_files) > 4,
+            )
+            pattern_dfs = [df for df, _ in patterns]
+            y_options = patterns[-1][1]
+
+            if self.data.get("stacked") and len(pattern_dfs) > 1:
+                grid, stacked = stack_patterns(pattern_dfs)
+                p = stacked_image_plot(
+                    grid,
+                    stacked,
+                    x_label="2θ (°)",
+                    z_label="normalized intensity",
+                    labels=[f["name"] for f in all_files],
+                )
+                self.data["bokeh_plot_data"] = bokeh.embed.json_item(p, theme=DATALAB_BOKEH_THEME)
+                return
 
         else:
             file_info = get_file_info_by_id(self.data["file_id"], update_if_live=True)
@@ -161,6 +302,9 @@ class XRDBlock(DataBlock):
             pattern_dfs, y_options = self.load_pattern(
                 file_info["location"],
                 wavelength=float(self.data.get("wavelength", self.defaults["wavelength"])),
+                derived_columns=derived_columns,
+                cache_key=get_file_revision_key(file_info),
+                reload=False,
             )
             pattern_dfs = [pattern_dfs]
 
@@ -175,3 +319,67 @@ class XRDBlock(DataBlock):
             )
 
             self.data["bokeh_plot_data"] = bokeh.embed.json_item(p, theme=DATALAB_BOKEH_THEME)
+
+
+class XRDHeatmapBlock(DataBlock):
+    """A data block for visualising in situ/operando series of diffraction patterns,
+    uploaded as a zip archive, as a single heatmap.
+
+    On first use, the patterns are interpolated onto a common 2θ grid and stored as a
+    memory-mapped array (with downsampled zoom levels) alongside the archive; each
+    render then only reads the window of the stack being viewed.
+
+    """
+
+    blocktype = "xrd-heatmap"
+    name = "In situ XRD"
+    description = "Visualize a zipped series of XRD patterns as a heatmap."
+    accepted_file_extensions = (".zip",)
+
+    max_image_shape: Tuple[int, int] = (256, 1024)
+    """The maximum (patterns, 2θ points) of the image sent to the browser."""
+
+    @property
+    def plot_functions(self):
+        return (self.generate_heatmap_plot,)
+
+    def generate_heatmap_plot(self):
+        if "file_id" not in self.data:
+            return None
+
+        file_info = get_file_info_by_id(self.data["file_id"], update_if_live=True)
+        ext = os.path.splitext(file_info["location"].split("/")[-1])[-1].lower()
+        if ext not in self.accepted_file_extensions:
+            raise RuntimeError(
+                f"XRDHeatmapBlock.generate_heatmap_plot(): Unsupported file extension (must be one of {self.accepted_file_extensions}), not {ext}"
+            )
+
+        index = load_pattern_stack(file_info["location"])
+        self.data["num_patterns"] = len(index["names"])
+        self.data["twotheta_limits"] = [
+            float(index["grids"][0][0]),
+            float(index["grids"][0][-1]),
+        ]
+
+        twotheta, patterns, image = get_pattern_stack_window(
+            file_info["location"],
+            index,
+            twotheta_range=self.data.get("twotheta_range"),
+            pattern_range=self.data.get("pattern_range"),
+            max_shape=self.max_image_shape,
+        )
+
+        labels = None
+        if all(float(p).is_integer() for p in patterns):
+            labels = [os.path.basename(index["names"][int(p)]) for p in patterns]
+
+        p = stacked_image_plot(
+            twotheta,
+            image,
+            x_label="2θ (°)",
+            y_label="pattern",
+            z_label=index["column"],
+            labels=labels,
+            y=patterns,
+        )
+        self.data["bokeh_plot_data"] = bokeh.embed.json_item(p, theme=DATALAB_BOKEH_THEME)
@@ -1,7 +1,11 @@
 import os
 import re
+import tempfile
 import warnings
-from typing import List, Tuple
+import zipfile
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from xml.etree import ElementTree
 
 import numpy as np
 import pandas as pd
@@ -9,35 +13,318 @@ import pandas as pd
 STARTEND_REGEX = (
     r"<startPosition>(\d+\.\d+)</startPosition>\s+<endPosition>(\d+\.\d+)</endPosition>"
 )
-DATA_REGEX = r'<(intensities|counts) unit="counts">((-?\d+ )+-?\d+)</(intensities|counts)>'
+DATA_REGEX = r'<(intensities|counts) unit="counts">([^<]*)</(?:intensities|counts)>'
 
 
 class XrdmlParseError(Exception):
     pass
 
 
-def parse_xrdml(filename: str) -> pd.DataFrame:
+def _strip_namespace(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _parse_positions(element: ElementTree.Element) -> Tuple[float, float] | np.ndarray | None:
+    """Returns either the (start, end) positions or the explicit list of positions
+    contained in an XRDML `<positions>` element.
+
+    """
+    start = end = None
+    for child in element:
+        tag = _strip_namespace(child.tag)
+        if tag == "startPosition":
+            start = float(child.text or "nan")
+        elif tag == "endPosition":
+            end = float(child.text or "nan")
+        elif tag == "listPositions":
+            return np.fromstring(child.text or "", dtype=np.float64, sep=" ")
+    if start is None or end is None:
+        return None
+    return start, end
+
+
+def iter_xrdml_scans(filename: str) -> Iterator[pd.DataFrame]:
+    """Streams the scans from an XRDML file, yielding a pandas DataFrame with columns
+    twotheta and intensity for each `<scan>` element.
+
+    The file is read incrementally with `xml.etree.ElementTree.iterparse` and each element
+    is removed from the tree once it has been handled, so memory use is bounded by the
+    size of a single scan.
+    The start and end positions of any other axes (e.g., Omega) are stored in
+    `df.attrs["positions"]`.
+
+    Parameters:
+        filename: The file to parse.
+
+    Raises:
+        XrdmlParseError: if a scan is missing its 2θ positions or intensities.
+
+    """
+    positions: Dict[str, Tuple[float, float] | np.ndarray] = {}
+    intensities: np.ndarray | None = None
+    scan_index = 0
+    # the currently open ancestors of each element, used to detach handled elements
+    open_elements: List[ElementTree.Element] = []
+
+    for event, element in ElementTree.iterparse(filename, events=("start", "end")):
+        if event == "start":
+            open_elements.append(element)
+            continue
+
+        open_elements.pop()
+        tag = _strip_namespace(element.tag)
+
+        if tag == "positions":
+            axis_positions = _parse_positions(element)
+            if axis_positions is not None:
+                positions[element.get("axis", f"axis_{len(positions)}")] = axis_positions
+
+        elif tag in ("intensities", "counts"):
+            intensities = np.fromstring(element.text or "", dtype=np.float64, sep=" ")
+
+        elif tag == "scan":
+            if intensities is None or not len(intensities):
+                raise XrdmlParseError("the intensitites were not found in the XML file")
+            if not positions:
+                raise XrdmlParseError(
+                    "the start and end 2theta positions were not found in the XRDML file"
+                )
+
+            # Fall back to the first listed axis, as in `getStartEnd`
+            axis = "2Theta" if "2Theta" in positions else next(iter(positions))
+            twotheta = positions.pop(axis)
+            if isinstance(twotheta, tuple):
+                twotheta = np.linspace(twotheta[0], twotheta[1], num=len(intensities))
+
+            df = pd.DataFrame({"twotheta": twotheta, "intensity": intensities})
+            df.attrs["scan"] = scan_index
+            df.attrs["positions"] = {k: v for k, v in positions.items() if isinstance(v, tuple)}
+            yield df
+
+            scan_index += 1
+            positions = {}
+            intensities = None
+
+        # The children of `<positions>` are kept until the positions themselves are parsed
+        if open_elements and _strip_namespace(open_elements[-1].tag) != "positions":
+            element.clear()
+            open_elements[-1].remove(element)
+
+
+def parse_xrdml(filename: str, scan: int = 0) -> pd.DataFrame:
     """Parses an XRDML file and returns a pandas DataFrame with columns
     twotheta and intensity.
 
     Parameters:
         filename: The file to parse.
+        scan: The index of the scan to return, for files containing multiple scans.
+
+    Raises:
+        XrdmlParseError: if the requested scan could not be found.
 
     """
+    for index, df in enumerate(iter_xrdml_scans(filename)):
+        if index == scan:
+            return df
+
+    raise XrdmlParseError(f"scan {scan} was not found in the XRDML file")
+
+
+def parse_xrdml_2d(filename: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Parses all scans in an XRDML file (e.g., from a 2D or repeated measurement)
+    into a single array.
+
+    Scans are interpolated onto the 2θ grid of the first scan if their grids differ.
+
+    Parameters:
+        filename: The file to parse.
+
+    Returns:
+        The shared 2θ grid and an array of intensities with shape (number of scans, number of points).
+
+    """
+    twotheta: np.ndarray | None = None
+    rows: List[np.ndarray] = []
+    for df in iter_xrdml_scans(filename):
+        if twotheta is None:
+            twotheta = df["twotheta"].to_numpy()
+            rows.append(df["intensity"].to_numpy())
+        elif len(df) == len(twotheta) and np.allclose(df["twotheta"].to_numpy(), twotheta):
+            rows.append(df["intensity"].to_numpy())
+        else:
+            rows.append(
+                np.interp(
+                    twotheta,
+                    df["twotheta"].to_numpy(),
+                    df["intensity"].to_numpy(),
+                    left=np.nan,
+                    right=np.nan,
+                )
+            )
+
+    if twotheta is None:
+        raise XrdmlParseError("no scans were found in the XRDML file")
+
+    return twotheta, np.vstack(rows)
+
+
+_MIN_DATA_ROWS = 5
+"""The number of consecutive numeric lines after which the data of an XY(E) file
+is taken to have started."""
+
+
+def _is_numeric_row(line: str, max_columns: int) -> bool:
+    """Returns whether a line of a whitespace-delimited file can be cast to
+    at most `max_columns` floats. Blank lines are treated as numeric, as they
+    are skipped by the subsequent parse.
+
+    """
+    fields = line.split()
+    if len(fields) > max_columns:
+        return False
+    try:
+        for field in fields:
+            float(field)
+    except ValueError:
+        return False
+    return True
+
+
+def parse_xy(
+    filename: str, columns: Tuple[str, ...] = ("twotheta", "intensity", "error")
+) -> pd.DataFrame:
+    """Parses a whitespace-delimited XY(E) file with an arbitrary header and returns a
+    pandas DataFrame with the given columns.
+
+    The header is located by scanning only until the first run of `_MIN_DATA_ROWS`
+    consecutive lines that can be cast to floats (or the end of the file); everything
+    after the last line that could not is then parsed in one go with the pandas C engine,
+    which rejects any later lines that are not data. Any header lines are stored verbatim
+    in `df.attrs["header"]`.
+
+    Parameters:
+        filename: The file to parse.
+        columns: The names to give the (up to) three data columns.
+
+    Raises:
+        RuntimeError: if no data could be extracted from the file.
+
+    """
+    skiprows: int = 0
+    num_data_rows: int = 0
     with open(filename) as f:
-        s = f.read()
+        for line_number, line in enumerate(f, start=1):
+            if _is_numeric_row(line, len(columns)):
+                if line.strip():
+                    num_data_rows += 1
+                    if num_data_rows >= _MIN_DATA_ROWS:
+                        break
+            else:
+                skiprows = line_number
+                num_data_rows = 0
+
+    if num_data_rows == 0:
+        raise RuntimeError(
+            f"Unable to extract XRD data from file {filename}; check file header for irregularities"
+        )
+
+    try:
+        df = pd.read_csv(
+            filename,
+            sep=r"\s+",
+            names=list(columns),
+            dtype=np.float64,
+            skiprows=skiprows,
+            engine="c",
+        )
+    except ValueError as exc:
+        raise RuntimeError(
+            f"Unable to extract XRD data from file {filename}; check file header for irregularities"
+        ) from exc
+
+    if skiprows > 0:
+        with open(filename) as f:
+            df.attrs["header"] = "".join(next(f) for _ in range(skiprows))
+
+    return df
+
+
+def load_pattern_file(location: Union[str, Path], reload: bool = True) -> pd.DataFrame:
+    """Parses an XRDML or XY(E) file into a dataframe with a twotheta column, caching
+    the parsed result alongside the file.
 
-    start, end = getStartEnd(s)  # extract first and last angle
-    intensities = getIntensities(s)  # extract intensities
+    Parameters:
+        location: The location of the file to parse.
+        reload: Whether to reparse the file, or use the cached version, if it is
+            newer than the file itself.
 
-    angles = np.linspace(start, end, num=len(intensities))
+    Returns:
+        The parsed pattern.
 
-    return pd.DataFrame(
-        {
-            "twotheta": angles,
-            "intensity": intensities,
-        }
-    )
+    """
+    location = str(location)
+    cache_location = Path(location).with_suffix(".XRD_PARSED.pkl")
+
+    if (
+        not reload
+        and cache_location.exists()
+        and cache_location.stat().st_mtime >= os.path.getmtime(location)
+    ):
+        return pd.read_pickle(cache_location)
+
+    ext = os.path.splitext(location.split("/")[-1])[-1].lower()
+    if ext == ".xrdml":
+        df = parse_xrdml(location)
+    else:
+        df = parse_xy(location)
+
+    if not reload:
+        df.to_pickle(cache_location)
+
+    return df
+
+
+def stack_patterns(
+    dfs: Sequence[pd.DataFrame],
+    x: str = "2θ (°)",
+    y: str = "normalized intensity",
+    num_points: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Interpolates a series of patterns onto a shared, evenly-spaced grid spanning
+    all of their x-ranges.
+
+    Parameters:
+        dfs: The patterns to stack.
+        x: The column to use for the shared grid.
+        y: The column to interpolate onto the grid.
+        num_points: The number of grid points, defaulting to the length of the longest pattern.
+
+    Returns:
+        The shared grid and an array with shape (number of patterns, number of points),
+        with NaNs where a pattern does not cover the grid.
+
+    """
+    if not dfs:
+        raise ValueError("No patterns to stack")
+
+    x_min: float = min(float(np.nanmin(df[x])) for df in dfs)
+    x_max: float = max(float(np.nanmax(df[x])) for df in dfs)
+    if num_points is None:
+        num_points = max(len(df) for df in dfs)
+
+    grid = np.linspace(x_min, x_max, num=num_points)
+    stacked = np.full((len(dfs), num_points), np.nan)
+    for ind, df in enumerate(dfs):
+        order = np.argsort(df[x].to_numpy())
+        stacked[ind] = np.interp(
+            grid,
+            df[x].to_numpy()[order],
+            df[y].to_numpy()[order],
+            left=np.nan,
+            right=np.nan,
+        )
+
+    return grid, stacked
 
 
 def convertSinglePattern(
@@ -70,13 +357,11 @@ def convertSinglePattern(
             )
             return outfn
 
-    with open(filename) as f:
-        s = f.read()
-
     print(f"Processing file {filename}")
-    start, end = getStartEnd(s)
+    df = parse_xrdml(filename)
+    start, end = df["twotheta"].iloc[0], df["twotheta"].iloc[-1]
     print(f"\tstart angle: {start}\tend angle: {end}")
-    intensities = getIntensities(s)
+    intensities = df["intensity"].tolist()
 
     if adjust_baseline:
         _intensities = np.array(intensities)  # type: ignore
@@ -131,11 +416,10 @@ def getIntensities(s: str) -> List[float]:
 
     """
     match = re.search(DATA_REGEX, s)
-    if not match:
+    if not match or not match.group(2).strip():
         raise XrdmlParseError("the intensitites were not found in the XML file")
 
-    out = [float(x) for x in match.group(2).split()]  # the intensitites as a list of integers
-    return out
+    return np.fromstring(match.group(2), dtype=np.float64, sep=" ").tolist()
 
 
 def toXY(intensities: List[float], start: float, end: float) -> str:
@@ -146,3 +430,293 @@ def toXY(intensities: List[float], start: float, end: float) -> str:
     angles = np.linspace(start, end, num=len(intensities))
     xylines = ["{:.5f} {:.3f}\r\n".format(a, i) for a, i in zip(angles, intensities)]
     return "".join(xylines)
+
+
+PATTERN_EXTENSIONS = (".xrdml", ".xy", ".dat", ".xye")
+"""The file extensions that will be read as patterns when building a pattern stack."""
+
+
+def _natural_sort_key(name: str) -> List[Union[int, str]]:
+    return [int(s) if s.isdigit() else s.lower() for s in re.split(r"(\d+)", name)]
+
+
+def _list_pattern_sources(location: Union[str, Path]) -> List[str]:
+    """Lists the pattern files in a directory or zip archive, in natural sort order
+    (so that e.g., `scan_2` precedes `scan_10`).
+
+    """
+    if Path(location).is_dir():
+        names = [str(p.relative_to(location)) for p in Path(location).rglob("*") if p.is_file()]
+    else:
+        with zipfile.ZipFile(location) as archive:
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+
+    return sorted(
+        (
+            name
+            for name in names
+            if os.path.splitext(name)[-1].lower() in PATTERN_EXTENSIONS
+            and not Path(name).name.startswith(".")
+            and "__MACOSX" not in name
+        ),
+        key=_natural_sort_key,
+    )
+
+
+def _iter_pattern_sources(location: Union[str, Path]) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """Yields the name and parsed pattern for each pattern file in a directory or zip
+    archive, extracting zipped patterns one at a time to bound disk and memory use.
+
+    """
+    names = _list_pattern_sources(location)
+    if Path(location).is_dir():
+        for name in names:
+            yield name, load_pattern_file(Path(location) / name)
+        return
+
+    with zipfile.ZipFile(location) as archive, tempfile.TemporaryDirectory() as tmpdir:
+        for name in names:
+            extracted = archive.extract(name, tmpdir)
+            try:
+                yield name, load_pattern_file(extracted)
+            finally:
+                os.remove(extracted)
+
+
+def _get_pattern_stack_location(location: Union[str, Path], suffix: str) -> Path:
+    location = Path(location)
+    if location.is_dir():
+        return location / f".XRD_STACK.{suffix}"
+    return location.with_suffix(f".XRD_STACK.{suffix}")
+
+
+def _downsample_stack_level(
+    source: np.ndarray,
+    target: np.ndarray,
+    factors: Tuple[int, int],
+    chunk_rows: int = 256,
+) -> None:
+    """Fills `target` with the block-averages of `source` over the given (row, column)
+    factors (each 1 or 2), ignoring NaNs and processing a bounded number of rows at a time.
+
+    """
+    row_factor, col_factor = factors
+    num_cols = source.shape[1]
+    for start in range(0, source.shape[0], row_factor * chunk_rows):
+        block = np.asarray(source[start : start + row_factor * chunk_rows], dtype=np.float32)
+        pad_rows = block.shape[0] % row_factor
+        pad_cols = num_cols % col_factor
+        if pad_rows or pad_cols:
+            block = np.pad(
+                block, ((0, pad_rows), (0, pad_cols)), mode="constant", constant_values=np.nan
+            )
+        block = block.reshape(
+            block.shape[0] // row_factor, row_factor, block.shape[1] // col_factor, col_factor
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            target[start // row_factor : start // row_factor + block.shape[0]] = np.nanmean(
+                block, axis=(1, 3)
+            )
+
+
+def _downsample_grid(grid: np.ndarray) -> np.ndarray:
+    if len(grid) % 2:
+        grid = np.append(grid, grid[-1] + (grid[-1] - grid[-2] if len(grid) > 1 else 1))
+    return grid.reshape(-1, 2).mean(axis=1)
+
+
+def _open_staged_stack_level(
+    location: Union[str, Path], level: int, shape: Tuple[int, int], staged: Dict[Path, Path]
+) -> np.memmap:
+    """Creates a memory-mapped array for a zoom level of a pattern stack in a new temporary
+    file, recording it in `staged` against the location it should be moved to once complete.
+
+    """
+    final = _get_pattern_stack_location(location, f"{level}.npy")
+    fd, path = tempfile.mkstemp(dir=final.parent, prefix=f".{final.name}.", suffix=".tmp")
+    os.close(fd)
+    staged[final] = Path(path)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+
+
+def build_pattern_stack(
+    location: Union[str, Path],
+    column: str = "intensity",
+    max_level_shape: Tuple[int, int] = (256, 1024),
+) -> Dict:
+    """Reads every pattern in a directory or zip archive into a single memory-mapped
+    array of shape (number of patterns, number of 2θ points), interpolating each pattern
+    onto an ascending 2θ grid spanning the range of the first. A pyramid of zoom levels
+    is then built by repeatedly halving whichever axes exceed `max_level_shape`.
+
+    The arrays are saved as `.npy` files alongside the archive (or inside the directory),
+    with the grids and pattern names in a pickled index. Each file is written to a
+    temporary location and only moved into place once the whole stack is complete (with
+    the index last), so concurrent builds never write to the same files, and readers
+    never see a partially written stack.
+
+    Parameters:
+        location: The directory or zip archive containing the patterns.
+        column: The column of each parsed pattern to stack.
+        max_level_shape: The (rows, columns) that the coarsest zoom level must fit within.
+
+    Raises:
+        RuntimeError: if no patterns could be found.
+
+    Returns:
+        The stack index, as returned by `load_pattern_stack`.
+
+    """
+    names = _list_pattern_sources(location)
+    if not names:
+        raise RuntimeError(f"No XRD patterns found in {location}")
+
+    staged: Dict[Path, Path] = {}
+    try:
+        grid: Optional[np.ndarray] = None
+        stack: Optional[np.memmap] = None
+        for ind, (name, df) in enumerate(_iter_pattern_sources(location)):
+            twotheta = df["twotheta"].to_numpy()
+            intensity = df[column].to_numpy()
+            order = np.argsort(twotheta)
+            if grid is None or stack is None:
+                grid = np.linspace(np.nanmin(twotheta), np.nanmax(twotheta), num=len(twotheta))
+                stack = _open_staged_stack_level(location, 0, (len(names), len(twotheta)), staged)
+            stack[ind] = np.interp(
+                grid, twotheta[order], intensity[order], left=np.nan, right=np.nan
+            )
+
+        if grid is None or stack is None:
+            raise RuntimeError(f"No XRD patterns could be read from {location}")
+        stack.flush()
+
+        shapes: List[Tuple[int, int]] = [(stack.shape[0], stack.shape[1])]
+        scales = [(1, 1)]
+        grids = [grid]
+        previous: np.memmap = stack
+        while previous.shape[0] > max_level_shape[0] or previous.shape[1] > max_level_shape[1]:
+            factors = (
+                2 if previous.shape[0] > max_level_shape[0] else 1,
+                2 if previous.shape[1] > max_level_shape[1] else 1,
+            )
+            shape = (-(-previous.shape[0] // factors[0]), -(-previous.shape[1] // factors[1]))
+            current = _open_staged_stack_level(location, len(shapes), shape, staged)
+            _downsample_stack_level(previous, current, factors)
+            current.flush()
+            shapes.append(shape)
+            scales.append((scales[-1][0] * factors[0], scales[-1][1] * factors[1]))
+            grids.append(_downsample_grid(grids[-1]) if factors[1] == 2 else grids[-1])
+            previous = current
+
+        index = {
+            "names": names,
+            "grids": grids,
+            "shapes": shapes,
+            "scales": scales,
+            "column": column,
+        }
+        index_location = _get_pattern_stack_location(location, "pkl")
+        fd, staged_index = tempfile.mkstemp(
+            dir=index_location.parent, prefix=f".{index_location.name}.", suffix=".tmp"
+        )
+        os.close(fd)
+        staged[index_location] = Path(staged_index)
+        pd.to_pickle(index, staged_index)
+
+        for final, path in staged.items():
+            os.replace(path, final)
+    finally:
+        for path in staged.values():
+            path.unlink(missing_ok=True)
+
+    # Moving files into a directory of patterns updates its modification time,
+    # so mark the index as newer for `load_pattern_stack`
+    os.utime(index_location)
+    return index
+
+
+def load_pattern_stack(location: Union[str, Path], reload: bool = False) -> Dict:
+    """Loads the index of the pattern stack for a directory or zip archive,
+    (re)building it if it does not exist or is older than the archive.
+
+    Parameters:
+        location: The directory or zip archive containing the patterns.
+        reload: Whether to rebuild the stack even if a fresh one exists.
+
+    Returns:
+        A dictionary with the pattern `names`, and the 2θ `grids`, array `shapes`
+        and (row, column) downsampling `scales` of each zoom level (finest first).
+
+    """
+    index_location = _get_pattern_stack_location(location, "pkl")
+    if (
+        not reload
+        and index_location.exists()
+        and index_location.stat().st_mtime >= os.path.getmtime(location)
+    ):
+        return pd.read_pickle(index_location)
+    return build_pattern_stack(location)
+
+
+def get_pattern_stack_window(
+    location: Union[str, Path],
+    index: Dict,
+    twotheta_range: Optional[Tuple[float, float]] = None,
+    pattern_range: Optional[Tuple[int, int]] = None,
+    max_shape: Tuple[int, int] = (256, 1024),
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Reads a window of a pattern stack from the coarsest zoom level that still
+    resolves the window at (up to) `max_shape` pixels, so that only a bounded
+    slice of the memory-mapped arrays is read.
+
+    Parameters:
+        location: The directory or zip archive containing the patterns.
+        index: The stack index, as returned by `load_pattern_stack`.
+        twotheta_range: The (min, max) 2θ to include, defaulting to the full range.
+        pattern_range: The (first, last) pattern indices to include, defaulting to all patterns.
+        max_shape: The maximum (rows, columns) of the returned image.
+
+    Raises:
+        ValueError: if the 2θ grid of the stack is not ascending.
+
+    Returns:
+        The 2θ values of each column, the (fractional) pattern index of each row
+        and the image itself.
+
+    """
+    full_grid = index["grids"][0]
+    num_patterns = index["shapes"][0][0]
+    if len(full_grid) > 1 and full_grid[0] > full_grid[-1]:
+        raise ValueError("The 2θ grid of the pattern stack must be ascending")
+    if twotheta_range is None:
+        twotheta_range = (full_grid[0], full_grid[-1])
+    if pattern_range is None:
+        pattern_range = (0, num_patterns - 1)
+
+    col_start = min(int(np.searchsorted(full_grid, min(twotheta_range))), len(full_grid) - 1)
+    col_stop = max(int(np.searchsorted(full_grid, max(twotheta_range))), col_start + 1)
+    row_start = min(max(int(min(pattern_range)), 0), num_patterns - 1)
+    row_stop = min(max(int(max(pattern_range)) + 1, row_start + 1), num_patterns)
+
+    # Use the finest level at which the window fits, or else the coarsest
+    for level, (row_scale, col_scale) in enumerate(index["scales"]):
+        if (row_stop - row_start) / row_scale <= max_shape[0] and (
+            col_stop - col_start
+        ) / col_scale <= max_shape[1]:
+            break
+
+    row_scale, col_scale = index["scales"][level]
+    rows = slice(row_start // row_scale, -(-row_stop // row_scale))
+    cols = slice(col_start // col_scale, -(-col_stop // col_scale))
+
+    # Stride over any remaining excess if even the coarsest level is too large
+    row_step = max(-(-(rows.stop - rows.start) // max_shape[0]), 1)
+    col_step = max(-(-(cols.stop - cols.start) // max_shape[1]), 1)
+
+    stack = np.load(_get_pattern_stack_location(location, f"{level}.npy"), mmap_mode="r")
+    image = np.array(stack[rows, cols][::row_step, ::col_step])
+    twotheta = index["grids"][level][cols][::col_step]
+    patterns = (np.arange(rows.start, rows.stop) * row_scale + (row_scale - 1) / 2)[::row_step]
+
+    return twotheta, patterns, image
@@ -0,0 +1,237 @@
+"""A content-addressed store for the contents of files, so that identical files
+(e.g., the same data file attached to many items, or re-synced from a remote)
+are only stored once.
+
+The contents of each file are stored under their SHA-256 hash, in a blob directory
+`FILE_DIRECTORY/.blobs/<first two characters of hash>/<hash>/<generation>/`, which holds
+a hard link to the contents under each name that it has been stored with. A new
+generation is started whenever a blob is stored again after being deleted, so that
+removing an old generation never touches newly stored contents. The directory of each
+file, `FILE_DIRECTORY/<file ID>/`, is a symbolic link to its blob directory, so that
+the location of the file is unchanged and any caches written alongside the file
+(parsed data, derived images) are shared between all files with the same contents.
+The number of files referencing each blob is counted in the `blobs` collection, and
+a blob is marked for deletion, then removed, once it is no longer referenced.
+
+Blobs are never modified in place: new contents are always staged in a separate
+file, hashed while they are written, and then linked into a new blob.
+
+"""
+
+import hashlib
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from pydatalab.config import CONFIG
+from pydatalab.logger import LOGGER
+from pydatalab.mongo import flask_mongo
+
+__all__ = (
+    "BLOB_DIRECTORY",
+    "hash_file",
+    "write_and_hash_stream",
+    "get_blob_directory",
+    "store_blob",
+    "release_blob",
+    "link_file_directory",
+)
+
+BLOB_DIRECTORY = ".blobs"
+"""The directory, under `CONFIG.FILE_DIRECTORY`, in which blobs are stored."""
+
+_BLOCK_SIZE = 1024**2
+
+_MAX_STORE_ATTEMPTS = 5
+
+
+def write_and_hash_stream(stream: BinaryIO, path: Path) -> Tuple[str, int]:
+    """Write a stream to a file, computing the SHA-256 hash of its contents on the way.
+
+    Returns:
+        The hex-encoded SHA-256 hash and the size of the contents in bytes.
+
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as f:
+        while block := stream.read(_BLOCK_SIZE):
+            digest.update(block)
+            size += len(block)
+            f.write(block)
+    return digest.hexdigest(), size
+
+
+def hash_file(path: Path | str) -> str:
+    """Returns the hex-encoded SHA-256 hash of the contents of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_blob_directory(content_hash: str, generation: str) -> Path:
+    """Returns the directory in which the given generation of the blob with the given
+    hash is stored.
+
+    """
+    return (
+        Path(CONFIG.FILE_DIRECTORY) / BLOB_DIRECTORY / content_hash[:2] / content_hash / generation
+    )
+
+
+def _place_contents(staged: Path, location: Path, existing: list[Path]) -> bool:
+    """Make the staged contents available at `location` without consuming the staged
+    file, preferably as a hard link to an existing name of the same blob.
+
+    Returns:
+        Whether the contents were placed by this call, rather than already being present.
+
+    """
+    if location.exists():
+        return False
+
+    for source in [*existing, staged]:
+        try:
+            os.link(source, location)
+        except FileExistsError:
+            # stored concurrently under the same name
+            return False
+        except OSError:
+            continue
+        return True
+
+    # fall back to a copy on filesystems without hard links
+    temporary = location.with_name(f".{location.name}.{uuid.uuid4().hex}.part")
+    shutil.copyfile(staged, temporary)
+    os.replace(temporary, location)
+    return True
+
+
+def _remove_blob(content_hash: str, generation: str) -> None:
+    """Remove a generation of a blob that has been marked for deletion."""
+    flask_mongo.db.blobs.delete_one(
+        {"_id": content_hash, "generation": generation, "deleting": True}
+    )
+    directory = get_blob_directory(content_hash, generation)
+    shutil.rmtree(directory, ignore_errors=True)
+    try:
+        directory.parent.rmdir()
+    except OSError:
+        # a new generation has already been stored
+        pass
+
+
+def store_blob(staged: Path, content_hash: str, filename: str) -> Path:
+    """Add a reference to the blob with the given contents, storing the staged contents
+    only if no identical blob exists. The staged file is removed once the reference has
+    been added, and left in place if storing fails.
+
+    The reference is only counted once the contents are in place, and never against a
+    blob that is being deleted: if the blob is marked for deletion before the reference
+    is counted, its removal is completed and the contents are stored in a new generation.
+
+    Parameters:
+        staged: The location of the staged contents, on the same filesystem as the store.
+        content_hash: The SHA-256 hash of the staged contents.
+        filename: The name under which to make the contents available in the blob directory.
+
+    Returns:
+        The blob directory.
+
+    """
+    size = os.path.getsize(staged)
+    for _ in range(_MAX_STORE_ATTEMPTS):
+        try:
+            blob = flask_mongo.db.blobs.find_one_and_update(
+                {"_id": content_hash, "deleting": {"$ne": True}},
+                {
+                    "$setOnInsert": {
+                        "refcount": 0,
+                        "names": [],
+                        "size": size,
+                        "generation": uuid.uuid4().hex,
+                    }
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # the blob is being deleted, so finish that before storing a new generation
+            deleting = flask_mongo.db.blobs.find_one({"_id": content_hash, "deleting": True})
+            if deleting is not None:
+                _remove_blob(content_hash, deleting["generation"])
+            continue
+
+        generation = blob["generation"]
+        directory = get_blob_directory(content_hash, generation)
+        directory.mkdir(parents=True, exist_ok=True)
+        location = directory / filename
+        existing = [directory / name for name in blob["names"] if name != filename]
+        placed = _place_contents(staged, location, existing)
+
+        if flask_mongo.db.blobs.update_one(
+            {"_id": content_hash, "generation": generation, "deleting": {"$ne": True}},
+            {"$inc": {"refcount": 1}, "$addToSet": {"names": filename}},
+        ).modified_count:
+            if existing and placed:
+                LOGGER.debug("Deduplicated %s against blob %s", filename, content_hash)
+            staged.unlink()
+            return directory
+
+        # the blob was marked for deletion while the contents were being placed
+        if placed:
+            location.unlink(missing_ok=True)
+
+    raise RuntimeError(
+        f"Unable to store blob {content_hash}: it was repeatedly deleted while being stored"
+    )
+
+
+def release_blob(content_hash: Optional[str]) -> None:
+    """Remove a reference to a blob, deleting the blob (and any caches stored with it)
+    once it is no longer referenced by any file.
+
+    The blob is first marked for deletion, which can only happen while it is unreferenced,
+    so that no new references can be counted against it while its directory is removed.
+
+    """
+    if not content_hash:
+        return
+    blob = flask_mongo.db.blobs.find_one_and_update(
+        {"_id": content_hash},
+        {"$inc": {"refcount": -1}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if blob is None or blob["refcount"] > 0:
+        return
+    if flask_mongo.db.blobs.update_one(
+        {
+            "_id": content_hash,
+            "generation": blob["generation"],
+            "refcount": {"$lte": 0},
+            "deleting": {"$ne": True},
+        },
+        {"$set": {"deleting": True}},
+    ).modified_count:
+        LOGGER.debug("Removing unreferenced blob %s", content_hash)
+        _remove_blob(content_hash, blob["generation"])
+
+
+def link_file_directory(directory: Path | str, blob_directory: Path) -> None:
+    """Atomically point the directory of a file at a blob directory, replacing any
+    previous link (or, for files stored before the blob store, the original directory).
+
+    """
+    directory = Path(directory)
+    link = directory.with_name(f".{directory.name}.{uuid.uuid4().hex}.link")
+    os.symlink(os.path.relpath(blob_directory, directory.parent), link)
+    if directory.is_dir() and not directory.is_symlink():
+        shutil.rmtree(directory)
+    os.replace(link, directory)
@@ -2,12 +2,12 @@ from typing import Dict, Sequence, Type
 
 # These app imports will be replaced by dynamic plugins in a future version
 from pydatalab.apps.chat.blocks import ChatBlock
-from pydatalab.apps.echem import CycleBlock
+from pydatalab.apps.echem import CapacityFadeBlock, CycleBlock
 from pydatalab.apps.eis import EISBlock
 from pydatalab.apps.nmr import NMRBlock
 from pydatalab.apps.raman import RamanBlock
 from pydatalab.apps.tga import MassSpecBlock
-from pydatalab.apps.xrd import XRDBlock
+from pydatalab.apps.xrd import XRDBlock, XRDHeatmapBlock
 from pydatalab.blocks.base import DataBlock
 from pydatalab.blocks.common import CommentBlock, MediaBlock, NotSupportedBlock, TabularDataBlock
 
@@ -15,7 +15,9 @@ BLOCKS: Sequence[Type["DataBlock"]] = (
     CommentBlock,
     MediaBlock,
     XRDBlock,
+    XRDHeatmapBlock,
     CycleBlock,
+    CapacityFadeBlock,
     RamanBlock,
     NMRBlock,
     NotSupportedBlock,
@@ -31,9 +33,11 @@ __all__ = (
     "CommentBlock",
     "MediaBlock",
     "XRDBlock",
+    "XRDHeatmapBlock",
     "ChatBlock",
     "EISBlock",
     "CycleBlock",
+    "CapacityFadeBlock",
     "NotSupportedBlock",
     "NMRBlock",
     "RamanBlock",
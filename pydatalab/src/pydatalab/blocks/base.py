@@ -3,10 +3,12 @@ import warnings
 from typing import Any, Callable, Dict, Optional, Sequence
 
 from bson import ObjectId
+from flask import g, has_app_context
 
 from pydatalab.logger import LOGGER
+from pydatalab.mongo import flask_mongo
 
-__all__ = ("generate_random_id", "DataBlock")
+__all__ = ("generate_random_id", "get_item_document", "DataBlock")
 
 
 def generate_random_id():
@@ -25,6 +27,32 @@ def generate_random_id():
     return "".join(randlist)
 
 
+def get_item_document(item_id: str) -> Optional[Dict[str, Any]]:
+    """Returns the database document for the item with the given `item_id`.
+
+    Documents are cached for the lifetime of the current application context (i.e.,
+    the current request), so that multiple blocks attached to the same item
+    only query the database once.
+
+    Parameters:
+        item_id: The ID of the item to retrieve.
+
+    Returns:
+        The item document, or `None` if it could not be found.
+
+    """
+    if not has_app_context():
+        return flask_mongo.db.items.find_one({"item_id": item_id})
+
+    if "item_documents" not in g:
+        g.item_documents = {}
+
+    if item_id not in g.item_documents:
+        g.item_documents[item_id] = flask_mongo.db.items.find_one({"item_id": item_id})
+
+    return g.item_documents[item_id]
+
+
 ############################################################################################################
 # Resources (base classes to be extended)
 ############################################################################################################
@@ -65,6 +93,7 @@ class DataBlock:
         collection_id: Optional[str] = None,
         init_data=None,
         unique_id=None,
+        item_context: Optional[Dict[str, Any]] = None,
     ):
         """Create a data block object for the given `item_id` or `collection_id`.
 
@@ -73,6 +102,8 @@ class DataBlock:
             collection_id: The collection to which the block is attached.
             init_data: A dictionary of data to initialise the block with.
             unique_id: A unique id for the block, used in the DOM and database.
+            item_context: The database document of the item to which the block is attached,
+                if it has already been loaded by the caller (see `get_item_context`).
         """
         if init_data is None:
             init_data = {}
@@ -113,6 +144,8 @@ class DataBlock:
         self.data.update(
             init_data
         )  # this could overwrite blocktype and block_id. I think that's reasonable... maybe
+
+        self._item_context = item_context
         LOGGER.debug(
             "Initialised block %s for item ID %s or collection ID %s.",
             self.__class__.__name__,
@@ -136,14 +169,32 @@ class DataBlock:
 
         return self.data
 
+    def get_item_context(self) -> Optional[Dict[str, Any]]:
+        """Returns the database document of the item to which this block is attached,
+        for use with any per-item parameters (e.g., characteristic masses or attached files).
+
+        If the document was not provided when the block was created, it is retrieved
+        with `get_item_document` and then kept for the lifetime of the block.
+
+        Returns:
+            The item document, or `None` if the block is not attached to an item.
+
+        """
+        if self._item_context is None and self.data.get("item_id") is not None:
+            self._item_context = get_item_document(self.data["item_id"])
+
+        return self._item_context
+
     @classmethod
-    def from_db(cls, db_entry):
+    def from_db(cls, db_entry, item_context: Optional[Dict[str, Any]] = None):
         """create a block from json (dictionary) stored in a db"""
         LOGGER.debug("Loading block %s from database object.", cls.__class__.__name__)
         new_block = cls(
             item_id=db_entry.get("item_id"),
             collection_id=db_entry.get("collection_id"),
-            dictionary=db_entry,
+            init_data=db_entry,
+            unique_id=db_entry.get("block_id"),
+            item_context=item_context,
         )
         if "file_id" in new_block.data:
             new_block.data["file_id"] = str(new_block.data["file_id"])
@@ -189,12 +240,13 @@ class DataBlock:
         return self.data
 
     @classmethod
-    def from_web(cls, data):
+    def from_web(cls, data, item_context: Optional[Dict[str, Any]] = None):
         LOGGER.debug("Loading block %s from web request.", cls.__class__.__name__)
         block = cls(
             item_id=data.get("item_id"),
             collection_id=data.get("collection_id"),
             unique_id=data["block_id"],
+            item_context=item_context,
         )
         block.update_from_web(data)
         return block
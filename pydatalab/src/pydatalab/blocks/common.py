@@ -1,13 +1,20 @@
-import base64
+import csv
 import io
+import os
 import warnings
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from PIL import Image
 
 from pydatalab.file_utils import get_file_info_by_id
 from pydatalab.logger import LOGGER
+from pydatalab.media import (
+    DERIVED_IMAGE_SIZES,
+    IMAGE_EXTENSIONS,
+    get_derived_image,
+    get_image_info,
+)
 
 from .base import DataBlock
 
@@ -34,24 +41,38 @@ class MediaBlock(DataBlock):
 
     @property
     def plot_functions(self):
-        return (self.encode_tiff,)
+        return (self.generate_derived_images,)
 
-    def encode_tiff(self):
+    def generate_derived_images(self):
+        """Prepare the web-resolution image and thumbnail of the selected page of an
+        image file, which are generated once per file revision and then served by URL.
+
+        """
+        # blocks saved before derived images were used may contain the whole image
+        self.data.pop("b64_encoded_image", None)
+        self.data["image_info"] = None
         if "file_id" not in self.data:
-            LOGGER.warning("ImageBlock.encode_tiff(): No file set in the DataBlock")
+            LOGGER.warning("MediaBlock.generate_derived_images(): No file set in the DataBlock")
             return
-        if "b64_encoded_image" not in self.data:
-            self.data["b64_encoded_image"] = {}
+
         file_info = get_file_info_by_id(self.data["file_id"], update_if_live=True)
-        if file_info["name"].endswith(".tif") or file_info["name"].endswith(".tiff"):
-            im = Image.open(file_info["location"])
-            LOGGER.warning("Making base64 encoding of tif")
-            with io.BytesIO() as f:
-                im.save(f, format="PNG")
-                f.seek(0)
-                self.data["b64_encoded_image"][self.data["file_id"]] = base64.b64encode(
-                    f.getvalue()
-                ).decode()
+        if os.path.splitext(file_info["name"])[-1].lower() not in IMAGE_EXTENSIONS:
+            return
+
+        info = get_image_info(file_info)
+        page = min(max(int(self.data.get("page") or 0), 0), info["num_pages"] - 1)
+        self.data["page"] = page
+        for kind in DERIVED_IMAGE_SIZES:
+            get_derived_image(file_info, kind, page=page)
+
+        self.data["image_info"] = {
+            "file_id": self.data["file_id"],
+            "revision": file_info.get("revision") or 1,
+            "num_pages": info["num_pages"],
+            "size": info["sizes"][page],
+            "web_size": DERIVED_IMAGE_SIZES["web"],
+            "tile_size": info["tile_size"],
+        }
 
 
 class TabularDataBlock(DataBlock):
@@ -65,65 +86,238 @@ class TabularDataBlock(DataBlock):
     description = "This block will load tabular data from common plain text files and allow you to create simple scatter plots of the columns within."
     accepted_file_extensions = (".csv", ".txt", ".tsv", ".dat")
 
+    max_plot_points: int = 10_000
+    """The maximum number of rows of the selected columns to send to the browser."""
+
     @property
     def plot_functions(self):
         return (self.plot_df,)
 
-    def _load(self) -> pd.DataFrame:
+    def _load(self) -> pd.DataFrame | None:
         if "file_id" not in self.data:
-            return
+            return None
 
         file_info = get_file_info_by_id(self.data["file_id"], update_if_live=True)
 
-        return self.load(file_info["location"])
+        df = self.load(file_info["location"], reload=False)
+
+        # column summaries only need to be recomputed when the file changes
+        revision = [file_info["location"], file_info.get("revision")]
+        if self.data.get("column_stats_revision") != revision:
+            self.data["column_stats"] = self.column_stats(df)
+            self.data["column_stats_revision"] = revision
+
+        return df
+
+    @staticmethod
+    def column_stats(df: pd.DataFrame) -> list[dict]:
+        """Summarise each column of the dataframe by its dtype, range and number of NaNs."""
+        stats = []
+        numeric = df.select_dtypes("number").columns
+        minima, maxima = df[numeric].min(), df[numeric].max()
+        nan_counts = df.isna().sum()
+        for column in df.columns:
+            stats.append(
+                {
+                    "name": column,
+                    "dtype": str(df[column].dtype),
+                    "min": float(minima[column])
+                    if column in numeric and pd.notna(minima[column])
+                    else None,
+                    "max": float(maxima[column])
+                    if column in numeric and pd.notna(maxima[column])
+                    else None,
+                    "nan_count": int(nan_counts[column]),
+                }
+            )
+        return stats
+
+    sniff_bytes: int = 64 * 1024
+    """The number of bytes at the start of a file used to detect its format."""
+
+    @staticmethod
+    def _is_number(field: str) -> bool:
+        try:
+            float(field)
+        except ValueError:
+            return False
+        return True
+
+    @staticmethod
+    def _split_fields(line: str, delimiter: str | None) -> list[str]:
+        if delimiter is None:
+            return line.split()
+        return next(csv.reader([line.rstrip()], delimiter=delimiter))
 
     @classmethod
-    def load(cls, location: Path) -> pd.DataFrame:
+    def sniff(cls, location: Path | str, min_rows: int = 5) -> dict:
+        """Detect the delimiter, preamble and header row of a delimited text file
+        from a bounded prefix of the file.
+
+        The delimiter is detected with `csv.Sniffer` on the end of the prefix, which is
+        most likely to contain data. The table is then taken to start at the first line
+        that begins a run of `min_rows` lines with the same number of fields as the data,
+        with any lines before it (e.g., instrument metadata or comments) skipped.
+
+        Parameters:
+            location: The location of the file to read.
+            min_rows: The number of consistent lines required to detect the start of the table.
+
+        Raises:
+            RuntimeError: if no tabular data could be found in the prefix.
+
+        Returns:
+            A dictionary with the `delimiter` (or `None` for whitespace), the number of
+            lines of preamble to skip (`skiprows`) and the `header` row, or `None` if
+            the table has no header.
+
+        """
+        with open(location, "rb") as f:
+            prefix = f.read(cls.sniff_bytes)
+            truncated = bool(f.read(1))
+
+        lines = prefix.decode("utf-8", errors="backslashreplace").splitlines()
+        if truncated and len(lines) > 1:
+            lines = lines[:-1]
+        data_lines = [line for line in lines if line.strip() and not line.startswith("#")]
+        if not data_lines:
+            raise RuntimeError(f"No tabular data found in the first {cls.sniff_bytes} bytes.")
+
+        tail = data_lines[-max(len(data_lines) // 2, 1) :][-100:]
         try:
+            delimiter = csv.Sniffer().sniff("\n".join(tail), delimiters=",;\t| ").delimiter
+        except csv.Error:
+            delimiter = None
+        if delimiter == " ":
+            delimiter = None
+
+        counts = [
+            len(cls._split_fields(line, delimiter))
+            if line.strip() and not line.startswith("#")
+            else 0
+            for line in lines
+        ]
+        num_fields = pd.Series([len(cls._split_fields(line, delimiter)) for line in tail]).mode()[0]
+
+        skiprows = 0
+        for skiprows in range(len(lines)):
+            run = counts[skiprows : skiprows + min_rows]
+            if run and all(count == num_fields for count in run):
+                break
+
+        # the first row is a header if it has text above a numeric column, or if
+        # `csv.Sniffer` otherwise detects a difference from the following rows
+        rows = [cls._split_fields(line, delimiter) for line in lines[skiprows : skiprows + 20]]
+        has_header = any(
+            not cls._is_number(field)
+            and any(len(row) > i and row[i].strip() for row in rows[1:])
+            and all(cls._is_number(row[i]) for row in rows[1:] if len(row) > i and row[i].strip())
+            for i, field in enumerate(rows[0])
+        )
+        if not has_header:
+            body = io.StringIO()
+            csv.writer(body).writerows(rows)
+            try:
+                has_header = csv.Sniffer().has_header(body.getvalue())
+            except csv.Error:
+                has_header = False
+
+        return {
+            "delimiter": delimiter,
+            "skiprows": skiprows,
+            "header": 0 if has_header else None,
+        }
+
+    @classmethod
+    def load(cls, location: Path | str, reload: bool = True) -> pd.DataFrame:
+        """Load a delimited text file with a single C-engine parse, using the format
+        detected by `sniff`.
+
+        Parameters:
+            location: The location of the file to read.
+            reload: Whether to reparse the file, or use the cached version, if it is
+                newer than the file itself.
+
+        Returns:
+            The parsed dataframe, with integer column names if the file has no header row.
+
+        """
+        cache_location = Path(location).with_suffix(".TABULAR.pkl")
+        if (
+            not reload
+            and cache_location.exists()
+            and cache_location.stat().st_mtime >= os.path.getmtime(location)
+        ):
+            return pd.read_pickle(cache_location)
+
+        try:
+            dialect = cls.sniff(location)
+            if dialect["skiprows"]:
+                warnings.warn(
+                    f"Skipping {dialect['skiprows']} lines of preamble in {Path(location).name}"
+                )
             df = pd.read_csv(
                 location,
-                sep=None,
+                sep=dialect["delimiter"] or r"\s+",
+                skiprows=dialect["skiprows"],
+                header=dialect["header"],
                 encoding_errors="backslashreplace",
-                skip_blank_lines=False,
-                engine="python",
+                engine="c",
             )
-
-            if df.isnull().values.any():
-                warnings.warn(
-                    "Loading file with less strict parser: columns were previously detected as {df.columns}"
-                )
-                df = pd.read_csv(
-                    location,
-                    sep=None,
-                    names=range(df.shape[1]),
-                    comment="#",
-                    header=None,
-                    encoding_errors="backslashreplace",
-                    skip_blank_lines=False,
-                    engine="python",
-                )
-                # Drop a row if entirety is NaN
-                df.dropna(axis=1, inplace=True)
+            # Drop any columns that are entirely NaN, e.g., from trailing delimiters
+            df.dropna(axis=1, how="all", inplace=True)
         except Exception as e:
             raise RuntimeError(f"`pandas.read_csv()` was not able to read the file. Error: {e}")
 
+        if not reload:
+            df.to_pickle(cache_location)
+
         return df
 
+    def _select_column(self, key: str, columns: list, default_index: int):
+        """Return the column selected in the block data under `key`, which may have been
+        stringified by the browser, or the column at `default_index`.
+
+        """
+        selected = self.data.get(key)
+        for column in columns:
+            if selected is not None and str(column) == str(selected):
+                return column
+        column = columns[min(default_index, len(columns) - 1)]
+        self.data[key] = column
+        return column
+
     def plot_df(self):
         import bokeh.embed
 
         from pydatalab.bokeh_plots import DATALAB_BOKEH_THEME, selectable_axes_plot
+        from pydatalab.utils import minmax_downsample_indices
 
         df = self._load()
         if df is None:
             return
         columns = list(df.columns)
+        x = self._select_column("x_column", columns, 0)
+        y = self._select_column("y_column", columns, 1)
+
+        # only the selected columns are sent to the browser, downsampled to the point budget
+        plot_df = df[list(dict.fromkeys([x, y]))]
+        if len(plot_df) > self.max_plot_points:
+            if pd.api.types.is_numeric_dtype(plot_df[y]):
+                indices = minmax_downsample_indices(
+                    plot_df[y].to_numpy(), self.max_plot_points // 2
+                )
+            else:
+                indices = np.linspace(0, len(plot_df) - 1, self.max_plot_points).astype(int)
+            plot_df = plot_df.iloc[indices]
+        self.data["num_plotted_points"] = len(plot_df)
+
+        # bokeh requires string column names, e.g., for files without a header row
+        plot_df = plot_df.rename(columns=str)
         plot = selectable_axes_plot(
-            df,
-            x_options=columns,
-            y_options=columns,
-            x_default=columns[0],
-            y_default=columns[1],
+            plot_df,
+            x_options=[str(x)],
+            y_options=[str(y)],
             plot_points=True,
             plot_line=False,
         )
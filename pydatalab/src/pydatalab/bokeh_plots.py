@@ -579,3 +579,71 @@ def double_axes_echem_plot(
         grid = [[p1], [xaxis_select], [yaxis_select]]
 
     return gridplot(grid, sizing_mode="scale_width", toolbar_location="below")
+
+
+def stacked_image_plot(
+    x: np.ndarray,
+    stacked: np.ndarray,
+    x_label: str,
+    y_label: str = "pattern",
+    z_label: str = "intensity",
+    labels: Optional[Sequence[str]] = None,
+    y: Optional[np.ndarray] = None,
+    palette: str = "Viridis256",
+    **kwargs,
+):
+    """Creates a heatmap of a series of 1D patterns that share an evenly-spaced x-grid,
+    as a single Bokeh image glyph.
+
+    Args:
+        x: The shared x-grid of the patterns.
+        stacked: A 2D array with shape (number of patterns, number of x points).
+        x_label: The label for the x-axis.
+        y_label: The label for the y-axis.
+        z_label: The label for the colour scale.
+        labels: Optional labels for each pattern, shown on the y-axis if there are few patterns.
+        y: Optional evenly-spaced y-values for each pattern, defaulting to the pattern index.
+        palette: The Bokeh palette to use for the colour scale.
+
+    Returns:
+        Bokeh figure
+
+    """
+    if y is None:
+        y = np.arange(stacked.shape[0])
+    dy = (y[-1] - y[0]) / (len(y) - 1) if len(y) > 1 else 1
+    dx = (x[-1] - x[0]) / (len(x) - 1) if len(x) > 1 else 1
+
+    p = figure(
+        sizing_mode="scale_width",
+        aspect_ratio=kwargs.pop("aspect_ratio", 1.5),
+        x_axis_label=x_label,
+        y_axis_label=y_label,
+        x_range=(x[0] - dx / 2, x[-1] + dx / 2),
+        y_range=(y[0] - dy / 2, y[-1] + dy / 2),
+        tools=TOOLS,
+        **kwargs,
+    )
+    p.toolbar.logo = "grey"
+
+    color_mapper = LinearColorMapper(
+        palette=palette, low=np.nanmin(stacked), high=np.nanmax(stacked), nan_color="white"
+    )
+    p.image(
+        image=[stacked],
+        x=x[0] - dx / 2,
+        y=y[0] - dy / 2,
+        dw=x[-1] - x[0] + dx,
+        dh=y[-1] - y[0] + dy,
+        color_mapper=color_mapper,
+    )
+    p.add_layout(ColorBar(color_mapper=color_mapper, title=z_label), "right")
+    p.add_tools(
+        HoverTool(tooltips=[(x_label, "$x{0.000}"), (y_label, "$y{0}"), (z_label, "@image")])
+    )
+
+    if labels is not None and len(labels) <= 20:
+        p.yaxis.ticker = list(y)
+        p.yaxis.major_label_overrides = {int(_y): str(label) for _y, label in zip(y, labels)}
+
+    return p
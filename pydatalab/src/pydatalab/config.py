@@ -4,7 +4,7 @@ import logging
 import os
 import platform
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Type, Union
+from typing import Any, Dict, List, Literal, Optional, Type, Union
 
 from pydantic import (
     AnyUrl,
@@ -151,6 +151,11 @@ class ServerConfig(BaseSettings):
         description="The path under which to place stored files uploaded to the server.",
     )
 
+    PREVIEW_WORKERS: int = Field(
+        2,
+        description="The number of background worker processes used to generate previews (thumbnails and sparkline plots) of files when they are uploaded or synced. If 0, previews are instead generated when they are first requested.",
+    )
+
     LOG_FILE: str | Path | None = Field(
         None,
         description="The path to the log file to use for the server and all associated processes (e.g., invoke tasks)",
@@ -191,6 +196,17 @@ class ServerConfig(BaseSettings):
         description="Whether the Flask app is being deployed behind a reverse proxy. If `True`, the reverse proxy middleware described in the [Flask docs](https://flask.palletsprojects.com/en/2.2.x/deploying/proxy_fix/) will be attached to the app.",
     )
 
+    FILE_SENDFILE_MODE: Optional[Literal["x-accel-redirect", "x-sendfile"]] = Field(
+        None,
+        description="""If set, stored files will not be sent by the API itself: the API will instead check permissions and conditional request headers, then hand the file over to the reverse proxy to serve (including any `Range` requests).
+Use `"x-accel-redirect"` for Nginx (see [`FILE_ACCEL_REDIRECT_PREFIX`][pydatalab.config.ServerConfig.FILE_ACCEL_REDIRECT_PREFIX]) or `"x-sendfile"` for Apache (mod_xsendfile) and lighttpd.""",
+    )
+
+    FILE_ACCEL_REDIRECT_PREFIX: str = Field(
+        "/_protected_files/",
+        description="When `FILE_SENDFILE_MODE` is `'x-accel-redirect'`, the internal Nginx location under which the `FILE_DIRECTORY` is served, i.e., the path of a stored file relative to `FILE_DIRECTORY` is appended to this prefix.",
+    )
+
     GITHUB_ORG_ALLOW_LIST: Optional[List[str]] = Field(
         [],
         description="A list of GitHub organization IDs (available from `https://api.github.com/orgs/<org_name>`, and are immutable) or organisation names (which can change, so be warned), that the membership of which will be required to register a new datalab account. Setting the value to `None` will allow any GitHub user to register an account.",
@@ -239,6 +255,16 @@ Warning: this value will overwrite any other values passed to `FLASK_MAX_CONTENT
 its importance when deploying a datalab instance.""",
     )
 
+    UPLOAD_CHUNK_SIZE: int = Field(
+        32 * 1000**2,
+        description="The maximum size, in bytes, of each chunk of a chunked file upload. Clients are asked to split files into chunks of this size, which must be smaller than `MAX_CONTENT_LENGTH` (and any request size limit of a reverse proxy).",
+    )
+
+    UPLOAD_EXPIRY_HOURS: int = Field(
+        24,
+        description="The number of hours after which incomplete chunked uploads that have received no new chunks are removed, along with their staged data.",
+    )
+
     BACKUP_STRATEGIES: Optional[dict[str, BackupStrategy]] = Field(
         {
             "daily-snapshots": BackupStrategy(
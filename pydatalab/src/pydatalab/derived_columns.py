@@ -0,0 +1,143 @@
+"""Named transforms that add derived columns (normalisations, baselines, etc.)
+to the dataframes loaded by spectroscopy/diffraction blocks.
+
+Transforms are only evaluated when their columns are requested, and their
+results are memoized in-process against a cache key that should identify the
+revision of the underlying file.
+
+"""
+
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+__all__ = (
+    "DerivedColumns",
+    "DerivedColumnRegistry",
+    "clear_derived_column_cache",
+    "get_file_revision_key",
+)
+
+_DERIVED_COLUMN_CACHE: "OrderedDict[Tuple[Hashable, str], Dict[str, np.ndarray]]" = OrderedDict()
+_DERIVED_COLUMN_CACHE_SIZE: int = 256
+
+
+def clear_derived_column_cache() -> None:
+    """Empties the in-process cache of derived columns."""
+    _DERIVED_COLUMN_CACHE.clear()
+
+
+def get_file_revision_key(file_info: Dict) -> Optional[Hashable]:
+    """Returns a key identifying the current revision of a file in the database,
+    or `None` if the file has no revision information.
+
+    """
+    if file_info.get("revision") is None:
+        return None
+    return (file_info["location"], file_info["revision"])
+
+
+class DerivedColumns:
+    """A named transform that computes one or more new columns from a dataframe.
+
+    Parameters:
+        name: A short, human-readable name for the transform (e.g., "median baseline").
+        columns: The names of the columns that the transform adds, which can be used to
+            request it. The columns actually added are those returned by `function`.
+        function: A callable that takes the dataframe and returns a dictionary
+            of column name to array.
+        expensive: Whether the transform should only be computed when explicitly requested.
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        columns: Iterable[str],
+        function: Callable[[pd.DataFrame], Dict[str, np.ndarray]],
+        expensive: bool = False,
+    ):
+        self.name = name
+        self.columns = tuple(columns)
+        self.function = function
+        self.expensive = expensive
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(name={self.name!r}, columns={self.columns!r})"
+
+
+class DerivedColumnRegistry:
+    """An ordered collection of derived-column transforms for a given block.
+
+    Transforms are applied in registration order, so later transforms may use
+    the columns created by earlier ones.
+
+    """
+
+    def __init__(self, *transforms: DerivedColumns):
+        self.transforms: Tuple[DerivedColumns, ...] = transforms
+
+    @property
+    def names(self) -> List[str]:
+        return [t.name for t in self.transforms]
+
+    @property
+    def optional_names(self) -> List[str]:
+        """The names of the expensive transforms that must be requested explicitly."""
+        return [t.name for t in self.transforms if t.expensive]
+
+    @property
+    def columns(self) -> List[str]:
+        return [c for t in self.transforms for c in t.columns]
+
+    def _select(self, requested: Optional[Iterable[str]]) -> List[DerivedColumns]:
+        if requested is None:
+            return [t for t in self.transforms if not t.expensive]
+        requested = set(requested)
+        return [
+            t
+            for t in self.transforms
+            if not t.expensive or t.name in requested or requested.intersection(t.columns)
+        ]
+
+    def add_columns(
+        self,
+        df: pd.DataFrame,
+        requested: Optional[Iterable[str]] = None,
+        cache_key: Optional[Hashable] = None,
+    ) -> List[str]:
+        """Adds the requested derived columns to the dataframe in place.
+
+        Cheap transforms are always applied; expensive transforms are only applied
+        if they are requested, either by transform name or by one of their column names.
+
+        Parameters:
+            df: The dataframe to add columns to.
+            requested: Transform or column names to compute in addition to the cheap defaults.
+            cache_key: A hashable key identifying the file revision that `df` was loaded from.
+                If provided, the computed columns will be memoized under this key.
+
+        Returns:
+            The names of the columns that were added, in registration order.
+
+        """
+        added: List[str] = []
+        for transform in self._select(requested):
+            key = (cache_key, transform.name)
+            result = _DERIVED_COLUMN_CACHE.get(key) if cache_key is not None else None
+            if result is None or any(len(v) != len(df) for v in result.values()):
+                result = {k: np.asarray(v) for k, v in transform.function(df).items()}
+                if cache_key is not None:
+                    _DERIVED_COLUMN_CACHE[key] = result
+                    while len(_DERIVED_COLUMN_CACHE) > _DERIVED_COLUMN_CACHE_SIZE:
+                        _DERIVED_COLUMN_CACHE.popitem(last=False)
+            elif cache_key is not None:
+                _DERIVED_COLUMN_CACHE.move_to_end(key)
+
+            for column, values in result.items():
+                df[column] = values
+                added.append(column)
+
+        return added
@@ -32,6 +32,15 @@ that you are allowed to make an account.
 """
 
 
+class InsufficientStorage(HTTPException):
+    """Raised when a file cannot be stored because there is not enough space
+    available on disk.
+    """
+
+    code = 507
+    description = "Insufficient space available on disk to store the file. Please contact your datalab administrator."
+
+
 def handle_http_exception(exc: HTTPException) -> Tuple[Response, int]:
     """Return a specific error message and status code if the exception stores them."""
     response = {
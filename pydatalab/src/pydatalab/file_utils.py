@@ -1,25 +1,41 @@
 import datetime
+import hashlib
 import os
 import pathlib
 import re
 import shutil
 import subprocess
-from typing import Any, Dict, Union
+from typing import Any, BinaryIO, Dict, Iterable, List, Union
 
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 from pymongo import ReturnDocument
 from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import BadRequest, Conflict, NotFound, RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
+from pydatalab.blobs import (
+    hash_file,
+    link_file_directory,
+    release_blob,
+    store_blob,
+    write_and_hash_stream,
+)
 from pydatalab.config import CONFIG, RemoteFilesystem
+from pydatalab.errors import InsufficientStorage
 from pydatalab.logger import LOGGER, logged_route
 from pydatalab.models import File
 from pydatalab.models.utils import PyObjectId
 from pydatalab.mongo import _get_active_mongo_client, flask_mongo
 from pydatalab.permissions import get_default_permissions
+from pydatalab.previews import queue_preview_generation
 
 LIVE_FILE_CUTOFF = datetime.timedelta(days=31)
 
+UPLOAD_STAGING_DIRECTORY = ".uploads"
+"""The directory, under `CONFIG.FILE_DIRECTORY`, in which new file contents (including
+chunked uploads) are staged, so that they can be moved into the blob store atomically."""
+
 
 def get_space_available_bytes() -> int:
     """For the configured file location, return the number of available bytes, as
@@ -181,14 +197,21 @@ def _check_and_sync_file(file_info: File, file_id: ObjectId) -> File:
         minutes=CONFIG.REMOTE_CACHE_MAX_AGE
     ):
         LOGGER.debug("Updating file %s to latest version", file_info.source_path)
+        if file_info.location is None:
+            raise RuntimeError(f"Attempted to sync file {file_id} with no local location")
 
+        staged = _get_staging_location()
         try:
-            _sync_file_with_remote(full_remote_path, file_info.location)
+            _sync_file_with_remote(full_remote_path, str(staged))
         except RuntimeError:
+            staged.unlink(missing_ok=True)
             LOGGER.warning(
                 "Unable to sync file %s with %s on server.", file_info.location, full_remote_path
             )
             return file_info
+        content_hash = _store_file(staged, file_info.location)
+        release_blob(file_info.content_hash)
+        file_info.content_hash = content_hash
 
     else:
         LOGGER.debug("File %s is recent enough, not updating", file_info.source_path)
@@ -211,6 +234,7 @@ def _check_and_sync_file(file_info: File, file_id: ObjectId) -> File:
                     ),
                     "last_modified_remote": remote_timestamp,
                     "is_live": is_live,
+                    "content_hash": file_info.content_hash,
                 },
                 "$inc": {"revision": 1},
             },
@@ -225,7 +249,9 @@ def _check_and_sync_file(file_info: File, file_id: ObjectId) -> File:
             )
             return file_info
 
-        return File(**updated_file_info)
+        updated_file_info = File(**updated_file_info)
+        queue_preview_generation(updated_file_info.dict())
+        return updated_file_info
 
     return file_info
 
@@ -271,11 +297,101 @@ def get_file_info_by_id(
 
 
 @logged_route
-def update_uploaded_file(file: FileStorage, file_id: ObjectId, size_bytes: int | None = None):
+def get_file_info_by_ids(
+    file_ids: Iterable[Union[str, ObjectId]], update_if_live: bool = True
+) -> List[Dict[str, Any]]:
+    """Query the files collection for several IDs at once, with a single query.
+
+    Arguments:
+        file_ids: The string or ObjectID representations of the file IDs.
+        update_if_live: Whether or not to update the stored files to a
+            newer version, if it exists.
+
+    Returns:
+        The stored file information for each file found in the database,
+        in the order that the IDs were given. Missing files are omitted.
+
+    """
+    file_ids = [ObjectId(file_id) for file_id in file_ids]
+    LOGGER.debug("getting files for file_ids: %s", file_ids)
+    files = {
+        doc["_id"]: File(**doc)
+        for doc in flask_mongo.db.files.find(
+            {"_id": {"$in": file_ids}, **get_default_permissions(user_only=False)}
+        )
+    }
+
+    file_infos = []
+    for file_id in file_ids:
+        if file_id not in files:
+            continue
+        file_info = files[file_id]
+        if update_if_live and file_info.is_live:
+            file_info = _check_and_sync_file(file_info, file_id)
+        file_infos.append(file_info.dict())
+
+    return file_infos
+
+
+def _get_staging_location() -> pathlib.Path:
+    """Returns a new location at which to stage file contents, on the same filesystem
+    as the file store.
+
+    """
+    directory = pathlib.Path(CONFIG.FILE_DIRECTORY) / UPLOAD_STAGING_DIRECTORY
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory / f"{ObjectId()}.part"
+
+
+def _store_file(file: FileStorage | pathlib.Path, location: str) -> str:
+    """Store the contents of an uploaded file in the content-addressed blob store, hashing
+    them as they are written, and link the file's directory to the blob. Files that have
+    already been staged on disk (e.g., completed chunked uploads) are hashed, then linked
+    into the store (or discarded, if their contents are already stored). A reference to the
+    blob is only taken once the file's directory has been linked to it.
+
+    Parameters:
+        file: The Flask file object in the request, or the location of staged contents.
+        location: The location of the file in the file store.
+
+    Returns:
+        The SHA-256 hash of the contents of the file.
+
+    """
+    if isinstance(file, pathlib.Path):
+        staged = file
+        content_hash = hash_file(staged)
+    else:
+        staged = _get_staging_location()
+        try:
+            content_hash, _ = write_and_hash_stream(file.stream, staged)
+        except Exception:
+            staged.unlink(missing_ok=True)
+            raise
+
+    try:
+        blob_directory = store_blob(staged, content_hash, os.path.basename(location))
+    except Exception:
+        if not isinstance(file, pathlib.Path):
+            staged.unlink(missing_ok=True)
+        raise
+
+    try:
+        link_file_directory(os.path.dirname(location), blob_directory)
+    except Exception:
+        release_blob(content_hash)
+        raise
+    return content_hash
+
+
+@logged_route
+def update_uploaded_file(
+    file: FileStorage | pathlib.Path, file_id: ObjectId, size_bytes: int | None = None
+):
     """Replace the file with the given `file_id` with the new file object from the request.
 
     Parameters:
-        file: The Flask file object in the request.
+        file: The Flask file object in the request, or the location of a staged chunked upload.
         file_id: The database ID of the file to update.
         size_bytes: A hint for the file size in bytes, will be used to verify ahead of time whether
 
@@ -302,33 +418,37 @@ def update_uploaded_file(file: FileStorage, file_id: ObjectId, size_bytes: int |
 
     updated_file_entry = File(**updated_file_entry)
 
-    # overwrite the old file with the new location
-    file.save(updated_file_entry.location)
+    # point the file at the new contents, then release the old ones
+    content_hash = _store_file(file, updated_file_entry.location)
+    release_blob(updated_file_entry.content_hash)
     size_bytes = os.path.getsize(updated_file_entry.location)
 
     file_collection.update_one(
-        {"_id": file_id, **get_default_permissions(user_only=False)}, {"$set": {"size": size_bytes}}
+        {"_id": file_id, **get_default_permissions(user_only=False)},
+        {"$set": {"size": size_bytes, "content_hash": content_hash}},
     )
 
     ret = updated_file_entry.dict()
-    ret.update({"_id": file_id})
+    ret.update({"_id": file_id, "content_hash": content_hash})
+    queue_preview_generation(ret)
     return ret
 
 
 @logged_route
 def save_uploaded_file(
-    file: FileStorage,
+    file: FileStorage | pathlib.Path,
     item_ids: list[str] | None = None,
     block_ids: list[str] | None = None,
     last_modified: datetime.datetime | str | None = None,
     size_bytes: int | None = None,
     creator_ids: list[PyObjectId | str] | None = None,
+    filename: str | None = None,
 ) -> dict:
     """Attempt to save a copy of the file object from the request in the file store, and
     add its metadata to the database.
 
     Parameters:
-        file: The flask file object in the request.
+        file: The flask file object in the request, or the location of a staged chunked upload.
         item_ids: The item IDs to attempt to attach the file to.
         block_ids: The block IDs to attempt to attach the file to.
         last_modified: An isoformat datetime for to track as the last time the filed was modified
@@ -337,6 +457,8 @@ def save_uploaded_file(
             the file can be saved.
         creator_ids: A list of IDs for users who will be registered as the creator of this file,
             i.e., retaining write access.
+        filename: The name of the file, if different to that of the file object
+            (required for staged uploads).
 
     Returns:
         A dictionary containing the saved metadata for the file.
@@ -357,11 +479,12 @@ def save_uploaded_file(
         ):
             raise ValueError(f"item_id is invalid: {item_id}")
 
-    if file.filename is None:
+    original_name: str | None = filename or getattr(file, "filename", None)
+    if not original_name:
         raise RuntimeError("Filename is missing.")
 
-    filename = secure_filename(file.filename)
-    extension = os.path.splitext(filename)[1]
+    stored_name = secure_filename(original_name)
+    extension = os.path.splitext(stored_name)[1]
 
     if isinstance(last_modified, datetime.datetime):
         last_modified = last_modified.isoformat()
@@ -370,8 +493,8 @@ def save_uploaded_file(
         last_modified = datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
 
     new_file_document = File(
-        name=filename,
-        original_name=file.filename,  # not escaped
+        name=stored_name,
+        original_name=original_name,  # not escaped
         location=None,  # file storage location in datalab. Important! will be filled in below
         url_path=None,  # the url used to access this file. Important! will be filled in below
         extension=extension,
@@ -410,9 +533,8 @@ def save_uploaded_file(
         inserted_id = result.inserted_id
 
         new_directory = os.path.join(CONFIG.FILE_DIRECTORY, str(inserted_id))
-        file_location = os.path.join(new_directory, filename)
-        pathlib.Path(new_directory).mkdir(exist_ok=False)
-        file.save(file_location)
+        file_location = os.path.join(new_directory, stored_name)
+        content_hash = _store_file(file, file_location)
 
     updated_file_entry = flask_mongo.db.files.find_one_and_update(
         {"_id": inserted_id, **get_default_permissions(user_only=False)},
@@ -420,6 +542,7 @@ def save_uploaded_file(
             "$set": {
                 "location": file_location,
                 "size": os.path.getsize(file_location),
+                "content_hash": content_hash,
             }
         },
         return_document=ReturnDocument.AFTER,
@@ -440,9 +563,284 @@ def save_uploaded_file(
 
     ret = updated_file_entry.dict()
     ret.update({"_id": inserted_id})
+    queue_preview_generation(ret)
     return ret
 
 
+_UPLOAD_WRITE_BLOCK_SIZE = 1024**2
+_UPLOAD_LEASE = datetime.timedelta(minutes=10)
+
+
+def _get_staged_upload_location(upload_id: ObjectId) -> pathlib.Path:
+    return pathlib.Path(CONFIG.FILE_DIRECTORY) / UPLOAD_STAGING_DIRECTORY / f"{upload_id}.part"
+
+
+def _remove_expired_uploads() -> None:
+    """Remove any chunked uploads that have not received a chunk within the configured
+    expiry time, along with their staged data.
+
+    """
+    cutoff = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(
+        hours=CONFIG.UPLOAD_EXPIRY_HOURS
+    )
+    for upload in flask_mongo.db.uploads.find({"last_modified": {"$lt": cutoff}}, {"_id": 1}):
+        LOGGER.debug("Removing expired chunked upload %s", upload["_id"])
+        _get_staged_upload_location(upload["_id"]).unlink(missing_ok=True)
+        flask_mongo.db.uploads.delete_one({"_id": upload["_id"]})
+
+
+def _get_chunked_upload(upload_id: ObjectId | str) -> dict:
+    try:
+        upload_id = ObjectId(upload_id)
+    except InvalidId:
+        raise NotFound(f"No upload found with ID {upload_id!r}")
+    upload = flask_mongo.db.uploads.find_one(
+        {"_id": upload_id, **get_default_permissions(user_only=True)}
+    )
+    if upload is None:
+        raise NotFound(f"No upload found with ID {upload_id!r}")
+    return upload
+
+
+def _lease_upload(upload_id: ObjectId, received: int) -> dict:
+    """Take a lease on an upload that has received the given number of bytes, so that
+    only one request writes to (or finalizes) it at a time. Leases of requests that
+    died part-way through expire after `_UPLOAD_LEASE`.
+
+    """
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    upload = flask_mongo.db.uploads.find_one_and_update(
+        {
+            "_id": upload_id,
+            "received": received,
+            "$or": [{"writing_since": None}, {"writing_since": {"$lt": now - _UPLOAD_LEASE}}],
+        },
+        {"$set": {"writing_since": now}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if upload is None:
+        raise Conflict("Another request is currently writing to this upload")
+    return upload
+
+
+def _release_upload(upload_id: ObjectId) -> None:
+    flask_mongo.db.uploads.update_one({"_id": upload_id}, {"$set": {"writing_since": None}})
+
+
+def _upload_status(upload: dict) -> dict:
+    return {
+        "upload_id": str(upload["_id"]),
+        "filename": upload["filename"],
+        "size": upload["size"],
+        "received": upload["received"],
+        "chunk_size": upload["chunk_size"],
+        "replace_file": str(upload["replace_file"]) if upload["replace_file"] else None,
+    }
+
+
+@logged_route
+def create_chunked_upload(
+    filename: str,
+    size_bytes: int,
+    item_ids: list[str] | None = None,
+    replace_file: ObjectId | None = None,
+    last_modified: datetime.datetime | str | None = None,
+    creator_ids: list[PyObjectId | str] | None = None,
+) -> dict:
+    """Begin a chunked upload, which is staged on disk chunk-by-chunk by `write_upload_chunk`
+    and then added to the file store by `finalize_chunked_upload`.
+
+    The size of the file is checked up front against the maximum file size and the
+    space available on disk (less that reserved by other incomplete uploads), so that
+    large uploads are refused before any data is sent.
+
+    Parameters:
+        filename: The name of the file being uploaded.
+        size_bytes: The total size of the file in bytes.
+        item_ids: The item IDs to attach the file to.
+        replace_file: The database ID of an existing file to replace with a new revision.
+        last_modified: An isoformat datetime to track as the last time the file was modified.
+        creator_ids: A list of IDs for users who will be registered as the creator of this file.
+
+    Returns:
+        The status of the upload, including its ID and the size of chunk to send.
+
+    """
+    if not filename or not secure_filename(filename):
+        raise BadRequest(f"Invalid filename {filename!r}")
+    if size_bytes < 0:
+        raise BadRequest(f"Invalid file size {size_bytes}")
+    if size_bytes > CONFIG.MAX_CONTENT_LENGTH:
+        raise RequestEntityTooLarge()
+
+    if replace_file is not None:
+        if not flask_mongo.db.files.find_one(
+            {"_id": replace_file, **get_default_permissions(user_only=False)}, {"_id": 1}
+        ):
+            raise NotFound(f"No file found with ID {replace_file}")
+        item_ids = []
+    for item_id in item_ids or []:
+        if not flask_mongo.db.items.find_one(
+            {"item_id": item_id, **get_default_permissions(user_only=True)}, {"_id": 1}
+        ):
+            raise BadRequest(f"item_id is invalid: {item_id}")
+
+    _remove_expired_uploads()
+
+    reserved = sum(
+        upload["size"] - upload["received"]
+        for upload in flask_mongo.db.uploads.find({}, {"size": 1, "received": 1})
+    )
+    if get_space_available_bytes() - reserved < size_bytes:
+        raise InsufficientStorage(
+            f"Cannot store file: insufficient space available on disk (required: {size_bytes / 1024**3:.2f} GB). Please contact your datalab administrator."
+        )
+
+    if isinstance(last_modified, datetime.datetime):
+        last_modified = last_modified.isoformat()
+
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    upload = {
+        "filename": filename,
+        "size": size_bytes,
+        "received": 0,
+        "chunk_size": min(CONFIG.UPLOAD_CHUNK_SIZE, CONFIG.MAX_CONTENT_LENGTH),
+        "chunks": [],
+        "item_ids": item_ids or [],
+        "replace_file": replace_file,
+        "file_last_modified": last_modified,
+        "creator_ids": creator_ids if creator_ids is not None else [],
+        "time_added": now,
+        "last_modified": now,
+        "writing_since": None,
+    }
+    upload["_id"] = flask_mongo.db.uploads.insert_one(upload).inserted_id
+
+    location = _get_staged_upload_location(upload["_id"])
+    location.parent.mkdir(exist_ok=True)
+    location.touch()
+
+    return _upload_status(upload)
+
+
+def get_chunked_upload_status(upload_id: ObjectId | str) -> dict:
+    """Returns the status of a chunked upload, including the number of bytes received,
+    from which an interrupted upload should be resumed.
+
+    """
+    return _upload_status(_get_chunked_upload(upload_id))
+
+
+@logged_route
+def write_upload_chunk(
+    upload_id: ObjectId | str, offset: int, stream: BinaryIO, sha256: str | None
+) -> dict:
+    """Stream a chunk of a chunked upload into its staged file, verifying its checksum.
+
+    Chunks must be sent in order, i.e., `offset` must equal the number of bytes received
+    so far; a chunk that fails verification can be resent at the same offset.
+
+    Parameters:
+        upload_id: The ID returned by `create_chunked_upload`.
+        offset: The position of the chunk in the file, in bytes.
+        stream: The body of the request containing the chunk.
+        sha256: The hex-encoded SHA-256 digest of the chunk.
+
+    Returns:
+        The status of the upload.
+
+    """
+    upload = _get_chunked_upload(upload_id)
+    if not sha256:
+        raise BadRequest("A SHA-256 checksum of the chunk is required")
+    if offset != upload["received"]:
+        raise Conflict(
+            f"Chunk offset {offset} does not match the {upload['received']} bytes received so far"
+        )
+
+    upload = _lease_upload(upload["_id"], offset)
+
+    written = 0
+    digest = hashlib.sha256()
+    try:
+        max_length = min(upload["chunk_size"], upload["size"] - offset)
+        with open(_get_staged_upload_location(upload["_id"]), "r+b") as f:
+            # discard any partial data from previous failed attempts at this chunk
+            f.truncate(offset)
+            f.seek(offset)
+            while block := stream.read(_UPLOAD_WRITE_BLOCK_SIZE):
+                written += len(block)
+                if written > max_length:
+                    raise BadRequest(
+                        f"Chunk exceeds the maximum chunk size or the remaining size of the file ({max_length} bytes)"
+                    )
+                digest.update(block)
+                f.write(block)
+
+        if digest.hexdigest() != sha256.lower():
+            raise BadRequest("Chunk checksum does not match; please resend the chunk")
+
+        upload = flask_mongo.db.uploads.find_one_and_update(
+            {"_id": upload["_id"], "received": offset},
+            {
+                "$set": {
+                    "received": offset + written,
+                    "last_modified": datetime.datetime.now(tz=datetime.timezone.utc),
+                    "writing_since": None,
+                },
+                "$push": {"chunks": {"offset": offset, "size": written, "sha256": sha256}},
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+    except Exception:
+        _release_upload(upload["_id"])
+        raise
+
+    return _upload_status(upload)
+
+
+@logged_route
+def finalize_chunked_upload(upload_id: ObjectId | str) -> dict:
+    """Once all chunks have been received, atomically move the staged file into the file
+    store as a new file (or a new revision of the file it replaces).
+
+    Returns:
+        A dictionary containing the saved metadata for the file.
+
+    """
+    upload = _get_chunked_upload(upload_id)
+    if upload["received"] != upload["size"]:
+        raise Conflict(f"Only {upload['received']} of {upload['size']} bytes have been received")
+
+    # claim the upload, so that it can only be finalized once
+    upload = _lease_upload(upload["_id"], upload["size"])
+    staged = _get_staged_upload_location(upload["_id"])
+    try:
+        if upload["replace_file"] is not None:
+            file_information = update_uploaded_file(staged, upload["replace_file"])
+        else:
+            file_information = save_uploaded_file(
+                staged,
+                item_ids=upload["item_ids"],
+                last_modified=upload["file_last_modified"],
+                creator_ids=upload["creator_ids"],
+                filename=upload["filename"],
+            )
+    except Exception:
+        _release_upload(upload["_id"])
+        raise
+
+    flask_mongo.db.uploads.delete_one({"_id": upload["_id"]})
+    return file_information
+
+
+def abort_chunked_upload(upload_id: ObjectId | str) -> None:
+    """Cancel a chunked upload and remove its staged data."""
+    upload = _get_chunked_upload(upload_id)
+    flask_mongo.db.uploads.delete_one({"_id": upload["_id"]})
+    _get_staged_upload_location(upload["_id"]).unlink(missing_ok=True)
+
+
 def add_file_from_remote_directory(
     file_entry: dict,
     item_id: str,
@@ -522,8 +920,13 @@ def add_file_from_remote_directory(
 
     new_directory = os.path.join(CONFIG.FILE_DIRECTORY, str(inserted_id))
     new_file_location = os.path.join(new_directory, filename)
-    pathlib.Path(new_directory).mkdir(exist_ok=True)
-    _sync_file_with_remote(full_remote_path, new_file_location)
+    staged = _get_staging_location()
+    try:
+        _sync_file_with_remote(full_remote_path, str(staged))
+    except Exception:
+        staged.unlink(missing_ok=True)
+        raise
+    content_hash = _store_file(staged, new_file_location)
 
     updated_file_entry = file_collection.find_one_and_update(
         {"_id": inserted_id, **get_default_permissions(user_only=False)},
@@ -531,6 +934,7 @@ def add_file_from_remote_directory(
             "$set": {
                 "location": new_file_location,
                 "url_path": new_file_location,
+                "content_hash": content_hash,
             }
         },
         return_document=ReturnDocument.AFTER,
@@ -545,6 +949,7 @@ def add_file_from_remote_directory(
             f"db operation failed when trying to insert new file ObjectId into sample: {item_id}"
         )
 
+    queue_preview_generation(updated_file_entry)
     return updated_file_entry
 
 
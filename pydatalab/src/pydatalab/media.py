@@ -0,0 +1,243 @@
+"""Web-resolution images, thumbnails and tiles derived from uploaded image files.
+
+Derived images are generated on first use for each revision of a file, and are stored
+in a directory alongside the original, so that the original (which may be a large,
+high bit-depth or multi-page TIFF) never needs to be sent to the browser. Pages of
+multi-page files are only decoded when they are first requested.
+
+"""
+
+import json
+import math
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+import numpy as np
+from PIL import Image, ImageSequence, features
+
+from pydatalab.logger import LOGGER
+
+__all__ = (
+    "IMAGE_EXTENSIONS",
+    "DERIVED_IMAGE_SIZES",
+    "TILE_SIZE",
+    "DERIVED_IMAGE_FORMAT",
+    "get_derived_directory",
+    "prepare_derived_directory",
+    "get_image_info",
+    "get_derived_image",
+    "get_image_tile",
+)
+
+IMAGE_EXTENSIONS: Tuple[str, ...] = (".png", ".jpeg", ".jpg", ".tif", ".tiff")
+"""The extensions of files for which derived images can be generated."""
+
+DERIVED_IMAGE_SIZES: Dict[str, int] = {"web": 2048, "thumbnail": 256}
+"""The maximum width and height, in pixels, of each kind of derived image."""
+
+TILE_SIZE: int = 512
+"""The width and height, in pixels, of the full-resolution tiles of large images."""
+
+DERIVED_IMAGE_FORMAT: str = "WEBP" if features.check("webp") else "PNG"
+"""The format in which derived images are stored and served."""
+
+_EXTENSIONS = {"WEBP": "webp", "PNG": "png"}
+
+
+def get_derived_directory(file_info: Dict[str, Any]) -> Path:
+    """Returns the directory of derived images for the current revision of the file.
+
+    Files stored in the blob store (see `pydatalab.blobs`) are keyed by their content
+    hash, so that derived images are shared between all files with the same contents;
+    older files are keyed by their revision.
+
+    """
+    base = Path(file_info["location"]).with_suffix(".DERIVED")
+    if file_info.get("content_hash"):
+        return base / f"sha256-{file_info['content_hash'][:16]}"
+    return base / f"r{file_info.get('revision') or 1}"
+
+
+def prepare_derived_directory(file_info: Dict[str, Any]) -> Path:
+    """Creates the directory of derived images for the current revision of the file,
+    removing those of any older revisions.
+
+    """
+    directory = get_derived_directory(file_info)
+    for old in directory.parent.glob("r*"):
+        if old != directory:
+            shutil.rmtree(old, ignore_errors=True)
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+
+def _atomic_save(image: Image.Image, path: Path, **kwargs) -> None:
+    """Saves an image via a temporary file, so that concurrent requests never
+    see a partially written file.
+
+    """
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix=path.suffix, delete=False) as f:
+        try:
+            image.save(f, format=DERIVED_IMAGE_FORMAT, **kwargs)
+        except Exception:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+def _to_display_image(image: Image.Image) -> Image.Image:
+    """Converts an image into an 8-bit mode that can be saved in the derived image format,
+    rescaling high bit-depth and floating point images between their 0.5th and
+    99.5th percentiles.
+
+    """
+    if image.mode in ("L", "LA", "RGB", "RGBA"):
+        return image
+    if image.mode in ("1", "P", "PA"):
+        return image.convert("RGBA" if "transparency" in image.info else "RGB")
+    if image.mode.startswith("I") or image.mode == "F":
+        array = np.asarray(image, dtype=np.float32)
+        finite = array[np.isfinite(array)]
+        if not finite.size:
+            return Image.new("L", image.size)
+        percentiles = np.asarray(np.percentile(finite, (0.5, 99.5)))
+        lower, upper = float(percentiles[0]), float(percentiles[1])
+        scaled = (np.nan_to_num(array, nan=lower) - lower) / max(upper - lower, 1e-12)
+        return Image.fromarray((np.clip(scaled, 0, 1) * 255).astype(np.uint8), mode="L")
+    return image.convert("RGB")
+
+
+def get_image_info(file_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the number of pages in an image file and the (width, height) of each page,
+    without decoding any pixel data, caching the result for the current revision of the file.
+    Any derived images of older revisions are removed.
+
+    Parameters:
+        file_info: The file document, as returned by `get_file_info_by_id`.
+
+    Returns:
+        A dictionary with the `num_pages`, the page `sizes`, the `tile_size` and the
+        `format` of the derived images.
+
+    """
+    directory = get_derived_directory(file_info)
+    info_location = directory / "info.json"
+    if info_location.exists():
+        return json.loads(info_location.read_text())
+
+    with Image.open(file_info["location"]) as image:
+        sizes = [list(page.size) for page in ImageSequence.Iterator(image)]
+
+    info = {
+        "num_pages": len(sizes),
+        "sizes": sizes,
+        "tile_size": TILE_SIZE,
+        "format": DERIVED_IMAGE_FORMAT.lower(),
+    }
+
+    prepare_derived_directory(file_info)
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as f:
+        json.dump(info, f)
+    os.replace(f.name, info_location)
+    return info
+
+
+def get_derived_image(file_info: Dict[str, Any], kind: str, page: int = 0) -> Path:
+    """Returns the location of a derived image of a page of an image file,
+    generating it if it does not yet exist for the current revision of the file.
+
+    Parameters:
+        file_info: The file document, as returned by `get_file_info_by_id`.
+        kind: The kind of derived image, one of `DERIVED_IMAGE_SIZES`.
+        page: The page of a multi-page file.
+
+    Raises:
+        ValueError: if the kind or page is not valid for the file.
+
+    Returns:
+        The location of the derived image.
+
+    """
+    if kind not in DERIVED_IMAGE_SIZES:
+        raise ValueError(f"Unknown derived image {kind!r}, must be one of {DERIVED_IMAGE_SIZES}")
+    info = get_image_info(file_info)
+    if not 0 <= page < info["num_pages"]:
+        raise ValueError(f"Page {page} out of range for file with {info['num_pages']} pages")
+
+    path = get_derived_directory(file_info) / f"{kind}-{page}.{_EXTENSIONS[DERIVED_IMAGE_FORMAT]}"
+    if path.exists():
+        return path
+
+    LOGGER.debug("Generating %s image of page %s of %s", kind, page, file_info["location"])
+    size = DERIVED_IMAGE_SIZES[kind]
+    with Image.open(file_info["location"]) as image:
+        image.seek(page)
+        if image.mode in ("L", "RGB") and image.format == "JPEG":
+            # decode JPEGs at a reduced scale where possible
+            image.draft(image.mode, (size, size))
+        display = _to_display_image(image)
+        display.thumbnail((size, size), reducing_gap=3.0)
+        _atomic_save(display, path, quality=90)
+    return path
+
+
+def get_image_tile(file_info: Dict[str, Any], page: int, column: int, row: int) -> Path:
+    """Returns the location of a full-resolution tile of a page of an image file.
+
+    All tiles of a page are generated together on first request, so each page is
+    decoded at full resolution at most once per revision.
+
+    Parameters:
+        file_info: The file document, as returned by `get_file_info_by_id`.
+        page: The page of a multi-page file.
+        column: The column of the tile, in units of `TILE_SIZE`.
+        row: The row of the tile, in units of `TILE_SIZE`.
+
+    Raises:
+        ValueError: if the page or tile is out of range.
+
+    Returns:
+        The location of the tile.
+
+    """
+    info = get_image_info(file_info)
+    if not 0 <= page < info["num_pages"]:
+        raise ValueError(f"Page {page} out of range for file with {info['num_pages']} pages")
+    width, height = info["sizes"][page]
+    num_columns, num_rows = math.ceil(width / TILE_SIZE), math.ceil(height / TILE_SIZE)
+    if not (0 <= column < num_columns and 0 <= row < num_rows):
+        raise ValueError(f"Tile ({column}, {row}) out of range ({num_columns}, {num_rows})")
+
+    directory = get_derived_directory(file_info) / f"tiles-{page}"
+    path = directory / f"{column}-{row}.{_EXTENSIONS[DERIVED_IMAGE_FORMAT]}"
+    if directory.exists():
+        return path
+
+    LOGGER.debug("Generating tiles of page %s of %s", page, file_info["location"])
+    staging = Path(tempfile.mkdtemp(dir=directory.parent, prefix=".tiles-"))
+    try:
+        with Image.open(file_info["location"]) as image:
+            image.seek(page)
+            display = _to_display_image(image)
+            for i in range(num_columns):
+                for j in range(num_rows):
+                    left, top = i * TILE_SIZE, j * TILE_SIZE
+                    tile = display.crop(
+                        (left, top, min(left + TILE_SIZE, width), min(top + TILE_SIZE, height))
+                    )
+                    tile.save(
+                        staging / f"{i}-{j}.{_EXTENSIONS[DERIVED_IMAGE_FORMAT]}",
+                        format=DERIVED_IMAGE_FORMAT,
+                        quality=90,
+                    )
+        os.rename(staging, directory)
+    except OSError:
+        # another request generated the tiles first
+        if not directory.exists():
+            raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return path
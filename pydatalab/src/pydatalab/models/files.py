@@ -30,6 +30,10 @@ class File(Entry, HasOwner, HasRevisionControl):
 
     location: Optional[str] = Field(description="The location of the file on disk.")
 
+    content_hash: Optional[str] = Field(
+        description="The SHA-256 hash of the contents of the file, under which they are stored."
+    )
+
     url_path: Optional[str] = Field(description="The path to a remote file.")
 
     source: Optional[str] = Field(
@@ -0,0 +1,304 @@
+"""Small previews of stored files, for display in file listings without loading the originals.
+
+Images are previewed by their thumbnail (see `pydatalab.media`), and recognised data files
+(XRD patterns, Raman spectra and electrochemical cycling data) by a sparkline plot of their
+main signal. Previews are generated for each revision of a file on a background worker pool
+when the file is uploaded or synced, and are stored in the same directory as the other
+derived images of that revision. Files for which no preview can be generated are marked as
+such, so that they are not reparsed on every request. Queued previews are also marked in
+that directory until they are generated, so that every server process (not only the one
+that queued the job) can report them as pending instead of generating them again.
+
+"""
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from pydatalab.config import CONFIG
+from pydatalab.logger import LOGGER
+from pydatalab.media import (
+    _EXTENSIONS,
+    DERIVED_IMAGE_FORMAT,
+    IMAGE_EXTENSIONS,
+    _atomic_save,
+    get_derived_directory,
+    get_derived_image,
+    prepare_derived_directory,
+)
+from pydatalab.utils import minmax_downsample_indices
+
+__all__ = (
+    "SPARKLINE_SIZE",
+    "PREVIEW_PENDING_TIMEOUT",
+    "PREVIEW_LOADERS",
+    "generate_preview",
+    "get_preview",
+    "is_preview_pending",
+    "queue_preview_generation",
+)
+
+SPARKLINE_SIZE: Tuple[int, int] = (256, 96)
+"""The (width, height), in pixels, of the sparkline previews of data files."""
+
+SPARKLINE_COLOR: Tuple[int, int, int] = (0, 65, 117)
+"""The colour of the sparkline."""
+
+_SUPERSAMPLING = 4
+_NO_PREVIEW_MARKER = "preview.none"
+_PENDING_MARKER = "preview.pending"
+
+PREVIEW_PENDING_TIMEOUT: float = 600
+"""The time, in seconds, after which a queued preview that has still not been generated
+(e.g., because its worker process died) is instead generated on request."""
+
+_PREVIEW_POOL: Optional[ProcessPoolExecutor] = None
+"""A lazily-created pool of worker processes used to generate previews."""
+
+_PREVIEW_JOBS: Dict[Tuple[str, int], Future] = {}
+"""The preview jobs submitted to the worker pool, keyed by file location and revision."""
+
+
+def _load_xrd(location: str) -> Tuple[np.ndarray, np.ndarray]:
+    from pydatalab.apps.xrd.utils import load_pattern_file
+
+    df = load_pattern_file(location, reload=False)
+    return df["twotheta"].to_numpy(), df["intensity"].to_numpy()
+
+
+def _load_raman(location: str) -> Tuple[np.ndarray, np.ndarray]:
+    from pydatalab.apps.raman.utils import load_wdf, read_raman_txt
+
+    if location.lower().endswith(".wdf"):
+        wdf = load_wdf(location)
+        return np.asarray(wdf["wavenumber"]), np.asarray(wdf["intensity"])
+
+    df, _, vendor = read_raman_txt(location)
+    if df is None or vendor is None:
+        raise ValueError("Not a recognised Raman spectrum")
+    return df["wavenumber"].to_numpy(), df["intensity"].to_numpy()
+
+
+def _load_echem(location: str) -> Tuple[np.ndarray, np.ndarray]:
+    from pydatalab.apps.echem.utils import load_echem_file
+
+    raw_df, _, _ = load_echem_file(location, reload=False)
+    return raw_df["Time"].to_numpy(), raw_df["Voltage"].to_numpy()
+
+
+PREVIEW_LOADERS: Dict[str, Tuple[Callable[[str], Tuple[np.ndarray, np.ndarray]], ...]] = {
+    ".xrdml": (_load_xrd,),
+    ".xy": (_load_xrd,),
+    ".xye": (_load_xrd,),
+    ".dat": (_load_xrd,),
+    ".wdf": (_load_raman,),
+    ".txt": (_load_raman, _load_echem),
+    ".mpr": (_load_echem,),
+    ".res": (_load_echem,),
+    ".nda": (_load_echem,),
+    ".ndax": (_load_echem,),
+    ".xls": (_load_echem,),
+    ".xlsx": (_load_echem,),
+}
+"""The functions used to load the (x, y) data plotted in the sparkline preview of each
+file extension. Where several apps share an extension, each loader is tried in turn,
+from the cheapest to the most expensive to attempt.
+
+"""
+
+
+def _draw_sparkline(x: np.ndarray, y: np.ndarray) -> Image.Image:
+    """Draws a minimal line plot of `y` against `x`, with no axes, on a transparent
+    background, downsampled so that peaks remain visible.
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y = x[finite], y[finite]
+    if len(x) < 2:
+        raise ValueError("Not enough finite data points to plot")
+
+    order = np.argsort(x, kind="stable")
+    x, y = x[order], y[order]
+    indices = minmax_downsample_indices(y, SPARKLINE_SIZE[0])
+    x, y = x[indices], y[indices]
+
+    width, height = (dim * _SUPERSAMPLING for dim in SPARKLINE_SIZE)
+    margin = 2 * _SUPERSAMPLING
+    x_range = (x.max() - x.min()) or 1.0
+    y_range = (y.max() - y.min()) or 1.0
+    px = margin + (x - x.min()) / x_range * (width - 2 * margin)
+    py = height - margin - (y - y.min()) / y_range * (height - 2 * margin)
+
+    image = Image.new("RGBA", (width, height), (255, 255, 255, 0))
+    ImageDraw.Draw(image).line(
+        list(zip(px.tolist(), py.tolist())),
+        fill=SPARKLINE_COLOR + (255,),
+        width=2 * _SUPERSAMPLING,
+        joint="curve",
+    )
+    return image.resize(SPARKLINE_SIZE, Image.Resampling.LANCZOS)
+
+
+def _get_preview_location(file_info: Dict[str, Any]) -> Path:
+    return get_derived_directory(file_info) / f"preview.{_EXTENSIONS[DERIVED_IMAGE_FORMAT]}"
+
+
+def _get_extension(file_info: Dict[str, Any]) -> str:
+    return os.path.splitext(file_info.get("name") or file_info["location"])[-1].lower()
+
+
+def generate_preview(file_info: Dict[str, Any]) -> Optional[Path]:
+    """Generates the preview of the current revision of a file, if it does not exist,
+    and clears any marker that it is pending.
+
+    Parameters:
+        file_info: The file document (or at least its `location`, `revision`, `name`
+            and `content_hash`).
+
+    Returns:
+        The location of the preview, or `None` if no preview could be generated.
+
+    """
+    try:
+        return _generate_preview(file_info)
+    finally:
+        (get_derived_directory(file_info) / _PENDING_MARKER).unlink(missing_ok=True)
+
+
+def _generate_preview(file_info: Dict[str, Any]) -> Optional[Path]:
+    extension = _get_extension(file_info)
+    if extension in IMAGE_EXTENSIONS:
+        try:
+            return get_derived_image(file_info, "thumbnail")
+        except Exception as exc:
+            LOGGER.debug("Unable to generate thumbnail of %s: %s", file_info["location"], exc)
+            return None
+
+    loaders = PREVIEW_LOADERS.get(extension)
+    if not loaders:
+        return None
+
+    directory = get_derived_directory(file_info)
+    path = _get_preview_location(file_info)
+    if path.exists():
+        return path
+    if (directory / _NO_PREVIEW_MARKER).exists():
+        return None
+
+    directory = prepare_derived_directory(file_info)
+    for loader in loaders:
+        try:
+            image = _draw_sparkline(*loader(file_info["location"]))
+        except Exception as exc:
+            LOGGER.debug("Unable to preview %s with %s: %s", file_info["location"], loader, exc)
+            continue
+        _atomic_save(image, path)
+        return path
+
+    (directory / _NO_PREVIEW_MARKER).touch()
+    return None
+
+
+def _has_preview_generator(file_info: Dict[str, Any]) -> bool:
+    extension = _get_extension(file_info)
+    return extension in IMAGE_EXTENSIONS or extension in PREVIEW_LOADERS
+
+
+def queue_preview_generation(file_info: Dict[str, Any]) -> Optional[Future]:
+    """Submit a job to generate the preview of the current revision of a file on the
+    background worker pool, unless a job for the same revision has already been submitted.
+    Does nothing if the background pool is disabled (`CONFIG.PREVIEW_WORKERS` is 0), if
+    previews are not available for files of this type, or if the preview (or the marker
+    that none can be generated) already exists, e.g., for a file with the same contents.
+
+    Returns:
+        The future corresponding to the (new or existing) job, if any.
+
+    """
+    global _PREVIEW_POOL
+
+    if not CONFIG.PREVIEW_WORKERS or not file_info.get("location"):
+        return None
+    if not _has_preview_generator(file_info):
+        return None
+
+    key = (str(file_info["location"]), file_info.get("revision") or 1)
+    job = _PREVIEW_JOBS.get(key)
+    if job is not None:
+        return job
+
+    directory = get_derived_directory(file_info)
+    if _get_preview_location(file_info).exists() or (directory / _NO_PREVIEW_MARKER).exists():
+        return None
+
+    if _PREVIEW_POOL is None:
+        _PREVIEW_POOL = ProcessPoolExecutor(
+            max_workers=CONFIG.PREVIEW_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    LOGGER.debug("Queueing preview of %s (revision %s)", *key)
+    pending_marker = prepare_derived_directory(file_info) / _PENDING_MARKER
+    pending_marker.touch()
+    try:
+        job = _PREVIEW_POOL.submit(
+            generate_preview,
+            {
+                "location": key[0],
+                "revision": key[1],
+                "name": file_info.get("name"),
+                "content_hash": file_info.get("content_hash"),
+            },
+        )
+    except (BrokenProcessPool, RuntimeError) as exc:
+        # a preview is never worth failing an upload for: it will instead be generated
+        # on request, and a new pool created for the next file
+        LOGGER.warning("Unable to queue preview of %s: %s", key[0], exc)
+        pending_marker.unlink(missing_ok=True)
+        _PREVIEW_POOL = None
+        return None
+    _PREVIEW_JOBS[key] = job
+    job.add_done_callback(lambda _: _PREVIEW_JOBS.pop(key, None))
+    return job
+
+
+def is_preview_pending(file_info: Dict[str, Any]) -> bool:
+    """Returns whether the preview of the current revision of a file is still being
+    generated on the background worker pool, by this or any other server process.
+
+    """
+    job = _PREVIEW_JOBS.get((str(file_info["location"]), file_info.get("revision") or 1))
+    if job is not None:
+        return not job.done()
+    if not file_info.get("location"):
+        return False
+    try:
+        queued = (get_derived_directory(file_info) / _PENDING_MARKER).stat().st_mtime
+    except FileNotFoundError:
+        return False
+    return time.time() - queued < PREVIEW_PENDING_TIMEOUT
+
+
+def get_preview(file_info: Dict[str, Any]) -> Optional[Path]:
+    """Returns the location of the preview of the current revision of a file,
+    generating it first if it has not been generated in the background.
+
+    Parameters:
+        file_info: The file document, as returned by `get_file_info_by_id`.
+
+    Returns:
+        The location of the preview, or `None` if the file has no preview.
+
+    """
+    if not file_info.get("location") or not _has_preview_generator(file_info):
+        return None
+    return generate_preview(file_info)
@@ -7,6 +7,7 @@ from flask_login import current_user
 from pydantic import ValidationError
 from pymongo.results import InsertOneResult, UpdateResult
 
+from pydatalab.apps.echem.blocks import capacity_fade_payload, get_capacity_fade_data
 from pydatalab.config import CONFIG
 from pydatalab.logger import logged_route
 from pydatalab.models.collections import Collection
@@ -91,6 +92,51 @@ def get_collection(collection_id):
     )
 
 
+@COLLECTIONS.route("/collections/<collection_id>/capacity-fade", methods=["GET"])
+def get_collection_capacity_fade(collection_id):
+    """Returns the capacity retention and coulombic efficiency per cycle for every
+    cycling file attached to the cells in the collection, as one series per file.
+
+    Only cached cycle summaries are used; any files that have not yet been parsed
+    are queued for parsing and their IDs are returned under `pending_file_ids`.
+
+    """
+    if not current_user.is_authenticated and not CONFIG.TESTING:
+        return (
+            jsonify(
+                {
+                    "status": "error",
+                    "message": f"No matching collection {collection_id=} with current authorization.",
+                }
+            ),
+            404,
+        )
+
+    result = get_capacity_fade_data(collection_id=collection_id)
+    if result is None:
+        return (
+            jsonify(
+                {
+                    "status": "error",
+                    "message": f"No matching collection {collection_id=} with current authorization.",
+                }
+            ),
+            404,
+        )
+
+    df, pending, errors = result
+
+    return jsonify(
+        {
+            "status": "success",
+            "collection_id": collection_id,
+            "data": capacity_fade_payload(df),
+            "pending_file_ids": pending,
+            "errors": errors,
+        }
+    )
+
+
 @COLLECTIONS.route("/collections", methods=["PUT"])
 def create_collection():
     request_json = request.get_json()  # noqa: F821 pylint: disable=undefined-variable
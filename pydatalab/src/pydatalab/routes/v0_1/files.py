@@ -1,16 +1,31 @@
+import datetime
+import mimetypes
 import os
+from pathlib import Path
+from urllib.parse import quote
 
 from bson import ObjectId
 from bson.errors import InvalidId
-from flask import Blueprint, jsonify, request, send_from_directory
+from flask import Blueprint, current_app, jsonify, request, send_file
 from flask_login import current_user
+from PIL import Image
 from pymongo import ReturnDocument
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
 import pydatalab.mongo
 from pydatalab import file_utils
 from pydatalab.config import CONFIG
+from pydatalab.media import (
+    DERIVED_IMAGE_FORMAT,
+    IMAGE_EXTENSIONS,
+    get_derived_image,
+    get_image_tile,
+)
+from pydatalab.models.utils import IsoformatDateTime
 from pydatalab.permissions import PUBLIC_USER_ID, active_users_or_get_only, get_default_permissions
+from pydatalab.previews import get_preview, is_preview_pending
 
 FILES = Blueprint("files", __name__)
 
@@ -22,15 +37,183 @@ def _(): ...
 
 @FILES.route("/files/<string:file_id>/<string:filename>", methods=["GET"])
 def get_file(file_id: str, filename: str):
+    """Serve a stored file.
+
+    Responses carry an `ETag` derived from the revision of the file and a
+    `Last-Modified` header from its database entry, so that clients can revalidate
+    cached copies with conditional requests, and `Range` requests are supported for
+    resumable downloads and seeking within videos. If `CONFIG.FILE_SENDFILE_MODE` is set,
+    the file itself is served by the reverse proxy.
+
+    """
     try:
         _file_id = ObjectId(file_id)
     except InvalidId:
         # If the ID is invalid, then there will be no results in the database anyway,
         # so just 401
         _file_id = file_id
-    if not pydatalab.mongo.flask_mongo.db.files.find_one(
-        {"_id": _file_id, **get_default_permissions(user_only=False)}
-    ):
+    file_info = pydatalab.mongo.flask_mongo.db.files.find_one(
+        {"_id": _file_id, **get_default_permissions(user_only=False)},
+        {"revision": 1, "last_modified": 1},
+    )
+    if not file_info:
+        return (
+            jsonify(
+                {
+                    "status": "error",
+                    "title": "Not Authorized",
+                    "detail": "Authorization required to access file",
+                }
+            ),
+            401,
+        )
+
+    relative_path = safe_join(secure_filename(file_id), filename)
+    if relative_path is None:
+        raise NotFound()
+    path = os.path.abspath(os.path.join(CONFIG.FILE_DIRECTORY, relative_path))
+    if not os.path.isfile(path):
+        raise NotFound()
+
+    etag = f"{file_id}-{file_info.get('revision') or 1}"
+    last_modified = None
+    if file_info.get("last_modified"):
+        last_modified = IsoformatDateTime.validate(file_info["last_modified"])
+
+    if CONFIG.FILE_SENDFILE_MODE:
+        response = _send_file_with_proxy(path, relative_path, etag, last_modified)
+    else:
+        response = send_file(path, etag=etag, last_modified=last_modified, conditional=True)
+
+    # stored files may change with each revision, so must always be revalidated
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _send_file_with_proxy(
+    path: str, relative_path: str, etag: str, last_modified: datetime.datetime | None
+):
+    """Hand a stored file over to the reverse proxy to send, via an `X-Accel-Redirect`
+    or `X-Sendfile` header, after answering any conditional request.
+
+    The proxy serves the body (and any requested byte range) itself, so the worker
+    is released as soon as the headers have been sent.
+
+    """
+    response = current_app.response_class(
+        mimetype=mimetypes.guess_type(relative_path)[0] or "application/octet-stream"
+    )
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.make_conditional(request)
+    if response.status_code != 200:
+        return response
+
+    if CONFIG.FILE_SENDFILE_MODE == "x-accel-redirect":
+        response.headers["X-Accel-Redirect"] = quote(
+            CONFIG.FILE_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + relative_path
+        )
+    else:
+        response.headers["X-Sendfile"] = path
+    return response
+
+
+@FILES.route("/files/<string:file_id>/derived/<string:kind>", methods=["GET"])
+def get_derived_file_image(file_id: str, kind: str):
+    """Serve a web-resolution image, thumbnail or full-resolution tile of
+    an image file, generating it on first request for the current revision.
+
+    Query parameters:
+        - `page`: the page of a multi-page file (default 0)
+        - `column`, `row`: the tile to serve, when `kind` is `tile`
+        - `revision`: the revision of the file that the client expects; if
+          this is the current revision, the response can be cached indefinitely
+
+    """
+    try:
+        _file_id = ObjectId(file_id)
+    except InvalidId:
+        _file_id = file_id
+    file_info = pydatalab.mongo.flask_mongo.db.files.find_one(
+        {"_id": _file_id, **get_default_permissions(user_only=False)},
+        {"location": 1, "revision": 1, "name": 1, "content_hash": 1},
+    )
+    if not file_info:
+        return (
+            jsonify(
+                {
+                    "status": "error",
+                    "title": "Not Authorized",
+                    "detail": "Authorization required to access file",
+                }
+            ),
+            401,
+        )
+
+    if os.path.splitext(file_info["name"])[-1].lower() not in IMAGE_EXTENSIONS:
+        return (
+            jsonify(
+                {
+                    "status": "error",
+                    "title": "Not Found",
+                    "detail": f"No derived images are available for {file_info['name']!r}",
+                }
+            ),
+            404,
+        )
+
+    page = request.args.get("page", 0, type=int)
+    try:
+        if kind == "tile":
+            path = get_image_tile(
+                file_info,
+                page,
+                request.args.get("column", 0, type=int),
+                request.args.get("row", 0, type=int),
+            )
+        else:
+            path = get_derived_image(file_info, kind, page=page)
+    except ValueError as exc:
+        return jsonify({"status": "error", "title": "Not Found", "detail": str(exc)}), 404
+    except Image.DecompressionBombError as exc:
+        return (
+            jsonify(
+                {
+                    "status": "error",
+                    "title": "Image Too Large",
+                    "detail": f"{file_info['name']!r} is too large to be displayed: {exc}",
+                }
+            ),
+            422,
+        )
+
+    return _send_derived_image(path, file_id, file_info.get("revision") or 1)
+
+
+@FILES.route("/files/<string:file_id>/preview", methods=["GET"])
+def get_file_preview(file_id: str):
+    """Serve a small preview of a file: the thumbnail of an image, or a sparkline plot
+    of a recognised data file.
+
+    Query parameters:
+        - `revision`: the revision of the file that the client expects; if
+          this is the current revision, the response can be cached indefinitely
+
+    Returns a 202 response if the preview is still being generated in the background,
+    and a 404 response if no preview is available for the file.
+
+    """
+    try:
+        _file_id = ObjectId(file_id)
+    except InvalidId:
+        _file_id = file_id
+    file_info = pydatalab.mongo.flask_mongo.db.files.find_one(
+        {"_id": _file_id, **get_default_permissions(user_only=False)},
+        {"location": 1, "revision": 1, "name": 1, "content_hash": 1},
+    )
+    if not file_info:
         return (
             jsonify(
                 {
@@ -41,8 +224,47 @@ def get_file(file_id: str, filename: str):
             ),
             401,
         )
-    path = os.path.join(CONFIG.FILE_DIRECTORY, secure_filename(file_id))
-    return send_from_directory(path, filename)
+
+    if is_preview_pending(file_info):
+        return jsonify({"status": "pending", "detail": "Preview is being generated"}), 202
+
+    path = get_preview(file_info)
+    if path is None:
+        return (
+            jsonify(
+                {
+                    "status": "error",
+                    "title": "Not Found",
+                    "detail": f"No preview is available for {file_info['name']!r}",
+                }
+            ),
+            404,
+        )
+
+    return _send_derived_image(path, file_id, file_info.get("revision") or 1)
+
+
+def _send_derived_image(path: Path, file_id: str, revision: int):
+    """Send an image derived from the given revision of a file, which can be cached
+    indefinitely by clients that requested that revision explicitly.
+
+    """
+    response = send_file(
+        path,
+        mimetype=f"image/{DERIVED_IMAGE_FORMAT.lower()}",
+        etag=f"{file_id}-{revision}-{path.parent.name}-{path.name}",
+        conditional=True,
+    )
+    # derived images are private to the user, and immutable for a given revision
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if request.args.get("revision", type=int) == revision:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = 365 * 24 * 60 * 60
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
 
 
 @FILES.route("/upload-file/", methods=["POST"])
@@ -90,7 +312,11 @@ def upload():
         file_information = file_utils.update_uploaded_file(file, ObjectId(replace_file_id))
     else:
         file_information = file_utils.save_uploaded_file(
-            file, item_ids=[item_id], creator_ids=[creator_id]
+            file,
+            item_ids=[item_id],
+            creator_ids=[creator_id],
+            # the request body is an upper bound on the file size, for checking the space available
+            size_bytes=request.content_length,
         )
 
     return (
@@ -106,6 +332,122 @@ def upload():
     )
 
 
+def _upload_requires_login():
+    return (
+        jsonify(
+            {
+                "status": "error",
+                "title": "Not Authorized",
+                "detail": "File upload requires login.",
+            }
+        ),
+        401,
+    )
+
+
+@FILES.route("/uploads/", methods=["POST"])
+def create_chunked_upload():
+    """Begin a chunked, resumable upload of a large file.
+
+    The JSON body must contain the `filename` and `size` (in bytes) of the file, and
+    either the `item_id` to attach it to or the `replace_file` ID of a file to replace.
+    The file is then sent in chunks of at most the returned `chunk_size` with
+    `PUT /uploads/<upload_id>?offset=<offset>`, each with its hex-encoded SHA-256 digest
+    in the `X-Chunk-SHA256` header, before `POST /uploads/<upload_id>/finalize` adds the
+    file to the item. If an upload is interrupted, `GET /uploads/<upload_id>` returns
+    the number of bytes `received`, from which it can be resumed.
+
+    """
+    if not current_user.is_authenticated and not CONFIG.TESTING:
+        return _upload_requires_login()
+
+    request_json = request.get_json(silent=True)
+    if not isinstance(request_json, dict):
+        return jsonify(error="The request body must be a JSON object"), 400
+
+    size = request_json.get("size")
+    if not request_json.get("filename") or not isinstance(size, int) or isinstance(size, bool):
+        return jsonify(error="A filename and integer size must be provided"), 400
+
+    replace_file = request_json.get("replace_file")
+    if not replace_file and not request_json.get("item_id"):
+        return jsonify(error="No item id provided"), 400
+    if replace_file:
+        try:
+            replace_file = ObjectId(replace_file)
+        except (InvalidId, TypeError):
+            return jsonify(error=f"Invalid file ID to replace: {replace_file!r}"), 400
+
+    if not CONFIG.TESTING:
+        creator_id = current_user.person.immutable_id
+    else:
+        creator_id = PUBLIC_USER_ID
+
+    upload_status = file_utils.create_chunked_upload(
+        request_json["filename"],
+        request_json["size"],
+        item_ids=[request_json["item_id"]] if not replace_file else None,
+        replace_file=replace_file or None,
+        last_modified=request_json.get("last_modified"),
+        creator_ids=[creator_id],
+    )
+    return jsonify({"status": "success", **upload_status}), 201
+
+
+@FILES.route("/uploads/<string:upload_id>", methods=["GET"])
+def get_chunked_upload(upload_id: str):
+    """Get the status of a chunked upload, e.g., to resume it."""
+    return jsonify({"status": "success", **file_utils.get_chunked_upload_status(upload_id)}), 200
+
+
+@FILES.route("/uploads/<string:upload_id>", methods=["PUT"])
+def put_upload_chunk(upload_id: str):
+    """Append a chunk to a chunked upload, streaming the raw request body to disk."""
+    if not current_user.is_authenticated and not CONFIG.TESTING:
+        return _upload_requires_login()
+
+    offset = request.args.get("offset", type=int)
+    if offset is None:
+        return jsonify(error="No chunk offset provided"), 400
+
+    upload_status = file_utils.write_upload_chunk(
+        upload_id, offset, request.stream, request.headers.get("X-Chunk-SHA256")
+    )
+    return jsonify({"status": "success", **upload_status}), 200
+
+
+@FILES.route("/uploads/<string:upload_id>/finalize", methods=["POST"])
+def finalize_chunked_upload(upload_id: str):
+    """Add a completed chunked upload to the file store and attach it to its item."""
+    if not current_user.is_authenticated and not CONFIG.TESTING:
+        return _upload_requires_login()
+
+    upload_status = file_utils.get_chunked_upload_status(upload_id)
+    is_update = upload_status["replace_file"] is not None
+    file_information = file_utils.finalize_chunked_upload(upload_id)
+    return (
+        jsonify(
+            {
+                "status": "success",
+                "file_id": str(file_information["_id"]),
+                "file_information": file_information,
+                "is_update": is_update,
+            }
+        ),
+        201,
+    )
+
+
+@FILES.route("/uploads/<string:upload_id>", methods=["DELETE"])
+def abort_chunked_upload(upload_id: str):
+    """Cancel a chunked upload and discard any chunks received."""
+    if not current_user.is_authenticated and not CONFIG.TESTING:
+        return _upload_requires_login()
+
+    file_utils.abort_chunked_upload(upload_id)
+    return jsonify({"status": "success"}), 200
+
+
 @FILES.route("/add-remote-file-to-sample/", methods=["POST"])
 def add_remote_file_to_sample():
     if not current_user.is_authenticated and not CONFIG.TESTING:
@@ -26,12 +26,16 @@ ITEMS = Blueprint("items", __name__)
 def _(): ...
 
 
-def reserialize_blocks(display_order: List[str], blocks_obj: Dict[str, Dict]) -> Dict[str, Dict]:
+def reserialize_blocks(
+    display_order: List[str], blocks_obj: Dict[str, Dict], item_context: Optional[Dict] = None
+) -> Dict[str, Dict]:
     """Create the corresponding Python objects from JSON block data, then
     serialize it again as JSON to populate any missing properties.
 
     Parameters:
         blocks_obj: A dictionary containing the JSON block data, keyed by block ID.
+        item_context: The already-loaded database document of the item that owns the blocks,
+            which will be shared with each block to avoid repeated queries.
 
     Returns:
         A dictionary with the re-serialized block data.
@@ -45,7 +49,9 @@ def reserialize_blocks(display_order: List[str], blocks_obj: Dict[str, Dict]) ->
             continue
         blocktype = block_data["blocktype"]
         blocks_obj[block_id] = (
-            BLOCK_TYPES.get(blocktype, BLOCK_TYPES["notsupported"]).from_db(block_data).to_web()
+            BLOCK_TYPES.get(blocktype, BLOCK_TYPES["notsupported"])
+            .from_db(block_data, item_context=item_context)
+            .to_web()
         )
 
     return blocks_obj
@@ -712,9 +718,12 @@ def get_item_data(
         else:
             raise KeyError(f"Item {item_id=} has no type field in document.")
 
+    item_context = doc
     doc = ItemModel(**doc)
     if load_blocks:
-        doc.blocks_obj = reserialize_blocks(doc.display_order, doc.blocks_obj)
+        doc.blocks_obj = reserialize_blocks(
+            doc.display_order, doc.blocks_obj, item_context=item_context
+        )
 
     # find any documents with relationships that mention this document
     relationships_query_results = flask_mongo.db.items.find(
@@ -3,10 +3,13 @@ anywhere in the package.
 
 """
 
+import base64
 import datetime
 from json import JSONEncoder
 from math import ceil
+from typing import Any, Dict
 
+import numpy as np
 import pandas as pd
 from bson import json_util
 from flask.json.provider import DefaultJSONProvider
@@ -34,6 +37,61 @@ def reduce_df_size(df: pd.DataFrame, target_nrows: int, endpoint: bool = True) -
     return df.iloc[indices].copy()
 
 
+def minmax_downsample_indices(y: np.ndarray, num_buckets: int) -> np.ndarray:
+    """Choose the indices of the minimum and maximum of `y` within each of
+    `num_buckets` contiguous buckets, so that peaks survive downsampling.
+
+    Parameters:
+        y: The values to downsample.
+        num_buckets: The number of buckets; at most `2 * num_buckets` indices
+            (plus the endpoints) will be returned.
+
+    Returns:
+        The sorted, unique indices to keep. If `y` already has no more than
+        `2 * num_buckets` points, all indices are returned.
+
+    """
+    num_points = len(y)
+    if num_points <= 2 * num_buckets:
+        return np.arange(num_points)
+
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(0, num_points, num_buckets + 1).astype(int)
+    # Fill NaNs so that they are never chosen as the min or max of a bucket
+    filled_min = np.where(np.isnan(y), np.inf, y)
+    filled_max = np.where(np.isnan(y), -np.inf, y)
+    mins = [start + np.argmin(filled_min[start:stop]) for start, stop in zip(edges, edges[1:])]
+    maxs = [start + np.argmax(filled_max[start:stop]) for start, stop in zip(edges, edges[1:])]
+    return np.unique(np.concatenate(([0, num_points - 1], mins, maxs)))
+
+
+def encode_array(array: np.ndarray, dtype: str = "float32") -> Dict[str, Any]:
+    """Encode a numerical array compactly as base64-encoded little-endian binary,
+    for storage in the database or sending to the browser.
+
+    Parameters:
+        array: The array to encode.
+        dtype: The NumPy dtype to cast to before encoding.
+
+    Returns:
+        A dictionary with the `dtype`, `shape` and base64 `data` of the array,
+        that can be decoded with `decode_array`.
+
+    """
+    array = np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder("<"))
+    return {
+        "dtype": dtype,
+        "shape": list(array.shape),
+        "data": base64.b64encode(array.tobytes()).decode("ascii"),
+    }
+
+
+def decode_array(encoded: Dict[str, Any]) -> np.ndarray:
+    """Decode an array that was encoded with `encode_array`."""
+    dtype = np.dtype(encoded["dtype"]).newbyteorder("<")
+    return np.frombuffer(base64.b64decode(encoded["data"]), dtype=dtype).reshape(encoded["shape"])
+
+
 class CustomJSONEncoder(JSONEncoder):
     """A custom JSON encoder that uses isoformat datetime strings and
     BSON for other serialization."""
@@ -1,9 +1,11 @@
 from pathlib import Path
 
 import pytest
-from navani.echem import echem_file_loader
+from navani.echem import cycle_summary, echem_file_loader
 
 from pydatalab.apps.echem.utils import (
+    build_cycle_index,
+    compute_capacity_retention,
     compute_gpcl_differential,
     filter_df_by_cycle_index,
     reduce_echem_cycle_sampling,
@@ -65,6 +67,24 @@ def test_compute_gpcl_differential(reduced_and_filtered_echem_dataframe):
     dvdq_results = compute_gpcl_differential(df, mode="dV/dQ")
     assert "dV/dQ (V/mA)" in dvdq_results
 
+    parallel_dqdv_results = compute_gpcl_differential(df, parallel=True)
+    assert parallel_dqdv_results.equals(dqdv_results)
+
+
+def test_compute_gpcl_differential_cache(reduced_echem_dataframe):
+    df = reduced_echem_dataframe
+
+    cache = {}
+    first_cycle = filter_df_by_cycle_index(df, [1])
+    compute_gpcl_differential(first_cycle, cache=cache)
+    assert set(cache) == set(first_cycle["half cycle"].unique())
+
+    cached_entries = dict(cache)
+    dqdv_results = compute_gpcl_differential(df, cache=cache)
+    assert set(cache) == set(df["half cycle"].unique())
+    assert all(cache[half_cycle] is cached_entries[half_cycle] for half_cycle in cached_entries)
+    assert dqdv_results.equals(compute_gpcl_differential(df))
+
 
 def test_filter_df_by_cycle_index(reduced_echem_dataframe):
     cycle_lists = ([1, 2, 3], [4.0, 6.0, 10.0], [-1, 5, 2])
@@ -73,6 +93,123 @@ def test_filter_df_by_cycle_index(reduced_echem_dataframe):
         assert {int(i) for i in filtered_df["full cycle"]}.issubset({int(i) for i in cycle_list})
 
 
+def test_filter_df_by_cycle_index_with_cycle_index(echem_dataframe):
+    cycle_index = build_cycle_index(echem_dataframe)
+    assert cycle_index is not None
+    assert cycle_index["stop"].max() == len(echem_dataframe)
+    assert set(cycle_index.index) == set(echem_dataframe["half cycle"].unique())
+
+    cycle_lists = ([1], [1, 2, 3], [4.0, 6.0, 10.0], [-1, 5, 2], [100])
+    for cycle_list in cycle_lists:
+        expected_df = filter_df_by_cycle_index(echem_dataframe, list(cycle_list))
+        sliced_df = filter_df_by_cycle_index(
+            echem_dataframe, list(cycle_list), cycle_index=cycle_index
+        )
+        assert sliced_df.equals(expected_df)
+
+    shuffled_df = echem_dataframe.sample(frac=1, random_state=0)
+    assert build_cycle_index(shuffled_df) is None
+
+
+def test_plot_cycle_reads_parse_caches(default_filepath, tmp_path, monkeypatch):
+    import os
+    import shutil
+
+    import pydatalab.apps.echem.blocks
+    import pydatalab.apps.echem.utils
+    from pydatalab.apps.echem.blocks import CycleBlock
+
+    location = tmp_path / default_filepath.name
+    shutil.copy(default_filepath, location)
+    file_info = {"name": location.name, "location": str(location), "revision": 1}
+    monkeypatch.setattr(
+        pydatalab.apps.echem.blocks, "get_file_info_by_id", lambda *args, **kwargs: file_info
+    )
+
+    block = CycleBlock(item_id="cell", init_data={"file_id": "0" * 24}, item_context={})
+    block.plot_cycle()
+    assert location.with_suffix(".CYCLE_INDEX.pkl").exists()
+    assert block.data["bokeh_plot_data"]
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Raw file was reparsed despite the parse caches")
+
+    monkeypatch.setattr(pydatalab.apps.echem.utils.ec, "echem_file_loader", fail)
+    monkeypatch.setattr(pydatalab.apps.echem.utils, "build_cycle_index", fail)
+    block.data.pop("bokeh_plot_data")
+    block.plot_cycle()
+    assert block.data["bokeh_plot_data"]
+
+    # a file that is newer than its caches (e.g., replaced in place) is reparsed
+    stat = location.stat()
+    os.utime(location, (stat.st_atime, stat.st_mtime + 10))
+    with pytest.raises(RuntimeError, match="reparsed"):
+        block.plot_cycle()
+
+
+def test_cache_echem_file_records_errors(default_filepath, tmp_path, monkeypatch):
+    import os
+    import shutil
+
+    import pydatalab.apps.echem.utils
+    from pydatalab.apps.echem.utils import cache_echem_file, load_cached_cycle_summary_error
+
+    location = tmp_path / default_filepath.name
+    shutil.copy(default_filepath, location)
+
+    def fail(*args, **kwargs):
+        raise ValueError("no cycles")
+
+    # failures to summarise the file are raised and recorded, rather than silently ignored
+    monkeypatch.setattr(pydatalab.apps.echem.utils.ec, "cycle_summary", fail)
+    with pytest.raises(RuntimeError):
+        cache_echem_file(location)
+    assert load_cached_cycle_summary_error(location) == "Unable to compute the cycle summary"
+
+    # the error is ignored once the file changes, and cleared once it can be summarised
+    os.utime(location, (location.stat().st_mtime + 10,) * 2)
+    assert load_cached_cycle_summary_error(location) is None
+    monkeypatch.undo()
+    cache_echem_file(location)
+    assert not location.with_suffix(".SUMMARY_ERROR.txt").exists()
+
+
+def test_prune_differential_caches(tmp_path):
+    import os
+
+    from pydatalab.apps.echem.blocks import MAX_DIFFERENTIAL_CACHES, CycleBlock
+
+    file_info = {"location": str(tmp_path / "cell.mpr"), "revision": 1}
+    caches = []
+    for i in range(MAX_DIFFERENTIAL_CACHES + 3):
+        cache = CycleBlock._get_differential_cache_location(file_info, {"s_spline": i})
+        cache.touch()
+        os.utime(cache, (i, i))
+        caches.append(cache)
+    unrelated = tmp_path / "other.DIFFERENTIAL-0.pkl"
+    unrelated.touch()
+
+    CycleBlock._prune_differential_caches(file_info)
+    assert [cache.exists() for cache in caches] == [False] * 3 + [True] * MAX_DIFFERENTIAL_CACHES
+    assert unrelated.exists()
+
+
+def test_compute_capacity_retention(default_filepath):
+    summary = cycle_summary(echem_file_loader(default_filepath))
+    half_summary = summary.iloc[: len(summary) // 2]
+
+    df = compute_capacity_retention({"a": summary, "b": half_summary, "empty": summary.iloc[0:0]})
+    assert set(df["series"]) == {"a", "b"}
+    assert (df["series"] == "a").sum() == len(summary)
+    assert (df["series"] == "b").sum() == len(half_summary)
+
+    for _, series in df.groupby("series"):
+        first_valid = series["capacity retention (%)"].dropna().iloc[0]
+        assert first_valid == pytest.approx(100.0)
+
+    assert compute_capacity_retention({}).empty
+
+
 def test_plot(reduced_echem_dataframe):
     from pydatalab.bokeh_plots import double_axes_echem_plot
 
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def _write_ivium_spectrum(path, circuit, parameters, noise=0.0, seed=0):
+    from pydatalab.apps.eis.utils import EIS_CIRCUITS
+
+    frequency = np.logspace(5, -2, 71)
+    z = EIS_CIRCUITS[circuit].impedance(np.array(parameters), 2 * np.pi * frequency)
+    z *= 1 + noise * np.random.default_rng(seed).standard_normal(len(z))
+    pd.DataFrame({"freq. /Hz": frequency, "Z1 /ohm": z.real, "Z2 /ohm": z.imag}).to_csv(
+        path, sep="\t", index=False
+    )
+
+
+@pytest.mark.parametrize(
+    "circuit, parameters",
+    (
+        ("R-RC", [10.0, 100.0, 1e-5]),
+        ("R-RQ", [10.0, 100.0, 1e-5, 0.85]),
+        ("R-RQ-W", [10.0, 100.0, 1e-5, 0.85, 30.0]),
+    ),
+)
+def test_fit_circuit(tmp_path, circuit, parameters):
+    from pydatalab.apps.eis.utils import fit_eis_file, load_eis_file
+
+    path = tmp_path / "eis.txt"
+    _write_ivium_spectrum(path, circuit, parameters, noise=0.002)
+
+    eis = load_eis_file(path)
+    assert (eis["-Im(Z) [Ω]"] > 0).all()
+    assert {"Frequency [Hz]", "Re(Z) [Ω]", "|Z| [Ω]", "-Phase [°]"} <= set(eis.columns)
+
+    _, fit = fit_eis_file(path, circuit, reload=False)
+    assert fit["success"]
+    np.testing.assert_allclose(list(fit["parameters"].values()), parameters, rtol=0.05)
+
+    # fits are cached per circuit alongside the file
+    assert (tmp_path / "eis.EIS_FIT.pkl").exists()
+    _, cached = fit_eis_file(path, circuit, reload=False)
+    assert cached == fit
+
+
+def test_load_spectra_parallel(tmp_path):
+    from pydatalab.apps.eis import EISBlock
+
+    file_infos = []
+    for i in range(6):
+        path = tmp_path / f"eis_{i}.txt"
+        _write_ivium_spectrum(path, "R-RQ", [10.0, 50.0 * (i + 1), 1e-5, 0.9])
+        file_infos.append({"location": str(path)})
+    (tmp_path / "not_eis.txt").write_text("not\tan\teis\tfile\n1\t2\t3\t4\n")
+    file_infos.append({"location": str(tmp_path / "not_eis.txt")})
+
+    results = EISBlock.load_spectra(file_infos, "R-RQ", parallel=True)
+    assert len(results) == 7
+    for i, (eis, fit, error) in enumerate(results[:-1]):
+        assert error is None
+        assert len(eis) == 71
+        assert fit["parameters"]["R1 [Ω]"] == pytest.approx(50.0 * (i + 1), rel=1e-3)
+
+    eis, fit, error = results[-1]
+    assert eis is None and fit is None and error
+
+    spectra = {f"eis_{i}": eis for i, (eis, _, _) in enumerate(results[:-1])}
+    fits = {f"eis_{i}": fit for i, (_, fit, _) in enumerate(results[:-1])}
+    assert EISBlock._plot_spectra(spectra, fits)
@@ -52,3 +52,77 @@ def test_bruker_reader_2D(nmr_2d_matpass_example):
     assert a_dic
     assert topspin_title
     assert shape == (8, 4096)
+
+
+def test_bruker_zip_cache(tmp_path):
+    import shutil
+
+    from pydatalab.apps.nmr.utils import list_bruker_processes, read_bruker_zip
+
+    zip_path = tmp_path / "72.zip"
+    shutil.copy(Path(__file__).parent.parent.parent / "example_data" / "NMR" / "72.zip", zip_path)
+
+    assert list_bruker_processes(zip_path) == ["1", "999"]
+
+    df, a_dic, topspin_title, shape = read_bruker_zip(zip_path, process_number=999)
+    assert df is not None
+    extracted = tmp_path / "72.zip.extracted" / "72"
+    assert (extracted / "acqus").exists()
+    assert (extracted / "pdata" / "999" / "1r").exists()
+    assert not (extracted / "pdata" / "1" / "2rr").exists()
+    assert not (tmp_path / "72.zip.extracted" / "__MACOSX").exists()
+
+    # second read should come from the parsed cache
+    (extracted / "pdata" / "999" / "1r").unlink()
+    cached_df, *_ = read_bruker_zip(zip_path, process_number=999)
+    assert cached_df.equals(df)
+
+
+def test_nmr_spectrum_encoding(nmr_1d_solid_example):
+    import json
+
+    import numpy as np
+
+    from pydatalab.apps.nmr.blocks import NMRBlock
+
+    df, a_dic, _, _ = read_bruker_1d(nmr_1d_solid_example)
+    encoded = NMRBlock._encode_spectrum(df)
+    assert encoded["num_points"] == len(df)
+    assert len(json.dumps(encoded)) < len(json.dumps(df.to_dict())) / 5
+
+    decoded = NMRBlock._decode_spectrum(encoded, nscans=a_dic["acqus"]["NS"])
+    assert len(decoded) <= NMRBlock.max_preview_points + 2
+    # the extrema of the spectrum should be preserved by the preview
+    np.testing.assert_allclose(decoded["intensity"].max(), df["intensity"].max(), rtol=1e-6)
+    np.testing.assert_allclose(decoded["intensity"].min(), df["intensity"].min(), rtol=1e-6)
+    np.testing.assert_allclose(
+        decoded["intensity_per_scan"], decoded["intensity"] / a_dic["acqus"]["NS"]
+    )
+
+    # legacy format should still be readable
+    assert NMRBlock._decode_spectrum(df.to_dict()).equals(df)
+
+
+def test_bruker_reader_2D_image(nmr_2d_matpass_example):
+    import nmrglue as ng
+    import numpy as np
+
+    from pydatalab.apps.nmr.utils import read_bruker_2d
+
+    spectrum = read_bruker_2d(nmr_2d_matpass_example, max_shape=(8, 1024))
+    assert spectrum["shape"] == (8, 4096)
+    assert spectrum["image"].shape == (8, 1024)
+    assert len(spectrum["f1_ppm"]) == 8
+    assert len(spectrum["f2_ppm"]) == 1024
+    assert len(spectrum["levels"])
+    assert len(spectrum["contours"]) == len(spectrum["levels"])
+
+    # the downsampled image should keep the peak of each row
+    _, full = ng.bruker.read_pdata(
+        str(nmr_2d_matpass_example / "pdata" / "1"), scale_data=True, all_components=False
+    )
+    np.testing.assert_allclose(spectrum["image"].max(axis=1), full.max(axis=1), rtol=1e-6)
+
+    # and without downsampling should reproduce the processed data exactly
+    spectrum = read_bruker_2d(nmr_2d_matpass_example, max_shape=(8, 4096))
+    np.testing.assert_allclose(spectrum["image"], full, rtol=1e-6)
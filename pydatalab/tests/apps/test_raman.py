@@ -14,3 +14,69 @@ def test_load(data_files):
     for f in data_files:
         df, metadata, y_options = RamanBlock.load(f)
         assert all(y in df.columns for y in y_options)
+
+
+def test_raman_map(tmp_path, monkeypatch):
+    import numpy as np
+    from scipy.integrate import trapezoid
+
+    from pydatalab.apps.raman import utils
+    from pydatalab.apps.raman.utils import get_map_spectrum, integrate_map_band, load_wdf
+
+    # a synthetic map in RosettaSciIO's (y, x, wavenumber) array order
+    wavenumber = 100 + 2.0 * np.arange(50)
+    data = np.random.default_rng(0).random((3, 4, 50)).astype(np.float32)
+    axes = [
+        {"name": "Y", "size": 3, "offset": 0, "scale": 5, "navigate": True, "index_in_array": 0},
+        {"name": "X", "size": 4, "offset": 0, "scale": 2, "navigate": True, "index_in_array": 1},
+        {
+            "name": "Raman Shift",
+            "size": 50,
+            "offset": 100,
+            "scale": 2.0,
+            "navigate": False,
+            "index_in_array": 2,
+        },
+    ]
+    monkeypatch.setattr(
+        utils, "file_reader", lambda _: [{"data": data, "axes": axes, "metadata": {}}]
+    )
+
+    location = tmp_path / "map.wdf"
+    location.touch()
+    wdf = load_wdf(location)
+    assert wdf["cube"].shape == (4, 3, 50)
+    assert isinstance(wdf["cube"], np.memmap)
+    np.testing.assert_array_equal(wdf["x"], [0, 2, 4, 6])
+    np.testing.assert_array_equal(wdf["y"], [0, 5, 10])
+    np.testing.assert_array_equal(wdf["wavenumber"], wavenumber)
+    np.testing.assert_allclose(wdf["intensity"], data.mean(axis=(0, 1)), rtol=1e-6)
+    np.testing.assert_array_equal(get_map_spectrum(wdf, 3, 1), data[1, 3])
+
+    image = integrate_map_band(wdf, band=(110, 120), chunk_rows=3)
+    assert image.shape == (4, 3)
+    window = (wavenumber >= 110) & (wavenumber <= 120)
+    np.testing.assert_allclose(
+        image[2, 1], trapezoid(data[1, 2, window], wavenumber[window]), rtol=1e-6
+    )
+
+    df, _, _ = RamanBlock.load(location, pixel=(3, 1))
+    np.testing.assert_array_equal(df["intensity"], data[1, 3])
+
+
+def test_read_raman_txt(tmp_path):
+    from pydatalab.apps.raman.utils import read_raman_txt
+
+    example_dir = Path(__file__).parent.parent.parent / "example_data" / "raman"
+    df, _, vendor = read_raman_txt(example_dir / "raman_example.txt")
+    assert vendor == "renishaw"
+    assert df.shape == (1011, 2)
+
+    df, metadata, vendor = read_raman_txt(example_dir / "labspec_raman_example.txt")
+    assert vendor == "labspec"
+    assert df.shape == (341, 2)
+    assert metadata["#AxisUnit[1]"] == "1/cm"
+
+    unknown = tmp_path / "unknown.txt"
+    unknown.write_text("#Time\t#Voltage\n1\t2\n")
+    assert read_raman_txt(unknown) == (None, {}, None)
@@ -19,3 +19,33 @@ def test_simple_csv(example_data_dir):
     df = TabularDataBlock.load(example_data_dir / "csv" / "simple.csv")
     assert df.shape == (2, 3)
     assert df.columns.tolist() == ["test", "test2", "test3"]
+
+
+def test_sniff_preamble(tmp_path):
+    path = tmp_path / "log.txt"
+    path.write_text(
+        "Instrument: test\nOperator: someone\n\ntime\tvalue\n"
+        + "".join(f"{i}\t{i**2}\n" for i in range(10))
+    )
+    dialect = TabularDataBlock.sniff(path)
+    assert dialect == {"delimiter": "\t", "skiprows": 3, "header": 0}
+
+    with pytest.warns(UserWarning):
+        df = TabularDataBlock.load(path, reload=False)
+    assert df.columns.tolist() == ["time", "value"]
+    assert df.shape == (10, 2)
+    assert (path.parent / "log.TABULAR.pkl").exists()
+
+    # should now load from the cache
+    assert TabularDataBlock.load(path, reload=False).equals(df)
+
+
+def test_column_stats(tmp_path):
+    path = tmp_path / "data.csv"
+    path.write_text("a,b,c\n1,2,x\n3,,y\n5,6,z\n")
+    stats = TabularDataBlock.column_stats(TabularDataBlock.load(path))
+    assert stats == [
+        {"name": "a", "dtype": "int64", "min": 1.0, "max": 5.0, "nan_count": 0},
+        {"name": "b", "dtype": "float64", "min": 2.0, "max": 6.0, "nan_count": 1},
+        {"name": "c", "dtype": "object", "min": None, "max": None, "nan_count": 0},
+    ]
@@ -63,3 +63,81 @@ def test_ms_parse_no_validation(filename):
         )
         assert "Time Relative [s]" in ms["data"][species]
         assert "Time" not in ms["data"][species]
+
+
+def test_ms_wide_array_and_cache(tmp_path):
+    import shutil
+
+    import numpy as np
+    from scipy.signal import savgol_filter
+
+    from pydatalab.apps.tga.blocks import MassSpecBlock
+
+    path = tmp_path / "ms.asc"
+    shutil.copy(
+        Path(__file__).parent.parent.parent
+        / "example_data"
+        / "TGA-MS"
+        / "20221128 134958 TGA MS Megan.asc",
+        path,
+    )
+
+    ms = MassSpecBlock.load(path, reload=False)
+    assert ms["array"].shape == (1366, 14)
+    assert ms["data_keys"] == ["Time Relative [s]", "Partial Pressure [mbar]"]
+    assert ms["species_columns"]["Water"] == slice(4, 6)
+    # per-species dataframes should be views onto the wide array
+    assert np.shares_memory(ms["data"]["Water"].to_numpy(), ms["array"])
+
+    cached = MassSpecBlock.load(path, reload=False)
+    assert (path.parent / "ms.MS_PARSED.pkl").exists()
+    for species, df in ms["data"].items():
+        assert cached["data"][species].equals(df)
+
+    smoothed = MassSpecBlock._smooth_channels(cached, "Partial Pressure [mbar]")
+    for species, df in ms["data"].items():
+        expected = savgol_filter(df["Partial Pressure [mbar]"].to_numpy(), len(df) // 10, 3)
+        np.testing.assert_allclose(smoothed[species], expected, rtol=1e-10, atol=1e-25)
+
+
+def test_ms_streamed_cache(tmp_path):
+    import shutil
+
+    import numpy as np
+
+    from pydatalab.apps.tga.parsers import (
+        parse_mt_mass_spec_ascii,
+        read_mt_mass_spec_window,
+        stream_mt_mass_spec_ascii,
+    )
+
+    path = tmp_path / "ms.asc"
+    shutil.copy(
+        Path(__file__).parent.parent.parent
+        / "example_data"
+        / "TGA-MS"
+        / "20221128 134958 TGA MS Megan.asc",
+        path,
+    )
+
+    ms = parse_mt_mass_spec_ascii(path)
+    streamed = stream_mt_mass_spec_ascii(
+        path, tmp_path / "ms.MS_CACHE", max_points=128, chunksize=100
+    )
+    assert streamed["num_rows"] == len(ms["array"])
+    assert set(streamed["data"]) == set(ms["data"])
+
+    key = "Partial Pressure [mbar]"
+    for species, df in ms["data"].items():
+        preview = streamed["data"][species]
+        # the preview is bounded in size but keeps the extrema of the full data
+        assert len(preview) <= 4 * 128
+        assert preview[key].max() == df[key].max()
+        assert preview[key].min() == df[key].min()
+
+        window = read_mt_mass_spec_window(streamed["cache_dir"], species)
+        np.testing.assert_array_equal(window.to_numpy(), df.to_numpy())
+
+        window = read_mt_mass_spec_window(streamed["cache_dir"], species, time_range=(1000, 2000))
+        assert len(window)
+        assert window["Time Relative [s]"].between(1000, 2000).all()
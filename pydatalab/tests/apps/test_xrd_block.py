@@ -29,3 +29,175 @@ def test_plot(data_files):
         point_size=3,
     )
     assert p
+
+
+def test_parse_xy_header(tmp_path):
+    from pydatalab.apps.xrd.utils import parse_xy
+
+    xy = tmp_path / "pattern.xye"
+    xy.write_text(
+        "# Wavelength\n1.5406\nSample: test 1 2\n10.0 100.0 10.0\n\n10.1 110.0 10.5\n10.2 90.0\n"
+    )
+    df = parse_xy(xy)
+    assert df.shape == (3, 3)
+    assert df.attrs["header"] == "# Wavelength\n1.5406\nSample: test 1 2\n"
+    assert df["error"].isna().sum() == 1
+
+    bad = tmp_path / "bad.xy"
+    bad.write_text("not\na\npattern\n")
+    with pytest.raises(RuntimeError):
+        parse_xy(bad)
+
+    trailing = tmp_path / "trailing.xy"
+    trailing.write_text("".join(f"{10 + i / 10} {i}\n" for i in range(10)) + "end of data\n")
+    with pytest.raises(RuntimeError):
+        parse_xy(trailing)
+
+
+def test_parse_xrdml_multiple_scans(tmp_path):
+    from pydatalab.apps.xrd.utils import iter_xrdml_scans, parse_xrdml, parse_xrdml_2d
+
+    scan = """<scan><dataPoints>
+<positions axis="2Theta" unit="deg"><startPosition>{start}</startPosition><endPosition>{end}</endPosition></positions>
+<positions axis="Omega" unit="deg"><startPosition>1.0</startPosition><endPosition>2.0</endPosition></positions>
+<intensities unit="counts">{counts}</intensities>
+</dataPoints></scan>"""
+    xrdml = tmp_path / "multi.xrdml"
+    xrdml.write_text(
+        '<?xml version="1.0"?><xrdMeasurements xmlns="http://www.xrdml.com/XRDMeasurement/1.5">'
+        "<xrdMeasurement>"
+        + scan.format(start="10.0", end="12.0", counts="1 2 3")
+        + scan.format(start="10.0", end="12.0", counts="4 5 6")
+        + scan.format(start="11.0", end="12.0", counts="7 8")
+        + "</xrdMeasurement></xrdMeasurements>"
+    )
+
+    scans = list(iter_xrdml_scans(xrdml))
+    assert len(scans) == 3
+    assert scans[0]["twotheta"].tolist() == [10.0, 11.0, 12.0]
+    assert scans[1]["intensity"].tolist() == [4.0, 5.0, 6.0]
+    assert scans[2].attrs["positions"] == {"Omega": (1.0, 2.0)}
+
+    assert parse_xrdml(xrdml, scan=1)["intensity"].tolist() == [4.0, 5.0, 6.0]
+
+    twotheta, intensities = parse_xrdml_2d(xrdml)
+    assert intensities.shape == (3, 3)
+    assert intensities[2, 1:].tolist() == [7.0, 8.0]
+
+
+def test_lazy_derived_columns(data_files):
+    from pydatalab.apps.xrd.blocks import XRD_DERIVED_COLUMNS
+    from pydatalab.derived_columns import _DERIVED_COLUMN_CACHE, clear_derived_column_cache
+
+    clear_derived_column_cache()
+    f = next(f for f in data_files if f.suffix == ".xye")
+
+    df, y_options = XRDBlock.load_pattern(f)
+    assert "intensity - median baseline" not in df.columns
+    assert "intensity - polyfit baseline" not in df.columns
+    assert y_options[:2] == ["normalized intensity", "intensity"]
+
+    df, y_options = XRDBlock.load_pattern(
+        f, derived_columns=["median baseline"], cache_key=("test", 1)
+    )
+    assert "intensity - median baseline" in y_options
+    assert "intensity - polyfit baseline" not in df.columns
+    assert (("test", 1), "median baseline") in _DERIVED_COLUMN_CACHE
+
+    cached_df, _ = XRDBlock.load_pattern(
+        f, derived_columns=XRD_DERIVED_COLUMNS.optional_names, cache_key=("test", 1)
+    )
+    assert cached_df["intensity - median baseline"].equals(df["intensity - median baseline"])
+    assert "intensity - polyfit baseline" in cached_df.columns
+
+
+def test_load_patterns_batched(data_files, tmp_path):
+    import shutil
+
+    from pydatalab.apps.xrd.utils import stack_patterns
+    from pydatalab.bokeh_plots import stacked_image_plot
+
+    file_infos = []
+    for ind, f in enumerate(sorted(data_files)[:6]):
+        location = tmp_path / f.name
+        shutil.copy(f, location)
+        file_infos.append({"location": str(location), "name": f.name, "revision": ind})
+
+    serial = XRDBlock.load_patterns(file_infos, wavelength=1.54)
+    assert all(Path(f["location"]).with_suffix(".XRD_PARSED.pkl").exists() for f in file_infos)
+    parallel = XRDBlock.load_patterns(file_infos, wavelength=1.54, parallel=True)
+    assert len(serial) == len(parallel) == len(file_infos)
+    for (df_serial, y_serial), (df_parallel, y_parallel) in zip(serial, parallel):
+        assert df_serial.equals(df_parallel)
+        assert y_serial == y_parallel
+
+    grid, stacked = stack_patterns([df for df, _ in serial])
+    assert stacked.shape == (len(file_infos), len(grid))
+    assert stacked.shape[1] == max(len(df) for df, _ in serial)
+
+    p = stacked_image_plot(grid, stacked, x_label="2θ (°)", labels=[f["name"] for f in file_infos])
+    assert p
+
+
+def test_pattern_stack(data_files, tmp_path):
+    import zipfile
+
+    import numpy as np
+
+    from pydatalab.apps.xrd.utils import get_pattern_stack_window, load_pattern_stack
+
+    patterns = sorted(f for f in data_files if f.name.startswith("Scan_C"))
+    archive = tmp_path / "operando.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        for f in patterns:
+            zf.write(f, f"series/{f.name}")
+
+    index = load_pattern_stack(archive)
+    assert index["names"][:3] == [
+        "series/Scan_C1.xrdml",
+        "series/Scan_C2.xrdml",
+        "series/Scan_C3.xrdml",
+    ]
+    assert index["shapes"][0][0] == len(patterns)
+    assert index["shapes"][-1][1] <= 1024
+    assert archive.with_suffix(".XRD_STACK.0.npy").exists()
+
+    full = np.load(archive.with_suffix(".XRD_STACK.0.npy"), mmap_mode="r")
+    first, _ = XRDBlock.load_pattern(patterns[0])
+    np.testing.assert_allclose(full[0], first["intensity"].to_numpy(), rtol=1e-5)
+
+    twotheta, rows, image = get_pattern_stack_window(archive, index)
+    assert image.shape == (len(patterns), len(twotheta))
+    assert len(twotheta) <= 1024
+
+    twotheta, rows, image = get_pattern_stack_window(
+        archive, index, twotheta_range=(20, 30), pattern_range=(2, 5)
+    )
+    assert rows.tolist() == [2, 3, 4, 5]
+    assert 20 <= twotheta[0] and twotheta[-1] <= 30
+    assert image.shape == (4, len(twotheta))
+
+
+def test_pattern_stack_descending_directory(tmp_path):
+    import numpy as np
+
+    from pydatalab.apps.xrd.utils import get_pattern_stack_window, load_pattern_stack
+
+    twotheta = np.linspace(80, 10, 500)
+    for ind in range(3):
+        np.savetxt(tmp_path / f"scan_{ind}.xy", np.column_stack([twotheta, twotheta + ind]))
+
+    index = load_pattern_stack(tmp_path)
+    grid = index["grids"][0]
+    assert grid[0] == 10 and grid[-1] == 80
+    assert not list(tmp_path.glob("*.tmp"))
+
+    twotheta_window, _, image = get_pattern_stack_window(tmp_path, index, twotheta_range=(20, 30))
+    assert 20 <= twotheta_window[0] and twotheta_window[-1] <= 30
+    np.testing.assert_allclose(image[2], twotheta_window + 2, rtol=1e-4)
+
+    # the stack is only rebuilt once the patterns change
+    index_location = tmp_path / ".XRD_STACK.pkl"
+    mtime = index_location.stat().st_mtime_ns
+    load_pattern_stack(tmp_path)
+    assert index_location.stat().st_mtime_ns == mtime
@@ -85,6 +85,8 @@ def app_config(tmp_path_factory):
         # Set to 10 MB to check that larger files fail; this should be larger than all of our example files.
         # Elsewhere, we can generate an artificial large file to check that it fails.
         "MAX_CONTENT_LENGTH": 10 * 1000**2,
+        # Generate file previews on request, rather than in background worker processes
+        "PREVIEW_WORKERS": 0,
     }
 
 
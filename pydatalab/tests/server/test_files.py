@@ -1,3 +1,4 @@
+import io
 import shutil
 
 import pytest
@@ -148,3 +149,306 @@ def test_upload_new_version(
         == response.json["file_information"]["location"]
     )
     assert response_reup.json["file_id"] == response.json["file_id"]
+
+
+def test_derived_images(client, tmpdir, insert_default_sample, default_sample):  # pylint: disable=unused-argument
+    import numpy as np
+    from PIL import Image
+
+    path = tmpdir / "large.tif"
+    Image.fromarray(np.arange(3000 * 2500, dtype=np.uint16).reshape(2500, 3000)).save(path)
+    with open(path, "rb") as f:
+        response = client.post(
+            "/upload-file/",
+            buffered=True,
+            content_type="multipart/form-data",
+            data={
+                "item_id": default_sample.item_id,
+                "file": [(f, "large.tif")],
+                "type": "application/octet-stream",
+                "replace_file": "null",
+                "relativePath": "null",
+            },
+        )
+    assert response.status_code == 201
+    file_id = response.json["file_id"]
+
+    response = client.get(f"/files/{file_id}/derived/web?revision=1")
+    assert response.status_code == 200
+    assert response.mimetype.startswith("image/")
+    assert "immutable" in response.headers["Cache-Control"]
+    assert max(Image.open(io.BytesIO(response.data)).size) == 2048
+
+    response = client.get(
+        f"/files/{file_id}/derived/web", headers={"If-None-Match": response.headers["ETag"]}
+    )
+    assert response.status_code == 304
+
+    assert client.get(f"/files/{file_id}/derived/thumbnail").status_code == 200
+    assert client.get(f"/files/{file_id}/derived/tile?column=5&row=4").status_code == 200
+    assert client.get(f"/files/{file_id}/derived/tile?column=6").status_code == 404
+    assert client.get(f"/files/{file_id}/derived/web?page=1").status_code == 404
+
+
+def test_derived_images_too_large(
+    client, tmpdir, monkeypatch, insert_default_sample, default_sample
+):  # pylint: disable=unused-argument
+    import numpy as np
+    from PIL import Image
+
+    path = tmpdir / "bomb.png"
+    Image.fromarray(np.zeros((200, 200), dtype=np.uint8)).save(path)
+    with open(path, "rb") as f:
+        response = client.post(
+            "/upload-file/",
+            buffered=True,
+            content_type="multipart/form-data",
+            data={
+                "item_id": default_sample.item_id,
+                "file": [(f, "bomb.png")],
+                "type": "application/octet-stream",
+                "replace_file": "null",
+                "relativePath": "null",
+            },
+        )
+    assert response.status_code == 201
+    file_id = response.json["file_id"]
+
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    response = client.get(f"/files/{file_id}/derived/web")
+    assert response.status_code == 422
+    assert "too large" in response.json["detail"]
+
+
+def test_file_previews(client, example_data_dir, insert_default_sample, default_sample):  # pylint: disable=unused-argument
+    from PIL import Image
+
+    from pydatalab.previews import SPARKLINE_SIZE
+
+    file_ids = {}
+    for name in ("XRD/Scan_C1.xrdml", "csv/simple.csv"):
+        path = example_data_dir / name
+        with open(path, "rb") as f:
+            response = client.post(
+                "/upload-file/",
+                buffered=True,
+                content_type="multipart/form-data",
+                data={
+                    "item_id": default_sample.item_id,
+                    "file": [(f, path.name)],
+                    "type": "application/octet-stream",
+                    "replace_file": "null",
+                    "relativePath": "null",
+                },
+            )
+        assert response.status_code == 201
+        file_ids[name] = response.json["file_id"]
+
+    response = client.get(f"/files/{file_ids['XRD/Scan_C1.xrdml']}/preview?revision=1")
+    assert response.status_code == 200
+    assert "immutable" in response.headers["Cache-Control"]
+    assert Image.open(io.BytesIO(response.data)).size == SPARKLINE_SIZE
+
+    assert client.get(f"/files/{file_ids['csv/simple.csv']}/preview").status_code == 404
+
+
+def test_file_range_and_conditional_requests(
+    client, tmpdir, insert_default_sample, default_sample, monkeypatch
+):  # pylint: disable=unused-argument
+    path = tmpdir / "clip.mp4"
+    path.write_binary(bytes(range(256)) * 40)
+    with open(path, "rb") as f:
+        response = client.post(
+            "/upload-file/",
+            buffered=True,
+            content_type="multipart/form-data",
+            data={
+                "item_id": default_sample.item_id,
+                "file": [(f, "clip.mp4")],
+                "type": "application/octet-stream",
+                "replace_file": "null",
+                "relativePath": "null",
+            },
+        )
+    assert response.status_code == 201
+    file_id = response.json["file_id"]
+
+    response = client.get(f"/files/{file_id}/clip.mp4")
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{file_id}-1"'
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert "Last-Modified" in response.headers
+
+    partial = client.get(f"/files/{file_id}/clip.mp4", headers={"Range": "bytes=100-199"})
+    assert partial.status_code == 206
+    assert partial.headers["Content-Range"] == "bytes 100-199/10240"
+    assert partial.data == response.data[100:200]
+
+    for headers in (
+        {"If-None-Match": response.headers["ETag"]},
+        {"If-Modified-Since": response.headers["Last-Modified"]},
+    ):
+        assert client.get(f"/files/{file_id}/clip.mp4", headers=headers).status_code == 304
+
+    assert client.get(f"/files/{file_id}/missing.mp4").status_code == 404
+
+    # in sendfile mode, the reverse proxy is asked to send the file instead
+    monkeypatch.setattr(CONFIG, "FILE_SENDFILE_MODE", "x-accel-redirect")
+    response = client.get(f"/files/{file_id}/clip.mp4")
+    assert response.status_code == 200
+    assert not response.data
+    assert (
+        response.headers["X-Accel-Redirect"]
+        == f"{CONFIG.FILE_ACCEL_REDIRECT_PREFIX}{file_id}/clip.mp4"
+    )
+    assert response.mimetype == "video/mp4"
+    response = client.get(
+        f"/files/{file_id}/clip.mp4", headers={"If-None-Match": response.headers["ETag"]}
+    )
+    assert response.status_code == 304
+    assert "X-Accel-Redirect" not in response.headers
+
+
+def test_chunked_upload(client, insert_default_sample, default_sample):  # pylint: disable=unused-argument
+    import hashlib
+
+    data = bytes(range(256)) * 1000
+    response = client.post(
+        "/uploads/",
+        json={"filename": "chunked.bin", "size": len(data), "item_id": default_sample.item_id},
+    )
+    assert response.status_code == 201
+    upload_id = response.json["upload_id"]
+    chunk_size = 100_000
+    assert response.json["chunk_size"] >= chunk_size
+
+    def put_chunk(offset, chunk, sha256=None):
+        return client.put(
+            f"/uploads/{upload_id}?offset={offset}",
+            data=chunk,
+            headers={"X-Chunk-SHA256": sha256 or hashlib.sha256(chunk).hexdigest()},
+            content_type="application/octet-stream",
+        )
+
+    assert put_chunk(0, data[:chunk_size]).json["received"] == chunk_size
+    # corrupted or out-of-order chunks are rejected, and can then be resent
+    assert put_chunk(chunk_size, data[chunk_size : 2 * chunk_size], "0" * 64).status_code == 400
+    assert put_chunk(0, data[:chunk_size]).status_code == 409
+    assert client.post(f"/uploads/{upload_id}/finalize").status_code == 409
+    assert client.get(f"/uploads/{upload_id}").json["received"] == chunk_size
+
+    for offset in range(chunk_size, len(data), chunk_size):
+        response = put_chunk(offset, data[offset : offset + chunk_size])
+        assert response.status_code == 200
+    assert response.json["received"] == len(data)
+
+    response = client.post(f"/uploads/{upload_id}/finalize")
+    assert response.status_code == 201
+    assert not response.json["is_update"]
+    file_id = response.json["file_id"]
+    assert response.json["file_information"]["size"] == len(data)
+    assert client.get(f"/files/{file_id}/chunked.bin").data == data
+    assert client.get(f"/uploads/{upload_id}").status_code == 404
+
+    # a new revision can be uploaded in the same way
+    response = client.post(
+        "/uploads/", json={"filename": "chunked.bin", "size": 3, "replace_file": file_id}
+    )
+    upload_id = response.json["upload_id"]
+    assert put_chunk(0, b"new").status_code == 200
+    response = client.post(f"/uploads/{upload_id}/finalize")
+    assert response.json["is_update"]
+    assert client.get(f"/files/{file_id}/chunked.bin").data == b"new"
+
+    # files that are too large are refused up front
+    response = client.post(
+        "/uploads/",
+        json={
+            "filename": "huge.bin",
+            "size": CONFIG.MAX_CONTENT_LENGTH + 1,
+            "item_id": default_sample.item_id,
+        },
+    )
+    assert response.status_code == 413
+
+    # malformed requests are rejected
+    assert client.post("/uploads/", json=["chunked.bin", 10]).status_code == 400
+    response = client.post(
+        "/uploads/", json={"filename": "chunked.bin", "size": 10, "replace_file": "not-an-id"}
+    )
+    assert response.status_code == 400
+    response = client.post(
+        "/uploads/", json={"filename": "chunked.bin", "size": 10, "item_id": "no-such-item"}
+    )
+    assert response.status_code == 400
+
+    response = client.post(
+        "/uploads/", json={"filename": "abort.bin", "size": 10, "item_id": default_sample.item_id}
+    )
+    upload_id = response.json["upload_id"]
+    assert client.delete(f"/uploads/{upload_id}").status_code == 200
+    assert client.get(f"/uploads/{upload_id}").status_code == 404
+
+
+def test_deduplicated_uploads(client, database, tmpdir, insert_default_sample, default_sample):  # pylint: disable=unused-argument
+    import os
+
+    def upload(data, name="dedup.csv", replace_file="null"):
+        response = client.post(
+            "/upload-file/",
+            buffered=True,
+            content_type="multipart/form-data",
+            data={
+                "item_id": default_sample.item_id,
+                "file": [(io.BytesIO(data), name)],
+                "type": "application/octet-stream",
+                "replace_file": replace_file,
+                "relativePath": "null",
+            },
+        )
+        assert response.status_code == 201
+        return response.json["file_id"], response.json["file_information"]
+
+    data = b"time,voltage\n" + b"0,1\n" * 1000
+    first_id, first = upload(data)
+    second_id, second = upload(data)
+    assert first_id != second_id
+    assert first["content_hash"] == second["content_hash"]
+    assert first["location"] != second["location"]
+
+    # the contents are stored once, and caches written alongside one file are shared
+    assert os.path.samefile(first["location"], second["location"])
+    cache = os.path.splitext(first["location"])[0] + ".cache.pkl"
+    with open(cache, "wb") as f:
+        f.write(b"cached")
+    assert os.path.exists(os.path.splitext(second["location"])[0] + ".cache.pkl")
+    assert database.blobs.find_one({"_id": first["content_hash"]})["refcount"] == 2
+
+    # a new version of one file leaves the other untouched
+    upload(b"time,voltage\n0,2\n", replace_file=first_id)
+    assert client.get(f"/files/{first_id}/dedup.csv").data == b"time,voltage\n0,2\n"
+    assert client.get(f"/files/{second_id}/dedup.csv").data == data
+    assert not os.path.exists(os.path.splitext(first["location"])[0] + ".cache.pkl")
+    assert database.blobs.find_one({"_id": first["content_hash"]})["refcount"] == 1
+
+    # a file with the same contents but a different name shares the same blob
+    _, renamed = upload(data, name="renamed.csv")
+    assert renamed["content_hash"] == first["content_hash"]
+    assert os.path.samefile(renamed["location"], second["location"])
+    assert database.blobs.find_one({"_id": first["content_hash"]})["refcount"] == 2
+
+    # a blob that is marked for deletion while being stored again is replaced by a new
+    # generation, rather than having the new contents removed along with it
+    blob = database.blobs.find_one({"_id": first["content_hash"]})
+    old_directory = os.path.realpath(os.path.dirname(second["location"]))
+    database.blobs.update_one(
+        {"_id": first["content_hash"]}, {"$set": {"refcount": 0, "deleting": True}}
+    )
+    restored_id, restored = upload(data)
+    assert restored["content_hash"] == first["content_hash"]
+    new_blob = database.blobs.find_one({"_id": first["content_hash"]})
+    assert new_blob["generation"] != blob["generation"]
+    assert new_blob["refcount"] == 1
+    assert not new_blob.get("deleting")
+    assert not os.path.exists(old_directory)
+    assert client.get(f"/files/{restored_id}/dedup.csv").data == data
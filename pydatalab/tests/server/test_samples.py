@@ -1,6 +1,7 @@
 import copy
 import datetime
 import json
+import time
 
 import pytest
 
@@ -700,3 +701,80 @@ def test_add_items_to_collection_success(client, default_collection, example_ite
     child_refcodes = [item["refcode"] for item in collection_data["child_items"]]
 
     assert all(refcode in child_refcodes for refcode in refcodes)
+
+
+@pytest.mark.dependency(depends=["test_create_collections"])
+def test_collection_capacity_fade(client, default_collection):
+    response = client.get(f"/collections/{default_collection.collection_id}/capacity-fade")
+    assert response.status_code == 200, response.json
+    assert response.json["status"] == "success"
+    assert response.json["data"] == []
+    assert response.json["pending_file_ids"] == []
+
+    response = client.get("/collections/random_id/capacity-fade")
+    assert response.status_code == 404, response.json
+
+
+@pytest.mark.dependency(depends=["test_collection_capacity_fade"])
+def test_collection_capacity_fade_caching(client, default_filepath, tmp_path):
+    collection_id = "capacity_fade_collection"
+    response = client.put("/collections", json={"data": {"collection_id": collection_id}})
+    assert response.status_code == 201, response.json
+    response = client.post(
+        "/new-sample/",
+        json={
+            "new_sample_data": {
+                "item_id": "capacity_fade_cell",
+                "type": "cells",
+                "collections": [{"collection_id": collection_id}],
+            }
+        },
+    )
+    assert response.status_code == 201, response.json
+
+    bad_filepath = tmp_path / "bad.mpr"
+    bad_filepath.write_bytes(b"not a cycler file" * 100)
+    file_ids = {}
+    for path in (default_filepath, bad_filepath):
+        with open(path, "rb") as f:
+            response = client.post(
+                "/upload-file/",
+                buffered=True,
+                content_type="multipart/form-data",
+                data={
+                    "item_id": "capacity_fade_cell",
+                    "file": [(f, path.name)],
+                    "type": "application/octet-stream",
+                    "replace_file": "null",
+                    "relativePath": "null",
+                },
+            )
+        assert response.status_code == 201, response.json
+        file_ids[path.name] = response.json["file_id"]
+
+    # files without a cached summary are queued for parsing rather than parsed in the request
+    response = client.get(f"/collections/{collection_id}/capacity-fade")
+    assert response.status_code == 200, response.json
+    assert set(response.json["pending_file_ids"]) == set(file_ids.values())
+    assert response.json["data"] == []
+
+    for _ in range(120):
+        response = client.get(f"/collections/{collection_id}/capacity-fade")
+        assert response.status_code == 200, response.json
+        if not response.json["pending_file_ids"]:
+            break
+        time.sleep(0.5)
+    else:
+        pytest.fail("Capacity fade data was never cached")
+
+    assert [series["file_id"] for series in response.json["data"]] == [
+        file_ids[default_filepath.name]
+    ]
+    assert len(response.json["errors"]) == 1
+    assert "bad.mpr" in response.json["errors"][0]
+
+    # the cached summaries and recorded errors are reused without queueing new jobs
+    response = client.get(f"/collections/{collection_id}/capacity-fade")
+    assert response.json["pending_file_ids"] == []
+    assert len(response.json["data"]) == 1
+    assert len(response.json["errors"]) == 1
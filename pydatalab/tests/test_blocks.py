@@ -0,0 +1,29 @@
+from pydatalab.apps.echem import CycleBlock
+from pydatalab.blocks import BLOCK_TYPES
+
+
+def test_block_from_db_roundtrip():
+    block = BLOCK_TYPES["comment"](item_id="test_item", init_data={"freeform_comment": "test"})
+    db_entry = block.to_db()
+
+    new_block = BLOCK_TYPES["comment"].from_db(db_entry)
+    assert new_block.block_id == block.block_id
+    assert new_block.data["item_id"] == "test_item"
+    assert new_block.data["freeform_comment"] == "test"
+
+
+def test_block_item_context():
+    item_context = {"item_id": "test_item", "characteristic_mass": 500.0}
+    block = CycleBlock.from_db(
+        {"item_id": "test_item", "block_id": "abc", "blocktype": "cycle"},
+        item_context=item_context,
+    )
+    assert block.get_item_context() is item_context
+    assert block._get_characteristic_mass_g() == 0.5
+    assert "characteristic_mass" not in block.to_db()
+
+    block = CycleBlock.from_web(
+        {"item_id": "test_item", "block_id": "abc", "blocktype": "cycle"},
+        item_context={"item_id": "test_item"},
+    )
+    assert block._get_characteristic_mass_g() is None
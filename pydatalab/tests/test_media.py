@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from pydatalab.media import (
+    DERIVED_IMAGE_SIZES,
+    TILE_SIZE,
+    get_derived_image,
+    get_image_info,
+    get_image_tile,
+)
+
+
+@pytest.fixture
+def multipage_tiff(tmp_path):
+    rng = np.random.default_rng(0)
+    pages = [
+        Image.fromarray((rng.random((1500, 3000)) * 60000).astype(np.uint16)),
+        Image.fromarray((rng.random((200, 300)) * 60000).astype(np.uint16)),
+    ]
+    path = tmp_path / "1" / "stack.tif"
+    path.parent.mkdir()
+    pages[0].save(path, save_all=True, append_images=pages[1:])
+    return {"location": str(path), "revision": 1}
+
+
+def test_derived_images(multipage_tiff):
+    info = get_image_info(multipage_tiff)
+    assert info["num_pages"] == 2
+    assert info["sizes"] == [[3000, 1500], [300, 200]]
+
+    for kind, size in DERIVED_IMAGE_SIZES.items():
+        with Image.open(get_derived_image(multipage_tiff, kind, page=0)) as image:
+            assert max(image.size) == size
+
+    # pages are only decoded when requested, and never upscaled
+    directory = get_derived_image(multipage_tiff, "web").parent
+    assert not list(directory.glob("*-1.*"))
+    with Image.open(get_derived_image(multipage_tiff, "web", page=1)) as image:
+        assert image.size == (300, 200)
+
+    with pytest.raises(ValueError):
+        get_derived_image(multipage_tiff, "web", page=2)
+    with pytest.raises(ValueError):
+        get_derived_image(multipage_tiff, "original")
+
+
+def test_image_tiles_and_revisions(multipage_tiff):
+    with Image.open(get_image_tile(multipage_tiff, 0, 5, 2)) as tile:
+        assert tile.size == (3000 - 5 * TILE_SIZE, 1500 - 2 * TILE_SIZE)
+    with Image.open(get_image_tile(multipage_tiff, 0, 0, 0)) as tile:
+        assert tile.size == (TILE_SIZE, TILE_SIZE)
+    with pytest.raises(ValueError):
+        get_image_tile(multipage_tiff, 0, 6, 0)
+
+    old = get_derived_image(multipage_tiff, "thumbnail")
+    new = get_derived_image({**multipage_tiff, "revision": 2}, "thumbnail")
+    assert new != old
+    assert new.exists()
+    assert not old.exists()
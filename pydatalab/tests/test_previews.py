@@ -0,0 +1,83 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from pydatalab.media import DERIVED_IMAGE_SIZES
+from pydatalab.previews import SPARKLINE_SIZE, get_preview
+
+EXAMPLE_DATA = Path(__file__).parent.parent / "example_data"
+
+
+def _copy(source: Path, tmp_path: Path, revision: int = 1) -> dict:
+    path = tmp_path / source.name
+    shutil.copy(source, path)
+    return {"location": str(path), "revision": revision, "name": path.name}
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        EXAMPLE_DATA / "XRD" / "Scan_C1.xrdml",
+        EXAMPLE_DATA / "XRD" / "example_bmb.xye",
+        EXAMPLE_DATA / "raman" / "raman_example.txt",
+        EXAMPLE_DATA / "echem" / "jdb11-1_c3_gcpl_5cycles_2V-3p8V_C-24_data_C09.mpr",
+    ],
+)
+def test_sparkline_previews(source, tmp_path):
+    file_info = _copy(source, tmp_path)
+    path = get_preview(file_info)
+    assert path is not None
+    with Image.open(path) as image:
+        assert image.size == SPARKLINE_SIZE
+        # something has been drawn on the transparent background
+        assert np.asarray(image.convert("RGBA"))[..., 3].max() == 255
+
+    # previews are cached per revision, and those of older revisions are removed
+    assert get_preview(file_info) == path
+    file_info["revision"] = 2
+    new_path = get_preview(file_info)
+    assert new_path != path
+    assert new_path.exists() and not path.exists()
+
+
+def test_image_and_unrecognised_previews(tmp_path):
+    image_path = tmp_path / "photo.png"
+    Image.new("RGB", (1000, 500), "red").save(image_path)
+    path = get_preview({"location": str(image_path), "revision": 1, "name": "photo.png"})
+    with Image.open(path) as image:
+        assert max(image.size) == DERIVED_IMAGE_SIZES["thumbnail"]
+
+    assert get_preview(_copy(EXAMPLE_DATA / "csv" / "simple.csv", tmp_path)) is None
+
+    # .txt files that are not recognised by any app are marked as having no preview
+    text = tmp_path / "notes.txt"
+    text.write_text("not data")
+    file_info = {"location": str(text), "revision": 1, "name": "notes.txt"}
+    assert get_preview(file_info) is None
+    assert list(text.with_suffix(".DERIVED").glob("r1/preview.none"))
+    assert get_preview(file_info) is None
+
+
+def test_previews_pending_in_other_processes(tmp_path):
+    import os
+
+    from pydatalab.media import prepare_derived_directory
+    from pydatalab.previews import is_preview_pending
+
+    # a preview queued by another server process is marked as pending in the derived directory
+    file_info = _copy(EXAMPLE_DATA / "XRD" / "example_bmb.xye", tmp_path)
+    marker = prepare_derived_directory(file_info) / "preview.pending"
+    marker.touch()
+    assert is_preview_pending(file_info)
+
+    # unless it has been pending for so long that its job must have failed
+    os.utime(marker, (0, 0))
+    assert not is_preview_pending(file_info)
+
+    marker.touch()
+    assert get_preview(file_info) is not None
+    assert not marker.exists()
+    assert not is_preview_pending(file_info)
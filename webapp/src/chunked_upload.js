@@ -0,0 +1,121 @@
+// An Uppy uploader that sends files to the API in checksummed chunks, so that large
+// uploads do not need to fit in a single request and can be resumed after a failed chunk.
+import { Plugin } from "@uppy/core";
+import { Buffer } from "buffer";
+import { createHash } from "crypto";
+
+import { construct_headers } from "@/server_fetch_utils.js";
+
+const MAX_CHUNK_ATTEMPTS = 3;
+
+async function sha256Hex(buffer) {
+  // The Web Crypto API is only available in secure contexts (HTTPS or localhost),
+  // so fall back to the bundled implementation for plain-HTTP deployments
+  if (!globalThis.crypto?.subtle) {
+    return createHash("sha256").update(Buffer.from(buffer)).digest("hex");
+  }
+  const digest = await globalThis.crypto.subtle.digest("SHA-256", buffer);
+  return Array.from(new Uint8Array(digest))
+    .map((byte) => byte.toString(16).padStart(2, "0"))
+    .join("");
+}
+
+async function apiRequest(url, options) {
+  const response = await fetch(url, {
+    credentials: "include",
+    ...options,
+    headers: construct_headers(options.headers || {}),
+  });
+  const body = await response.json();
+  if (!response.ok) {
+    const error = new Error(body.description || body.message || body.error || response.statusText);
+    error.status = response.status;
+    throw error;
+  }
+  return body;
+}
+
+export default class ChunkedUpload extends Plugin {
+  constructor(uppy, opts) {
+    super(uppy, opts);
+    this.id = opts.id || "ChunkedUpload";
+    this.type = "uploader";
+    this.endpoint = opts.endpoint;
+    this.handleUpload = this.handleUpload.bind(this);
+  }
+
+  install() {
+    this.uppy.addUploader(this.handleUpload);
+  }
+
+  uninstall() {
+    this.uppy.removeUploader(this.handleUpload);
+  }
+
+  async handleUpload(fileIDs) {
+    for (const id of fileIDs) {
+      const file = this.uppy.getFile(id);
+      this.uppy.emit("upload-started", file);
+      try {
+        const body = await this.uploadFile(file);
+        this.uppy.emit("upload-success", file, { status: 201, body });
+      } catch (error) {
+        this.uppy.emit("upload-error", file, error);
+      }
+    }
+  }
+
+  async uploadFile(file) {
+    const upload = await apiRequest(`${this.endpoint}/`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        filename: file.name,
+        size: file.size,
+        item_id: file.meta.item_id,
+        replace_file: file.meta.replace_file,
+        last_modified: file.data.lastModified
+          ? new Date(file.data.lastModified).toISOString()
+          : null,
+      }),
+    });
+    const url = `${this.endpoint}/${upload.upload_id}`;
+
+    try {
+      let received = upload.received;
+      let attempts = 0;
+      while (received < file.size) {
+        const chunk = await file.data
+          .slice(received, Math.min(received + upload.chunk_size, file.size))
+          .arrayBuffer();
+        try {
+          const status = await apiRequest(`${url}?offset=${received}`, {
+            method: "PUT",
+            headers: {
+              "Content-Type": "application/octet-stream",
+              "X-Chunk-SHA256": await sha256Hex(chunk),
+            },
+            body: chunk,
+          });
+          received = status.received;
+          attempts = 0;
+        } catch (error) {
+          if (++attempts >= MAX_CHUNK_ATTEMPTS) {
+            throw error;
+          }
+          // resume from however much the server has stored
+          received = (await apiRequest(url, { method: "GET" })).received;
+        }
+        this.uppy.emit("upload-progress", file, {
+          uploader: this,
+          bytesUploaded: received,
+          bytesTotal: file.size,
+        });
+      }
+      return await apiRequest(`${url}/finalize`, { method: "POST" });
+    } catch (error) {
+      apiRequest(url, { method: "DELETE" }).catch(() => {});
+      throw error;
+    }
+  }
+}
@@ -2,11 +2,11 @@ import "@uppy/core/dist/style.css";
 import "@uppy/dashboard/dist/style.css";
 import Uppy from "@uppy/core";
 import Dashboard from "@uppy/dashboard";
-import XHRUpload from "@uppy/xhr-upload";
 import Webcam from "@uppy/webcam";
 
+import ChunkedUpload from "@/chunked_upload.js";
+
 import store from "@/store/index.js";
-import { construct_headers } from "@/server_fetch_utils.js";
 
 import { API_URL, UPPY_MAX_NUMBER_OF_FILES, UPPY_MAX_TOTAL_FILE_SIZE } from "@/resources.js";
 // file-upload loaded
@@ -19,7 +19,6 @@ export default function setupUppy(item_id, trigger_selector, reactive_file_list)
       maxNumberOfFiles: UPPY_MAX_NUMBER_OF_FILES, // Similarly, a max of 10000 files in one upload as a single "File" entry feels reasonable, once we move to uploading folders etc.
     },
   });
-  let headers = construct_headers();
   uppy
     .use(Dashboard, {
       inline: false,
@@ -27,14 +26,9 @@ export default function setupUppy(item_id, trigger_selector, reactive_file_list)
       close_after_finish: true,
     })
     .use(Webcam, { target: Dashboard })
-    .use(XHRUpload, {
-      //someday, try to upgrade this to Tus for resumable uploads
-      headers: headers,
-      endpoint: `${API_URL}/upload-file/`,
-      FormData: true, // send as form
-      fieldName: "files[]", // default, think about whether or not to change this
-      showProgressDetails: true,
-      withCredentials: true,
+    .use(ChunkedUpload, {
+      // files are sent in checksummed chunks, which are retried if they fail
+      endpoint: `${API_URL}/uploads`,
     });
 
   uppy.on("file-added", (file) => {
@@ -1,11 +1,13 @@
 // Resources for the application
 import DataBlockBase from "@/components/datablocks/DataBlockBase";
-import BokehBlock from "@/components/datablocks/BokehBlock";
 import MediaBlock from "@/components/datablocks/MediaBlock";
 import XRDBlock from "@/components/datablocks/XRDBlock";
+import XRDHeatmapBlock from "@/components/datablocks/XRDHeatmapBlock";
+import TabularDataBlock from "@/components/datablocks/TabularDataBlock";
 import ChatBlock from "@/components/datablocks/ChatBlock";
 import RamanBlock from "@/components/datablocks/RamanBlock";
 import CycleBlock from "@/components/datablocks/CycleBlock";
+import CapacityFadeBlock from "@/components/datablocks/CapacityFadeBlock";
 import NMRBlock from "@/components/datablocks/NMRBlock";
 import EISBlock from "@/components/datablocks/EISBlock";
 import MassSpecBlock from "@/components/datablocks/MassSpecBlock";
@@ -56,10 +58,20 @@ export const debounceTime = 250; // time after user stops typing before request
 export const blockTypes = {
   comment: { description: "Comment", component: DataBlockBase, name: "Comment" },
   media: { description: "Media", component: MediaBlock, name: "Media" },
-  tabular: { description: "Tabular Data", component: BokehBlock, name: "Tabular data" },
+  tabular: { description: "Tabular Data", component: TabularDataBlock, name: "Tabular data" },
   xrd: { description: "Powder XRD", component: XRDBlock, name: "Powder XRD" },
+  "xrd-heatmap": {
+    description: "In situ XRD heatmap",
+    component: XRDHeatmapBlock,
+    name: "In situ XRD",
+  },
   raman: { description: "Raman", component: RamanBlock, name: "Raman" },
   cycle: { description: "Electrochemistry", component: CycleBlock, name: "Electrochemistry" },
+  "capacity-fade": {
+    description: "Capacity fade across cells",
+    component: CapacityFadeBlock,
+    name: "Capacity fade",
+  },
   eis: { description: "Electrochemical Impedance Spectroscopy", component: EISBlock, name: "EIS" },
   nmr: { description: "Nuclear Magnetic Resonance Spectroscopy", component: NMRBlock, name: "NMR" },
   ms: { description: "Mass Spectrometry", component: MassSpecBlock, name: "Mass Spectrometry" },